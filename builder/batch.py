@@ -0,0 +1,176 @@
+import os
+import sys
+import logging
+from argparse import Namespace
+from subprocess import Popen, STDOUT
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from builder.lib import config, utils
+from builder.lib.context import ArchBuilderContext
+log = logging.getLogger(__name__)
+
+
+class BatchPreset:
+	"""
+	Preset to build in a worker process
+	"""
+	name: str = None
+
+	"""
+	Top tree folder, used by config loader
+	"""
+	dir: str = None
+
+	"""
+	Merged config without subscript resolved
+	"""
+	config: dict = None
+
+	"""
+	Preset mode, used by config loader
+	"""
+	preset: bool = False
+
+	"""
+	Key of shared rootfs snapshot after packages installed
+	"""
+	layer: str = None
+
+	def __init__(self, dir: str, name: str):
+		self.dir = dir
+		self.name = name
+		self.config = {}
+
+	def load(self, extra: list[str], mirrors: list[str]):
+		"""
+		Load preset with all configs to find out shared packages snapshot,
+		in same order as builder loads them
+		"""
+		config.load_preset(self, self.name)
+		configs: list[str] = list(extra)
+		configs.extend(self.config["package"].get("configs", []))
+		configs.extend(f"mirrors/{name}" for name in mirrors)
+		config.load_configs(self, configs)
+
+		# stages after packages always run in every preset
+		self.layer = utils.layer_key(self.config)
+
+
+def find_presets(ctx: ArchBuilderContext) -> list[str]:
+	"""
+	List all presets in configs/presets
+	"""
+	ret: list[str] = []
+	folder = os.path.join(ctx.dir, "configs", "presets")
+	for file in sorted(os.listdir(folder)):
+		if not file.endswith((".yaml", ".yml", ".jsn", ".json")): continue
+		ret.append(file[:file.rfind(".")])
+	return ret
+
+
+def worker_args(ctx: ArchBuilderContext, args: Namespace, preset: str, cache: str) -> list[str]:
+	"""
+	Generate command line for a worker builder
+	"""
+	cmds = [sys.executable, os.path.join(ctx.dir, "build.py")]
+	cmds.extend(["--preset", preset])
+	cmds.extend(["--workspace", os.path.join(ctx.work, preset)])
+	cmds.extend(["--artifacts", ctx.artifacts])
+	cmds.extend(["--snapshot-cache", cache])
+	for conf in args.config or []: cmds.extend(["--config", conf])
+	for mirror in args.mirror or []: cmds.extend(["--mirror", mirror])
+	if args.snapshot_limit: cmds.extend(["--snapshot-limit", args.snapshot_limit])
+	if ctx.keyring_cache: cmds.extend(["--keyring-cache", ctx.keyring_cache])
+	if ctx.proxy_cache: cmds.extend(["--proxy-cache", ctx.proxy_cache])
+	if ctx.package_cache: cmds.extend(["--package-cache", ctx.package_cache])
+	if args.package_cache_limit: cmds.extend(["--package-cache-limit", args.package_cache_limit])
+	if ctx.trace:
+		base, ext = os.path.splitext(ctx.trace)
+		cmds.extend(["--trace", f"{base}-{preset}{ext}"])
+	if ctx.lock: cmds.extend(["--lock", ctx.lock])
+	if ctx.write_lock == "": cmds.append("--write-lock")
+	elif ctx.write_lock:
+		base, ext = os.path.splitext(ctx.write_lock)
+		cmds.extend(["--write-lock", f"{base}-{preset}{ext}"])
+	if args.download_jobs is not None: cmds.extend(["--download-jobs", str(args.download_jobs)])
+	if args.clean: cmds.append("--clean")
+	if args.repack: cmds.append("--repack")
+	if args.update: cmds.append("--update")
+	if args.debug: cmds.append("--debug")
+	if args.no_gpgcheck: cmds.append("--no-gpgcheck")
+	if args.no_checkpoint: cmds.append("--no-checkpoint")
+	if args.no_refresh: cmds.append("--no-refresh")
+	if args.no_probe: cmds.append("--no-probe")
+	if args.no_pipeline: cmds.append("--no-pipeline")
+	if args.no_preverify: cmds.append("--no-preverify")
+	if args.fast_bootstrap: cmds.append("--fast-bootstrap")
+	return cmds
+
+
+def run_worker(ctx: ArchBuilderContext, args: Namespace, preset: str, cache: str) -> int:
+	"""
+	Build one preset in a new process with own workspace and cgroup
+	"""
+	cmds = worker_args(ctx, args, preset, cache)
+	logfile = os.path.join(ctx.work, f"{preset}.log")
+	env = os.environ.copy()
+	env["ARCH_CGROUP"] = f"arch-image-builder-{preset}"
+	log.info(f"start building preset {preset}, log in {logfile}")
+	log.debug("running worker %s", " ".join(cmds))
+	with open(logfile, "w") as f:
+		proc = Popen(cmds, env=env, stdout=f, stderr=STDOUT)
+		ret = proc.wait()
+	if ret == 0: log.info(f"build preset {preset} done")
+	else: log.error(f"build preset {preset} failed with {ret}, see {logfile}")
+	return ret
+
+
+def build_presets(ctx: ArchBuilderContext, args: Namespace, presets: list[str]):
+	"""
+	Build multiple presets, presets shared same base layers
+	build first one to create rootfs snapshot, then others in parallel
+	"""
+	os.makedirs(ctx.work, mode=0o0755, exist_ok=True)
+	cache = ctx.snapshot_cache or os.path.join(ctx.work, "snapshots")
+	if not ctx.package_cache:
+		ctx.package_cache = os.path.join(ctx.work, "packages")
+	if not ctx.keyring_cache:
+		ctx.keyring_cache = os.path.join(ctx.work, "keyrings")
+	extra: list[str] = []
+	for conf in args.config or []:
+		extra.extend(conf.split(","))
+	mirrors: list[str] = []
+	for mirror in args.mirror or []:
+		mirrors.extend(mirror.split(","))
+
+	# group presets by shared packages snapshot
+	groups: dict[str, list[str]] = {}
+	for name in presets:
+		preset = BatchPreset(ctx.dir, name)
+		preset.load(extra, mirrors)
+		groups.setdefault(preset.layer, []).append(name)
+	for layer, names in groups.items():
+		log.info("presets %s share packages snapshot %s", " ".join(names), layer[:12])
+
+	failed: list[str] = []
+	pending: dict[Future, list[str]] = {}
+	jobs = max(1, args.jobs)
+	log.info(f"building {len(presets)} presets in {len(groups)} groups with {jobs} jobs")
+	with ThreadPoolExecutor(max_workers=jobs) as pool:
+		# build first preset in every group to create shared packages snapshot
+		for names in groups.values():
+			future = pool.submit(run_worker, ctx, args, names[0], cache)
+			pending[future] = [names[0], names[1:]]
+
+		# rest presets reuse packages snapshot, then run all later stages
+		while pending:
+			done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+			for future in done:
+				name, rest = pending.pop(future)
+				if future.result() != 0: failed.append(name)
+				for other in rest:
+					item = pool.submit(run_worker, ctx, args, other, cache)
+					pending[item] = [other, []]
+
+	if failed:
+		raise RuntimeError("build presets failed: %s" % " ".join(failed))
+	log.info(f"all {len(presets)} presets built, your packages are in {ctx.artifacts}")
@@ -17,4 +17,5 @@ def proc_bootloader(ctx: ArchBuilderContext):
 	for method in ctx.get("bootloader.method", []):
 		if method not in methods:
 			raise ValueError(f"unsupported bootloader method {method}")
-		methods[method](ctx)
+		with ctx.profile.span("bootloader", method):
+			methods[method](ctx)
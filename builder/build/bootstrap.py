@@ -6,8 +6,11 @@ from builder.build import mount, fstab, bootloader, user, filesystem, script
 from builder.build import locale, systemd, mkinitcpio, names
 from builder.build import pacman as pacman_build
 from builder.component import pacman as pacman_comp
+from builder.component.keyring_cache import KeyringCache
 from builder.lib.context import ArchBuilderContext
+from builder.lib.checkpoint import StageCheckpoint, hook_inputs, package_inputs
 from builder.lib.mount import MountTab
+from builder.lib.utils import hash_file
 log = getLogger(__name__)
 
 
@@ -51,11 +54,86 @@ def remove_workspace(ctx: ArchBuilderContext):
 
 
 def run_hooks(ctx: ArchBuilderContext, stage: str=None):
-	# run add files hooks
-	filesystem.add_files_all(ctx, stage)
+	with ctx.profile.span("hook", stage or "default"):
+		# run add files hooks
+		filesystem.add_files_all(ctx, stage)
 
-	# run scripts hooks
-	script.run_scripts(ctx, stage)
+		# run scripts hooks
+		script.run_scripts(ctx, stage)
+
+
+def init_keyring(ctx: ArchBuilderContext, pacman: pacman_comp.Pacman):
+	"""
+	Initialize build time keyring and trust all keys
+	"""
+	# one gpg trustdb check after all steps
+	with pacman.pacman_key.session():
+		with ctx.profile.span("step", "keyring"):
+			pacman.init_keyring()
+
+		# trust pgp key in config (for keyring packages, allow failed)
+		with ctx.profile.span("step", "trust"):
+			pacman_build.trust_all(ctx, pacman, True)
+
+		# install all keyring packages before other packages
+		with ctx.profile.span("step", "keyring-packages"):
+			pacman_build.proc_pacman_keyring(ctx, pacman)
+
+		# trust pgp key in config
+		with ctx.profile.span("step", "trust"):
+			pacman_build.trust_all(ctx, pacman)
+
+
+def build_packages(ctx: ArchBuilderContext):
+	"""
+	Initialize pacman, then install or remove all packages
+	"""
+	# initialize pacman context
+	pacman = pacman_comp.Pacman(ctx)
+
+	if ctx.lock:
+		# locked packages never need databases
+		pacman_build.load_lock(ctx, pacman)
+	else:
+		# update pacman repos databases
+		with ctx.profile.span("step", "databases"):
+			pacman.load_databases()
+		if ctx.write_lock is not None:
+			pacman_build.write_lock(ctx, pacman)
+
+	# download packages while keyring initializing, update only downloads changed packages
+	snapshot = None
+	if ctx.pipeline and not ctx.update:
+		snapshot = pacman_build.snapshot_key(ctx, pacman)
+	if ctx.pipeline and not ctx.update and not pacman_build.has_snapshot(ctx, snapshot):
+		if pacman.locked is not None:
+			pacman.start_prefetch(list(pacman.locked.keys()))
+		else:
+			plan = pacman_build.plan_transaction(ctx, pacman)
+			pacman.start_prefetch(plan["install"])
+
+	try:
+		# build time keyring, copy from cache for a clean rootfs
+		keyrings = KeyringCache(ctx)
+		gpgdir = pacman.handle.gpgdir
+		fresh = not os.path.exists(os.path.join(gpgdir, "trustdb.gpg"))
+		key = keyrings.make_key(pacman) if fresh else None
+		with ctx.profile.span("step", "keyring-cache"):
+			restored = keyrings.restore(key, gpgdir)
+		if restored:
+			pacman.init_mirrorlists()
+		else:
+			init_keyring(ctx, pacman)
+			if fresh: keyrings.save(key, gpgdir)
+	finally:
+		pacman.wait_prefetch()
+
+	# run hooks for pacman settings
+	run_hooks(ctx, "pre-pacman")
+
+	# real install all packages
+	with ctx.profile.span("step", "packages"):
+		pacman_build.proc_pacman(ctx, pacman, snapshot)
 
 
 def build_rootfs(ctx: ArchBuilderContext):
@@ -80,8 +158,10 @@ def build_rootfs(ctx: ArchBuilderContext):
 	# build rootfs contents
 	if not ctx.repack:
 		try:
+			stages = StageCheckpoint(ctx)
+
 			# run hooks for environment init
-			run_hooks(ctx, "pre-init")
+			stages.run("pre-init", [], run_hooks, ctx, "pre-init", extra=hook_inputs(ctx, "pre-init"))
 
 			# initialize basic folders
 			mount.init_rootfs(ctx)
@@ -90,61 +170,78 @@ def build_rootfs(ctx: ArchBuilderContext):
 			mount.init_mount(ctx)
 
 			# run hooks for build settings
-			run_hooks(ctx, "pre-build")
-
-			# initialize pacman context
-			pacman = pacman_comp.Pacman(ctx)
-
-			# initialize build time keyring
-			pacman.init_keyring()
-
-			# trust pgp key in config (for pacman database, allow failed)
-			pacman_build.trust_all(ctx, pacman, True)
-
-			# update pacman repos databases
-			pacman.load_databases()
-
-			# install all keyring packages before other packages
-			pacman_build.proc_pacman_keyring(ctx, pacman)
-
-			# trust pgp key in config
-			pacman_build.trust_all(ctx, pacman)
-
-			# run hooks for pacman settings
-			run_hooks(ctx, "pre-pacman")
-
-			# real install all packages
-			pacman_build.proc_pacman(ctx, pacman)
+			stages.run("pre-build", [], run_hooks, ctx, "pre-build", extra=hook_inputs(ctx, "pre-build"))
+
+			# initialize, install or remove all packages
+			stages.run(
+				"pacman", ["arch", "pacman", "mirrors", "distro.id"],
+				build_packages, ctx,
+				extra={
+					"gpgcheck": ctx.gpgcheck,
+					"hooks": hook_inputs(ctx, "pre-pacman"),
+					"lock": hash_file(ctx.lock) if ctx.lock else None,
+				},
+				force=ctx.update,
+			)
 
 			# reload user databases after install packages
 			ctx.reload_passwd()
 
 			# run hooks for user settings
-			run_hooks(ctx, "pre-user")
+			stages.run(
+				"pre-user", [], run_hooks, ctx, "pre-user",
+				extra=hook_inputs(ctx, "pre-user"),
+				packages=package_inputs(ctx),
+			)
 
 			# create custom users and groups
-			user.proc_usergroup(ctx)
+			stages.run(
+				"usergroup", ["sysconf.user", "sysconf.group"],
+				user.proc_usergroup, ctx,
+				packages=package_inputs(ctx),
+			)
 
 			# build time files add/remove hooks
-			filesystem.proc_filesystem(ctx)
+			stages.run(
+				"filesystem", ["filesystem.remove"],
+				filesystem.proc_filesystem, ctx,
+				extra=hook_inputs(ctx),
+				packages=package_inputs(ctx),
+			)
 
 			# enable / disable systemd units
-			systemd.proc_systemd(ctx)
+			stages.run("systemd", ["systemd"], systemd.proc_systemd, ctx, packages=package_inputs(ctx))
 
 			# setup locale (timezone / i18n language / fonts / input methods)
-			locale.proc_locale(ctx)
+			stages.run(
+				"locale", ["locale", "timezone"],
+				locale.proc_locale, ctx,
+				packages=package_inputs(ctx, ["glibc", "glibc-locales", "tzdata"]),
+			)
 
 			# setup system names (environments / hosts / hostname / machine-info)
-			names.proc_names(ctx)
+			stages.run("names", ["sysconf"], names.proc_names, ctx, packages=package_inputs(ctx))
 
 			# run hooks for initramfs settings
-			run_hooks(ctx, "pre-initramfs")
+			stages.run(
+				"pre-initramfs", [], run_hooks, ctx, "pre-initramfs",
+				extra=hook_inputs(ctx, "pre-initramfs"),
+				packages=package_inputs(ctx),
+			)
 
 			# recreate initramfs
-			mkinitcpio.proc_mkinitcpio(ctx)
+			# only when kernel, modules, firmware or mkinitcpio changed
+			stages.run(
+				"mkinitcpio", ["mkinitcpio"],
+				mkinitcpio.proc_mkinitcpio, ctx,
+				packages=package_inputs(
+					ctx, ["mkinitcpio*"],
+					["usr/lib/modules/", "usr/lib/firmware/", "usr/lib/initcpio/"],
+				),
+			)
 
 			# reset machine-id (never duplicated machine id)
-			systemd.proc_machine_id(ctx)
+			stages.run("machine-id", ["machine-id"], systemd.proc_machine_id, ctx, packages=package_inputs(ctx))
 		finally:
 			# kill spawned daemons (gpg-agent, dirmngr, ...)
 			ctx.cgroup.kill_all()
@@ -153,7 +250,8 @@ def build_rootfs(ctx: ArchBuilderContext):
 			mount.undo_mounts(ctx)
 
 		# cleanup unneeded files
-		cleanup(ctx)
+		with ctx.profile.span("step", "cleanup"):
+			cleanup(ctx)
 
 	# run hooks after build rootfs
 	run_hooks(ctx, "post-build")
@@ -167,22 +265,26 @@ def build_rootfs(ctx: ArchBuilderContext):
 		run_hooks(ctx, "pre-image")
 
 		# create disk and filesystem image
-		image.proc_image(ctx)
+		with ctx.profile.span("step", "image"):
+			image.proc_image(ctx)
 
 		# generate fstab
-		fstab.proc_fstab(ctx)
+		with ctx.profile.span("step", "fstab"):
+			fstab.proc_fstab(ctx)
 
 		# run hooks for bootloader settings
 		run_hooks(ctx, "pre-boot")
 
 		# install bootloader
-		bootloader.proc_bootloader(ctx)
+		with ctx.profile.span("step", "bootloader"):
+			bootloader.proc_bootloader(ctx)
 
 		# run hooks for bootloader settings
 		run_hooks(ctx, "post-fs")
 
 		# post process images
-		image.proc_image_post(ctx)
+		with ctx.profile.span("step", "image-post"):
+			image.proc_image_post(ctx)
 
 		# run hooks after image rootfs
 		run_hooks(ctx, "post-image")
@@ -1,6 +1,10 @@
 import os
 from logging import getLogger
+from builder.build import mount
 from builder.component.pacman import Pacman
+from builder.component.snapshot import RootfsSnapshots
+from builder.lib import json
+from builder.lib.config import ArchBuilderConfigError
 from builder.lib.context import ArchBuilderContext
 from builder.lib.utils import open_config
 log = getLogger(__name__)
@@ -51,6 +55,124 @@ def replace_all(ctx: ArchBuilderContext, pacman: Pacman):
 		log.info(f"replacing {pkg['old']} with {pkg['new']}")
 		pacman.replace([pkg["old"]], [pkg["new"]])
 
+def plan_transaction(ctx: ArchBuilderContext, pacman: Pacman) -> dict[str, list[str]]:
+	"""
+	Merge install, uninstall and replaces into final transactions
+	"""
+	install: list[str] = ctx.get("pacman.install", [])
+	uninstall: list[str] = ctx.get("pacman.uninstall", [])
+	replaces: list[dict] = ctx.get("pacman.replaces", [])
+	olds = [pkg["old"] for pkg in replaces]
+	news = [pkg["new"] for pkg in replaces]
+	installed = pacman.installed_packages()
+
+	# replaced and uninstalled packages never enter the install transaction,
+	# dependencies on replaced packages are satisfied by new packages
+	targets: list[str] = []
+	for pkg in install + news:
+		name = pkg.split("/")[-1]
+		if pkg in news or (name not in uninstall and name not in olds):
+			if pkg not in targets: targets.append(pkg)
+	return {
+		"remove_first": [old for old in olds if old in installed],
+		"install": targets,
+		"remove": uninstall,
+		"remove_replaced": [old for old in olds if old not in news],
+	}
+
+
+def apply_transaction(ctx: ArchBuilderContext, pacman: Pacman):
+	"""
+	Apply all package changes in as few pacman transactions as possible,
+	normally only one, so ALPM hooks run once
+	"""
+	plan = plan_transaction(ctx, pacman)
+	log.debug(f"pacman transaction plan: {plan}")
+	if plan["remove_first"]:
+		pacman.uninstall(plan["remove_first"], opts=["--nodeps", "--nodeps"])
+	if ctx.fast_bootstrap and pacman.fast_install(plan["install"]):
+		log.info("packages installed by fast bootstrap")
+	elif pacman.locked is not None:
+		pacman.install_locked(list(pacman.locked.values()), plan["install"])
+	else:
+		pacman.install(plan["install"])
+
+	# only remove packages pulled in by dependencies
+	installed = pacman.installed_packages()
+	leftover = [old for old in plan["remove_replaced"] if old in installed]
+	if leftover:
+		pacman.uninstall(leftover, opts=["--nodeps", "--nodeps"])
+	remove = [pkg for pkg in plan["remove"] if pkg in installed]
+	if remove:
+		pacman.uninstall(remove)
+
+
+def update_transaction(ctx: ArchBuilderContext, pacman: Pacman):
+	"""
+	Upgrade existing rootfs in place, only apply changed packages
+	and remove packages not configured anymore
+	"""
+	plan = plan_transaction(ctx, pacman)
+	local_pkgs = [pkg for pkg in plan["install"] if ".pkg.tar." in pkg]
+	targets = [pkg for pkg in plan["install"] if ".pkg.tar." not in pkg]
+	if plan["remove_first"]:
+		pacman.uninstall(plan["remove_first"], opts=["--nodeps", "--nodeps"])
+	changed, stale = pacman.update(targets)
+	if local_pkgs:
+		pacman.install_local(local_pkgs)
+
+	# keep packages from local files, name-version-release-arch.pkg.tar.*
+	keep = set(os.path.basename(pkg).rsplit("-", 3)[0] for pkg in local_pkgs)
+	installed = pacman.installed_packages()
+	remove = set(plan["remove"] + plan["remove_replaced"]) - keep
+	remove = sorted(pkg for pkg in remove if pkg in installed)
+	if remove:
+		pacman.uninstall(remove)
+
+	# stale packages still required by others (e.g. other provider chosen
+	# by pacman) are kept instead of failing whole removal
+	unneeded = sorted(pkg for pkg in set(stale) - keep - set(remove) if pkg in installed)
+	if unneeded:
+		pacman.uninstall(unneeded, opts=["--unneeded"])
+	removed = len(installed - pacman.installed_packages())
+	log.info(f"updated rootfs with {len(changed)} changed and {removed} removed packages")
+
+
+def write_lock(ctx: ArchBuilderContext, pacman: Pacman):
+	"""
+	Write resolved packages with exact versions and files into lock file
+	"""
+	path = ctx.write_lock or os.path.join(ctx.work, "pacman-lock.json")
+	plan = plan_transaction(ctx, pacman)
+	packages = pacman.resolve_closure(plan["install"])
+	data = {
+		"version": 1,
+		"arch": ctx.tgt_arch,
+		"packages": pacman.lock_entries(packages, pacman.target_names(plan["install"])),
+	}
+	tmp = f"{path}.tmp"
+	with open(tmp, "w") as f:
+		json.dump(data, f, indent=2)
+	os.replace(tmp, path)
+	log.info(f"wrote {len(packages)} packages into lock file {path}")
+
+
+def load_lock(ctx: ArchBuilderContext, pacman: Pacman):
+	"""
+	Load lock file, install exactly locked packages without databases
+	"""
+	with open(ctx.lock, "r") as f:
+		data = json.load(f)
+	if data.get("version") != 1:
+		raise ArchBuilderConfigError(f"unsupported lock file {ctx.lock}")
+	if data.get("arch") != ctx.tgt_arch:
+		raise ArchBuilderConfigError(
+			f"lock file arch {data.get('arch')} mismatch with {ctx.tgt_arch}"
+		)
+	pacman.locked = {entry["name"]: entry for entry in data["packages"]}
+	log.info(f"loaded {len(pacman.locked)} packages from lock file {ctx.lock}")
+
+
 def append_config(ctx: ArchBuilderContext, lines: list[str]):
 	"""
 	Generate basic pacman.conf for rootfs
@@ -89,13 +211,57 @@ def gen_mirrorlist(ctx: ArchBuilderContext, pacman: Pacman):
 	log.info(f"generated pacman mirrorlist {conf}")
 
 
-def proc_pacman(ctx: ArchBuilderContext, pacman: Pacman):
+def snapshot_key(ctx: ArchBuilderContext, pacman: Pacman) -> str | None:
+	"""
+	Key of rootfs snapshot after packages installed, None when disabled
+	"""
+	return RootfsSnapshots(ctx).make_key(pacman)
+
+
+def has_snapshot(ctx: ArchBuilderContext, key: str | None) -> bool:
+	"""
+	Is a rootfs snapshot with all packages ready
+	"""
+	return RootfsSnapshots(ctx).exists(key)
+
+
+def install_packages(ctx: ArchBuilderContext, pacman: Pacman, key: str = None):
+	"""
+	Restore packages from rootfs snapshot, or apply transaction and save snapshot
+	Snapshot key is calculated here when not given
+	"""
+	snapshots = RootfsSnapshots(ctx)
+	if key is None: key = snapshots.make_key(pacman)
+	restored = False
+	if key:
+		# snapshot cannot clone into a mounted rootfs
+		mount.undo_mounts(ctx)
+		try: restored = snapshots.restore(key)
+		finally: mount.init_mount(ctx)
+	if restored: return
+	try:
+		apply_transaction(ctx, pacman)
+	except OSError:
+		# locked packages cannot be resolved again without databases
+		if pacman.locked is not None: raise
+
+		# e.g. new package conflicts with a dependency of others
+		log.warning("merged pacman transaction failed, fallback to separate transactions", exc_info=True)
+		install_all(ctx, pacman)
+		uninstall_all(ctx, pacman)
+		replace_all(ctx, pacman)
+	snapshots.save(key)
+
+
+def proc_pacman(ctx: ArchBuilderContext, pacman: Pacman, snapshot: str = None):
 	"""
 	Install or remove packages for rootfs, and generate pacman.conf
 	"""
-	install_all(ctx, pacman)
-	uninstall_all(ctx, pacman)
-	replace_all(ctx, pacman)
+	if ctx.update and pacman.installed_packages():
+		# snapshots always replace whole rootfs, upgrade in place
+		update_transaction(ctx, pacman)
+	else:
+		install_packages(ctx, pacman, snapshot)
 	gen_config(ctx, pacman)
 	if ctx.get("pacman.gen_mirrorlist", True):
 		gen_mirrorlist(ctx, pacman)
@@ -115,14 +281,11 @@ def trust_all(ctx: ArchBuilderContext, pacman: Pacman, fail: bool=False):
 	if not ctx.gpgcheck: return
 	trust = ctx.get("pacman.trust", [])
 
-	# receive all keys now
-	try: pacman.pacman_key.recv_keys(trust)
-	except: log.warning("recv-keys partial failed")
-
-	# local sign keys
-	for key in trust:
-		try:
-			pacman.pacman_key.lsign_key(key)
-		except:
-			if not fail: raise
-			log.warning(f"lsign-key {key} failed")
+	with pacman.pacman_key.session():
+		# receive all keys now
+		try: pacman.pacman_key.recv_keys(trust, update=False)
+		except: log.warning("recv-keys partial failed")
+
+		# local sign keys
+		pacman.pacman_key.lsign_keys(trust, fail=fail, update=False)
+		pacman.pacman_key.update_db()
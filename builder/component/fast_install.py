@@ -0,0 +1,425 @@
+import os
+import re
+import gzip
+import time
+import shlex
+import fnmatch
+import libarchive
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from builder.lib.context import ArchBuilderContext
+from builder.lib.utils import hash_file
+log = getLogger(__name__)
+
+
+# package metadata files stored before all files in archive
+metadata_files = [".PKGINFO", ".BUILDINFO", ".MTREE", ".INSTALL", ".CHANGELOG"]
+
+# local database desc fields from .PKGINFO keys
+desc_fields = [
+	("NAME", "pkgname"),
+	("VERSION", "pkgver"),
+	("BASE", "pkgbase"),
+	("DESC", "pkgdesc"),
+	("URL", "url"),
+	("ARCH", "arch"),
+	("BUILDDATE", "builddate"),
+	("INSTALLDATE", None),
+	("PACKAGER", "packager"),
+	("SIZE", "size"),
+	("REASON", None),
+	("GROUPS", "group"),
+	("LICENSE", "license"),
+	("VALIDATION", None),
+	("REPLACES", "replaces"),
+	("DEPENDS", "depend"),
+	("OPTDEPENDS", "optdepend"),
+	("CONFLICTS", "conflict"),
+	("PROVIDES", "provides"),
+	("XDATA", "xdata"),
+]
+
+
+def parse_pkginfo(data: bytes) -> dict[str, list[str]]:
+	"""
+	Parse .PKGINFO into multi values dict
+	"""
+	info: dict[str, list[str]] = {}
+	for line in data.decode().splitlines():
+		line = line.strip()
+		if len(line) <= 0 or line.startswith("#"): continue
+		key, _, value = line.partition("=")
+		info.setdefault(key.strip(), []).append(value.strip())
+	return info
+
+
+def mtree_unescape(name: str) -> str:
+	"""
+	Decode octal escapes in mtree path
+	mtree_unescape("usr/share/a\\040b") = "usr/share/a b"
+	"""
+	raw = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), name)
+	try: return raw.encode("latin-1").decode()
+	except UnicodeError: return raw
+
+
+def mtree_files(data: bytes) -> list[str]:
+	"""
+	Get files list for local database from .MTREE, folders end with slash
+	"""
+	files: list[str] = []
+	defaults: dict[str, str] = {}
+	for line in gzip.decompress(data).decode().splitlines():
+		if len(line) <= 0 or line.startswith("#"): continue
+		words = line.split()
+		keys = dict(word.partition("=")[::2] for word in words[1:])
+		if words[0] == "/set":
+			defaults.update(keys)
+			continue
+		if words[0] == "/unset" or not words[0].startswith("./"): continue
+		name = mtree_unescape(words[0][2:])
+		if name in metadata_files or len(name) <= 0: continue
+		if keys.get("type", defaults.get("type")) == "dir": name += "/"
+		files.append(name)
+	files.sort()
+	return files
+
+
+def has_function(script: str, name: str) -> bool:
+	"""
+	Is a function defined in install scriptlet
+	"""
+	return re.search(rf"^\s*(function\s+)?{name}\s*\(", script, re.M) is not None
+
+
+def match_patterns(patterns: list[str], name: str) -> bool:
+	"""
+	Match name with ALPM hook targets, last matched pattern wins
+	"""
+	for pattern in reversed(patterns):
+		negative = pattern.startswith("!")
+		if negative: pattern = pattern[1:]
+		if fnmatch.fnmatchcase(name, pattern):
+			return not negative
+	return False
+
+
+def parse_hook(path: str) -> tuple[list[dict], dict]:
+	"""
+	Parse an ALPM hook file into triggers and action
+	"""
+	multiple = ("Operation", "Target", "Depends")
+	triggers: list[dict] = []
+	action: dict = {}
+	section: dict = None
+	with open(path, "r") as f:
+		for line in f:
+			line = line.strip()
+			if len(line) <= 0 or line.startswith("#"): continue
+			if line == "[Trigger]":
+				section = {}
+				triggers.append(section)
+				continue
+			if line == "[Action]":
+				section = action
+				continue
+			if section is None: continue
+			key, _, value = line.partition("=")
+			key, value = key.strip(), value.strip()
+			if key in multiple:
+				section.setdefault(key, []).append(value)
+			else:
+				section[key] = value
+	return triggers, action
+
+
+class FastInstaller:
+	"""
+	Install packages into an empty rootfs without pacman transaction
+
+	Packages conflicting with others or with files in rootfs are refused
+	before any change. Archives are extracted by bsdtar in dependency waves, filesystem
+	with its dependencies first one by one (it creates lib, bin and sbin
+	symlinks which other packages write through), then every package in
+	parallel after all its dependencies. Local database is written from
+	package metadata, then install scriptlets run in dependency order and
+	ALPM post transaction hooks run only once.
+	"""
+	ctx: ArchBuilderContext
+	root: str
+	validation: str
+	providers: dict[str, str]
+
+	def __init__(self, ctx: ArchBuilderContext, root: str, validation: str = "none"):
+		self.ctx = ctx
+		self.root = root
+		self.validation = validation
+		self.providers = {}
+
+	def read_metadata(self, path: str) -> dict[str, bytes]:
+		"""
+		Read metadata files from the head of package archive
+		"""
+		meta: dict[str, bytes] = {}
+		with libarchive.file_reader(path) as archive:
+			for entry in archive:
+				if not entry.pathname.startswith("."): break
+				if entry.pathname not in metadata_files: continue
+				meta[entry.pathname] = b"".join(entry.get_blocks())
+		if ".PKGINFO" not in meta:
+			raise RuntimeError(f"package {path} has no .PKGINFO")
+		return meta
+
+	def extract(self, path: str):
+		"""
+		Extract one package archive into rootfs, run in worker thread
+		"""
+		args = ["bsdtar", "-xpf", path, "-C", self.root, "--numeric-owner"]
+		for name in metadata_files:
+			args.extend(["--exclude", name])
+		ret = self.ctx.run_external(args)
+		if ret != 0: raise OSError(f"extract package {path} failed with {ret}")
+
+	def write_entry(
+		self,
+		meta: dict[str, bytes],
+		info: dict[str, list[str]],
+		installed: list[str],
+		explicit: bool,
+	):
+		"""
+		Write package entry with its files list into local database
+		"""
+		name, version = info["pkgname"][0], info["pkgver"][0]
+		folder = os.path.join(self.root, "var/lib/pacman/local", f"{name}-{version}")
+		os.makedirs(folder, mode=0o0755, exist_ok=True)
+		special = {
+			"INSTALLDATE": [str(int(time.time()))],
+			"REASON": [] if explicit else ["1"],
+			"VALIDATION": [self.validation],
+		}
+
+		desc: list[str] = []
+		for field, key in desc_fields:
+			values = special[field] if key is None else info.get(key, [])
+			values = [value for value in values if value]
+			if len(values) <= 0: continue
+			desc.append(f"%{field}%\n")
+			desc.extend(f"{value}\n" for value in values)
+			desc.append("\n")
+		with open(os.path.join(folder, "desc"), "w") as f:
+			f.writelines(desc)
+
+		files = ["%FILES%\n"]
+		files.extend(f"{file}\n" for file in installed)
+		files.append("\n")
+		backups = info.get("backup", [])
+		if backups:
+			files.append("%BACKUP%\n")
+			for backup in backups:
+				path = os.path.join(self.root, backup)
+				if not os.path.isfile(path): continue
+				files.append(f"{backup}\t{hash_file(path, 'md5')}\n")
+			files.append("\n")
+		with open(os.path.join(folder, "files"), "w") as f:
+			f.writelines(files)
+
+		for file, target in ((".MTREE", "mtree"), (".INSTALL", "install"), (".CHANGELOG", "changelog")):
+			if file not in meta: continue
+			with open(os.path.join(folder, target), "wb") as f:
+				f.write(meta[file])
+
+	def index_providers(self, infos: dict[str, dict]):
+		"""
+		Map package names and provides to packages in transaction
+		"""
+		self.providers = {}
+		for name, info in infos.items():
+			self.providers[name] = name
+			for provide in info.get("provides", []):
+				self.providers.setdefault(re.split(r"[<>=]", provide)[0], name)
+
+	def depends_of(self, infos: dict[str, dict], name: str) -> list[str]:
+		"""
+		Names of packages in transaction which satisfy depends of a package
+		"""
+		depends: list[str] = []
+		for depend in infos[name].get("depend", []):
+			provider = self.providers.get(re.split(r"[<>=]", depend)[0])
+			if provider: depends.append(provider)
+		return depends
+
+	def find_conflict(self, infos: dict[str, dict], files: dict[str, list[str]]) -> str | None:
+		"""
+		Find conflicts which pacman checks in transaction, packages conflicting
+		with others by name or provides (versions ignored, always pacman then),
+		files in more than one package or already in rootfs (installed or not)
+		Return description of first conflict found
+		"""
+		provided: dict[str, set[str]] = {}
+		for name, info in infos.items():
+			for provide in [name, *info.get("provides", [])]:
+				provided.setdefault(re.split(r"[<>=]", provide)[0], set()).add(name)
+		for name, info in infos.items():
+			for conflict in info.get("conflict", []):
+				others = provided.get(re.split(r"[<>=]", conflict)[0], set()) - {name}
+				if others: return f"{name} conflicts with {' '.join(sorted(others))}"
+		owners: dict[str, str] = {}
+		for name, paths in files.items():
+			for path in paths:
+				if path.endswith("/"): continue
+				if path in owners:
+					return f"{path} exists in both {owners[path]} and {name}"
+				owners[path] = name
+				if os.path.lexists(os.path.join(self.root, path)):
+					return f"{path} of {name} exists in filesystem"
+		return None
+
+	def sort_packages(self, infos: dict[str, dict]) -> list[str]:
+		"""
+		Sort packages names by dependencies, dependencies first
+		"""
+		order: list[str] = []
+		visited: set[str] = set()
+
+		def visit(name: str):
+			if name in visited: return
+			visited.add(name)
+			for depend in self.depends_of(infos, name):
+				visit(depend)
+			order.append(name)
+
+		for name in infos: visit(name)
+		return order
+
+	def extract_waves(self, order: list[str], infos: dict[str, dict]) -> list[list[str]]:
+		"""
+		Group sorted packages into waves, packages in one wave extract in parallel
+		"""
+		chain: set[str] = set()
+		stack = ["filesystem"] if "filesystem" in infos else []
+		while stack:
+			name = stack.pop()
+			if name in chain: continue
+			chain.add(name)
+			stack.extend(self.depends_of(infos, name))
+		waves: list[list[str]] = [[name] for name in order if name in chain]
+
+		# dependencies in a cycle are broken by sorted order
+		levels: dict[str, int] = {}
+		for name in order:
+			if name in chain: continue
+			deps = [levels[dep] for dep in self.depends_of(infos, name) if dep in levels]
+			levels[name] = max(deps, default=-1) + 1
+		rest: list[list[str]] = [[] for _ in range(max(levels.values(), default=-1) + 1)]
+		for name in order:
+			if name in levels: rest[levels[name]].append(name)
+		return waves + rest
+
+	def run_scriptlets(self, order: list[str], metas: dict[str, dict], infos: dict[str, dict]):
+		"""
+		Run install scriptlets in chroot, all files are already extracted
+		so pre_install runs just before post_install of the same package
+		"""
+		tmp = os.path.join(self.root, "tmp")
+		os.makedirs(tmp, mode=0o1777, exist_ok=True)
+		for name in order:
+			if ".INSTALL" not in metas[name]: continue
+			script = metas[name][".INSTALL"].decode()
+			version = infos[name]["pkgver"][0]
+			path = os.path.join(tmp, f"alpm-{name}.install")
+			with open(path, "w") as f:
+				f.write(script)
+			try:
+				for func in ("pre_install", "post_install"):
+					if not has_function(script, func): continue
+					log.debug(f"running {func} scriptlet of {name}")
+					cmd = f". /tmp/alpm-{name}.install; {func} {shlex.quote(version)}"
+					ret = self.ctx.run_external(["chroot", self.root, "/bin/sh", "-c", cmd])
+					if ret != 0: log.warning(f"{func} scriptlet of {name} failed with {ret}")
+			finally:
+				os.remove(path)
+
+	def load_hooks(self) -> dict[str, str]:
+		"""
+		Find ALPM hooks in rootfs, hooks in /etc override same name hooks
+		"""
+		hooks: dict[str, str] = {}
+		for folder in ("usr/share/libalpm/hooks", "etc/pacman.d/hooks"):
+			path = os.path.join(self.root, folder)
+			if not os.path.isdir(path): continue
+			for entry in os.scandir(path):
+				if not entry.name.endswith(".hook"): continue
+				if entry.is_symlink() and os.readlink(entry.path) == "/dev/null":
+					hooks.pop(entry.name, None)
+					continue
+				hooks[entry.name] = entry.path
+		return hooks
+
+	def run_hooks(self, packages: list[str], files: list[str]):
+		"""
+		Run all matched ALPM post transaction hooks once
+		"""
+		for hook, path in sorted(self.load_hooks().items()):
+			triggers, action = parse_hook(path)
+			if action.get("When") != "PostTransaction" or "Exec" not in action: continue
+			targets: set[str] = set()
+			for trigger in triggers:
+				if "Install" not in trigger.get("Operation", []): continue
+				patterns = trigger.get("Target", [])
+				names = packages if trigger.get("Type") == "Package" else files
+				targets.update(name for name in names if match_patterns(patterns, name))
+			if len(targets) <= 0: continue
+			log.info(f"running hook {hook}: {action.get('Description', action['Exec'])}")
+			stdin = None
+			if "NeedsTargets" in action:
+				stdin = "".join(f"{target}\n" for target in sorted(targets))
+			args = ["chroot", self.root]
+			args.extend(shlex.split(action["Exec"]))
+			ret = self.ctx.run_external(args, stdin=stdin)
+			if ret != 0: log.warning(f"hook {hook} failed with {ret}")
+
+	def install(self, files: list[str], explicit: set[str]) -> bool:
+		"""
+		Install package files, explicit is names of explicitly installed packages
+		Return False without any change when pacman would find conflicts
+		"""
+		metas: dict[str, dict] = {}
+		infos: dict[str, dict] = {}
+		paths: dict[str, str] = {}
+		owned: dict[str, list[str]] = {}
+		with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+			for path, meta in zip(files, pool.map(self.read_metadata, files)):
+				info = parse_pkginfo(meta[".PKGINFO"])
+				name = info["pkgname"][0]
+				if name in infos:
+					log.warning(f"package {name} found twice, fallback to pacman")
+					return False
+				metas[name], infos[name], paths[name] = meta, info, path
+				owned[name] = mtree_files(meta[".MTREE"]) if ".MTREE" in meta else []
+			conflict = self.find_conflict(infos, owned)
+			if conflict:
+				log.warning(f"{conflict}, fallback to pacman")
+				return False
+			log.info(f"fast extracting {len(files)} packages into {self.root}")
+			local = os.path.join(self.root, "var/lib/pacman/local")
+			os.makedirs(local, mode=0o0755, exist_ok=True)
+			self.index_providers(infos)
+			order = self.sort_packages(infos)
+			waves = self.extract_waves(order, infos)
+			log.debug(f"extracting packages in {len(waves)} waves")
+			with self.ctx.profile.span("pacman", "fast-extract", packages=len(files), waves=len(waves)):
+				for wave in waves:
+					list(pool.map(self.extract, [paths[name] for name in wave]))
+		installed: list[str] = []
+		for name in order:
+			self.write_entry(metas[name], infos[name], owned[name], name in explicit)
+			installed.extend(owned[name])
+		with open(os.path.join(local, "ALPM_DB_VERSION"), "w") as f:
+			f.write("9\n")
+		with self.ctx.profile.span("pacman", "scriptlets"):
+			self.run_scriptlets(order, metas, infos)
+		with self.ctx.profile.span("pacman", "hooks"):
+			self.run_hooks(order, installed)
+		log.info(f"fast installed {len(order)} packages")
+		return True
@@ -0,0 +1,117 @@
+import os
+import shutil
+import hashlib
+from logging import getLogger
+from builder.lib import json
+from builder.lib.utils import file_lock
+from builder.lib.context import ArchBuilderContext
+from builder.component.pacman import Pacman
+log = getLogger(__name__)
+
+
+def ignore_runtime(folder: str, names: list[str]) -> list[str]:
+	"""
+	Skip gpg-agent sockets and gpg lock files
+	"""
+	return [
+		name for name in names
+		if name.startswith(("S.", ".#lk")) or name.endswith(".lock")
+	]
+
+
+class KeyringCache:
+	"""
+	Cache of initialized build time pacman keyring
+
+	Keyed by keyring packages versions, trusted keys and repo keys,
+	clean builds copy a ready keyring instead of generating master
+	key and importing all keyrings again.
+	"""
+	ctx: ArchBuilderContext
+	store: str = None
+	keep: int = 8
+
+	@property
+	def enabled(self) -> bool:
+		return self.store is not None and self.ctx.gpgcheck
+
+	def __init__(self, ctx: ArchBuilderContext):
+		self.ctx = ctx
+		if ctx.keyring_cache:
+			self.store = os.path.realpath(ctx.keyring_cache)
+			os.makedirs(self.store, mode=0o0755, exist_ok=True)
+
+	def path_of(self, key: str) -> str:
+		return os.path.join(self.store, key)
+
+	def lock(self):
+		return file_lock(os.path.join(self.store, ".lock"))
+
+	def make_key(self, pacman: Pacman) -> str | None:
+		"""
+		Calculate keyring key from keyring packages and trusted keys
+		"""
+		if not self.enabled: return None
+		packages: list[str] = []
+		for name in self.ctx.get("pacman.install", []):
+			if not name.endswith("-keyring"): continue
+			if pacman.locked is not None:
+				entry = pacman.locked_entry(name)
+				packages.append(f"{entry['filename']}={entry['sha256']}")
+				continue
+			for pkg in pacman.lookup_package(name):
+				packages.append(f"{pkg.db.name}/{pkg.name}={pkg.version}")
+		repos = [
+			{"name": repo.name, "publickey": repo.publickey, "keyid": repo.keyid}
+			for repo in pacman.repos
+		]
+		data = json.dumps({
+			"packages": sorted(packages),
+			"trust": self.ctx.get("pacman.trust", []),
+			"repos": repos,
+		}, sort_keys=True)
+		return hashlib.sha256(data.encode()).hexdigest()
+
+	def restore(self, key: str, gpgdir: str) -> bool:
+		"""
+		Copy cached keyring into rootfs
+		"""
+		if not self.enabled or key is None: return False
+		path = self.path_of(key)
+		with self.lock():
+			if not os.path.isdir(path):
+				log.info(f"pacman keyring cache {key} not found")
+				return False
+			log.info(f"restoring pacman keyring from cache {key}")
+			if os.path.exists(gpgdir): shutil.rmtree(gpgdir)
+			shutil.copytree(path, gpgdir, symlinks=True)
+			os.utime(path)
+		return True
+
+	def save(self, key: str, gpgdir: str):
+		"""
+		Store initialized keyring into cache
+		"""
+		if not self.enabled or key is None: return
+		path = self.path_of(key)
+		tmp = f"{path}.tmp"
+		log.info(f"saving pacman keyring cache {key}")
+		if os.path.exists(tmp): shutil.rmtree(tmp)
+		shutil.copytree(gpgdir, tmp, symlinks=True, ignore=ignore_runtime)
+		with self.lock():
+			if os.path.exists(path): shutil.rmtree(path)
+			os.rename(tmp, path)
+			self.evict()
+
+	def evict(self):
+		"""
+		Keep only recently used keyrings
+		"""
+		keys = [
+			entry for entry in os.scandir(self.store)
+			if entry.is_dir() and not entry.name.endswith(".tmp")
+		]
+		keys.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+		for entry in keys[self.keep:]:
+			log.debug(f"evicting pacman keyring cache {entry.name}")
+			shutil.rmtree(entry.path)
@@ -0,0 +1,159 @@
+import os
+import time
+from logging import getLogger
+from builder.lib import json
+from builder.lib.utils import hash_file, file_lock, link_file
+from builder.lib.context import ArchBuilderContext
+log = getLogger(__name__)
+
+
+class PackageCache:
+	"""
+	Content-addressed packages cache shared by all workspaces
+
+	Package files are stored once by sha256 checksum and linked into
+	workspace cache folders by hard link or reflink, index.json maps
+	package filenames to checksums with last used time for eviction.
+	Only packages verified by a transaction and matched the database
+	checksum are added, cached files are checked again before used.
+	"""
+	ctx: ArchBuilderContext
+	store: str = None
+	limit: int = 0
+
+	@property
+	def enabled(self) -> bool:
+		return self.store is not None
+
+	def __init__(self, ctx: ArchBuilderContext):
+		self.ctx = ctx
+		if ctx.package_cache:
+			self.store = os.path.realpath(ctx.package_cache)
+			self.limit = ctx.package_cache_limit
+			os.makedirs(os.path.join(self.store, "objects"), mode=0o0755, exist_ok=True)
+
+	def object_path(self, sha256: str) -> str:
+		return os.path.join(self.store, "objects", sha256[:2], sha256)
+
+	def load_index(self) -> dict[str, dict]:
+		path = os.path.join(self.store, "index.json")
+		if not os.path.exists(path): return {}
+		try:
+			with open(path, "r") as f:
+				return json.load(f)
+		except:
+			log.warning(f"failed to load packages cache index {path}", exc_info=True)
+			return {}
+
+	def save_index(self, index: dict[str, dict]):
+		path = os.path.join(self.store, "index.json")
+		tmp = f"{path}.tmp"
+		with open(tmp, "w") as f:
+			json.dump(index, f)
+		os.replace(tmp, path)
+
+	def lock(self):
+		return file_lock(os.path.join(self.store, ".lock"))
+
+	def drop(self, index: dict[str, dict], filename: str):
+		"""
+		Remove a bad package with signature from index,
+		and their objects when not referenced
+		"""
+		for file in (filename, f"{filename}.sig"):
+			if file not in index: continue
+			sha256 = index.pop(file)["sha256"]
+			if any(item["sha256"] == sha256 for item in index.values()): continue
+			path = self.object_path(sha256)
+			if os.path.exists(path): os.remove(path)
+
+	def populate(self, sums: dict[str, str], dest: str) -> int:
+		"""
+		Link cached packages (filename to expected sha256) and signatures
+		into workspace cache folder, cached files mismatch checksum are evicted
+		Return count of populated files
+		"""
+		if not self.enabled or len(sums) <= 0: return 0
+		methods: dict[str, int] = {}
+		now = time.time()
+		with self.lock():
+			index = self.load_index()
+			for filename, sha256 in sums.items():
+				target = os.path.join(dest, filename)
+				if filename not in index or os.path.exists(target): continue
+				path = self.object_path(index[filename]["sha256"])
+				if not sha256 or not os.path.exists(path) or hash_file(path) != sha256:
+					log.warning(f"evicting {filename} mismatch checksum from packages cache")
+					self.drop(index, filename)
+					continue
+				for file in (filename, f"{filename}.sig"):
+					if file not in index: continue
+					method = link_file(self.object_path(index[file]["sha256"]), os.path.join(dest, file))
+					methods[method] = methods.get(method, 0) + 1
+					index[file]["used"] = now
+			self.save_index(index)
+		count = sum(methods.values())
+		if count > 0:
+			info = " ".join(f"{k}={v}" for k, v in methods.items())
+			log.info(f"populated {count} files from packages cache ({info})")
+		return count
+
+	def save(self, files: dict[str, str]):
+		"""
+		Add verified package files (path to expected sha256) with signatures
+		into cache, files mismatch checksum are never added
+		"""
+		if not self.enabled or len(files) <= 0: return
+		now = time.time()
+		added = 0
+		with self.lock():
+			index = self.load_index()
+			for path, sha256 in files.items():
+				filename = os.path.basename(path)
+				if filename in index and index[filename]["sha256"] == sha256:
+					index[filename]["used"] = now
+					continue
+				if not sha256 or hash_file(path) != sha256:
+					log.warning(f"skip caching {filename} mismatch checksum")
+					continue
+				if filename in index: self.drop(index, filename)
+				paths = [path]
+				if os.path.exists(f"{path}.sig"): paths.append(f"{path}.sig")
+				for file in paths:
+					digest = sha256 if file == path else hash_file(file)
+					obj = self.object_path(digest)
+					if not os.path.exists(obj):
+						os.makedirs(os.path.dirname(obj), mode=0o0755, exist_ok=True)
+						tmp = f"{obj}.tmp"
+						link_file(file, tmp)
+						os.replace(tmp, obj)
+					index[os.path.basename(file)] = {
+						"sha256": digest,
+						"size": os.path.getsize(obj),
+						"used": now,
+					}
+				added += 1
+			self.evict(index)
+			self.save_index(index)
+		if added > 0: log.info(f"added {added} packages into packages cache")
+
+	def evict(self, index: dict[str, dict]):
+		"""
+		Remove least recently used files until under size limit
+		"""
+		if self.limit <= 0: return
+		sizes: dict[str, int] = {}
+		refs: dict[str, int] = {}
+		for item in index.values():
+			sizes[item["sha256"]] = item["size"]
+			refs[item["sha256"]] = refs.get(item["sha256"], 0) + 1
+		total = sum(sizes.values())
+		for filename in sorted(index.keys(), key=lambda k: index[k]["used"]):
+			if total <= self.limit: break
+			sha256 = index.pop(filename)["sha256"]
+			refs[sha256] -= 1
+			if refs[sha256] > 0: continue
+			log.debug(f"evicting {filename} from packages cache")
+			path = self.object_path(sha256)
+			if os.path.exists(path): os.remove(path)
+			total -= sizes[sha256]
@@ -2,13 +2,23 @@ import os
 import pyalpm
 import logging
 import shutil
+import threading
 import libarchive
 from logging import getLogger
 from builder.lib.serializable import SerializableDict
 from builder.lib.context import ArchBuilderContext
 from builder.lib.config import ArchBuilderConfigError
 from builder.lib.subscript import resolve_simple_values
+from builder.lib import json
+from builder.lib.utils import str_find_all, hash_file, link_file, have_external
+from builder.lib.download import Downloader, DownloadItem, DownloadError
+from builder.lib.proxy import MirrorProxy
+from builder.lib.probe import MirrorProbe, url_host
+from builder.lib.checkpoint import installed_versions, diff_versions
 from builder.component.pacman_key import PacmanKey
+from builder.component.package_cache import PackageCache
+from builder.component.verifier import PackageVerifier
+from builder.component.fast_install import FastInstaller
 log = getLogger(__name__)
 
 
@@ -39,6 +49,7 @@ class PacmanRepoServer(SerializableDict):
 	config_url: str = None
 	name: str = None
 	mirror: bool = False
+	local: bool = False
 
 	def __init__(
 		self,
@@ -46,13 +57,15 @@ class PacmanRepoServer(SerializableDict):
 		name: str = None,
 		url: str = None,
 		config_url: str = None,
-		mirror: bool = None
+		mirror: bool = None,
+		local: bool = None,
 	):
 		self.ctx = ctx
 		if url is not None: self.url = url
 		if config_url is not None: self.config_url = config_url
 		if name is not None: self.name = name
 		if mirror is not None: self.mirror = mirror
+		if local is not None: self.local = local
 
 	def append_server(self, lines: list[str]):
 		if self.mirror:
@@ -107,11 +120,67 @@ class PacmanRepo(SerializableDict):
 			mirror=mirror,
 		))
 
-	def append_repo(self, lines: list[str]):
+	def append_repo(self, lines: list[str], rootfs: bool = False):
 		for server in self.servers:
+			# builder local servers not available in target
+			if rootfs and server.local: continue
 			server.append_server(lines)
 
 
+def depend_name(depend: str) -> str:
+	"""
+	Strip version constraint from a depend string
+	depend_name("glibc>=2.38") = "glibc"
+	depend_name("sh") = "sh"
+	"""
+	p = str_find_all(depend, ["<", ">", "="])
+	return depend if p < 0 else depend[:p]
+
+
+class PackageClosure:
+	"""
+	Packages chosen for a transaction, indexed by names and provides,
+	conflicts and replaces, to resolve dependencies like pacman
+	"""
+	def __init__(self):
+		self.fulls: dict[str, str] = {}
+		self.provides: dict[str, list[pyalpm.Package]] = {}
+		self.conflicts: dict[str, list[tuple[pyalpm.Package, str]]] = {}
+		self.replaces: dict[str, list[tuple[pyalpm.Package, str]]] = {}
+
+	def add(self, pkg: pyalpm.Package, full: str):
+		self.fulls[pkg.name] = full
+		for prov in [pkg.name, *pkg.provides]:
+			self.provides.setdefault(depend_name(prov), []).append(pkg)
+		for dep in pkg.conflicts:
+			self.conflicts.setdefault(depend_name(dep), []).append((pkg, dep))
+		for dep in pkg.replaces:
+			self.replaces.setdefault(depend_name(dep), []).append((pkg, dep))
+
+	def satisfier(self, depend: str) -> pyalpm.Package | None:
+		"""
+		Chosen package satisfies depend by name or provides
+		"""
+		return pyalpm.find_satisfier(self.provides.get(depend_name(depend), []), depend)
+
+	def conflict(self, pkg: pyalpm.Package) -> str | None:
+		"""
+		Name of a chosen package conflicting with or replacing pkg
+		"""
+		for dep in pkg.conflicts:
+			others = [o for o in self.provides.get(depend_name(dep), []) if o.name != pkg.name]
+			other = pyalpm.find_satisfier(others, dep)
+			if other: return other.name
+		for prov in [pkg.name, *pkg.provides]:
+			for other, dep in self.conflicts.get(depend_name(prov), []):
+				if other.name != pkg.name and pyalpm.find_satisfier([pkg], dep):
+					return other.name
+		for other, dep in self.replaces.get(pkg.name, []):
+			if other.name != pkg.name and pyalpm.find_satisfier([pkg], dep):
+				return other.name
+		return None
+
+
 def is_remote(val: str) -> bool:
 	if not val: return False
 	if val.startswith("http://"): return True
@@ -128,6 +197,12 @@ class Pacman:
 	caches: list[str]
 	repos: list[PacmanRepo]
 	package_map: dict[str: str] = None
+	index_names: dict[str, list[str]] = None
+	index_provides: dict[str, list[str]] = None
+	index_groups: dict[str, list[str]] = None
+	lookup_cache: dict[str, list[pyalpm.Package] | None] = None
+	prefetch: threading.Thread = None
+	locked: dict[str, dict] = None
 
 	def append_repos(self, lines: list[str], rootfs: bool = False):
 		"""
@@ -154,12 +229,13 @@ class Pacman:
 				else: raise ArchBuilderConfigError(
 					f"unknown value {repo.mirrorlist} for mirrorlist"
 				)
-			repo.append_repo(lines)			
+			repo.append_repo(lines, rootfs)
 
 	def append_mirrorlist(self, lines: list[str]):
 		servers: list[PacmanRepoServer] = []
 		for repo in self.repos:
 			for server in repo.servers:
+				if server.local: continue
 				if not any((server.name == local.name for local in servers)):
 					servers.append(server)
 		for server in servers:
@@ -199,25 +275,32 @@ class Pacman:
 			return
 		log.info("initializing pacman keyring")
 		self.pacman_key.initialize()
+		self.init_mirrorlists()
 
-		# Download and add public keys and mirrorlist
+		# Download and add public keys
 		for repo in self.repos:
-			if is_remote(repo.mirrorlist):
-				mirrorlist = os.path.join(self.ctx.work, f"etc/pacman.d/{repo.name}-mirrorlist")
-				cmds = ["wget", repo.mirrorlist, "-O", mirrorlist]
-				ret = self.ctx.run_external(cmds)
-				if ret != 0: raise OSError(f"wget failed with {ret}")
 			if repo.publickey is not None:
 				keypath = os.path.join(self.ctx.work, f"{repo.name}.pub")
 				cmds = ["wget", repo.publickey, "-O", keypath]
 				ret = self.ctx.run_external(cmds)
 				if ret != 0: raise OSError(f"wget failed with {ret}")
 				self.pacman_key.add_keys_from(keypath)
-				self.lsign_key(repo.keyid)
+				self.pacman_key.lsign_key(repo.keyid)
 			elif repo.keyid is not None:
 				self.pacman_key.recv_keys(repo.keyid)
 				self.pacman_key.lsign_key(repo.keyid)
 
+	def init_mirrorlists(self):
+		"""
+		Download remote mirrorlist of repos
+		"""
+		for repo in self.repos:
+			if not is_remote(repo.mirrorlist): continue
+			mirrorlist = os.path.join(self.ctx.work, f"etc/pacman.d/{repo.name}-mirrorlist")
+			cmds = ["wget", repo.mirrorlist, "-O", mirrorlist]
+			ret = self.ctx.run_external(cmds)
+			if ret != 0: raise OSError(f"wget failed with {ret}")
+
 	def write_config(self, name: str, lines: list[str]) -> str:
 		config = os.path.join(self.ctx.work, name)
 		if os.path.exists(config):
@@ -231,7 +314,7 @@ class Pacman:
 
 	def init_config(self):
 		"""
-		Create host pacman.conf and pacman-nogpg.conf
+		Create host pacman.conf, pacman-nogpg.conf and pacman-verified.conf
 		"""
 		lines_main = []
 		self.append_config(lines_main)
@@ -243,11 +326,22 @@ class Pacman:
 		]
 		self.write_config("pacman-nogpg.conf", lines_nogpg)
 
-	def pacman(self, args: list[str], nogpg: bool=False):
+		# only package files pre-verified by builder skip verification,
+		# packages pulled from repos are still verified by pacman
+		lines_verified = [
+			f"Include = {config_main}\n",
+			"[options]\n",
+			"LocalFileSigLevel = Never\n"
+		]
+		self.write_config("pacman-verified.conf", lines_verified)
+
+	def pacman(self, args: list[str], nogpg: bool=False, verified: bool=False):
 		"""
 		Call pacman for rootfs
 		"""
-		config_name = "pacman-nogpg.conf" if nogpg else "pacman.conf"
+		config_name = "pacman.conf"
+		if nogpg: config_name = "pacman-nogpg.conf"
+		elif verified: config_name = "pacman-verified.conf"
 		config = os.path.join(self.ctx.work, config_name)
 		cmds = ["pacman"]
 		cmds.append("--noconfirm")
@@ -274,22 +368,191 @@ class Pacman:
 			for server in mirror.servers:
 				servers.append(server.url)
 			db.servers = servers
+		self.init_config()
+		self.refresh_databases()
+		self.build_index()
 
-			tries = 0
-			while True:
+	def refresh_databases(self, force: bool = False):
+		"""
+		Update sync databases once for both pyalpm and pacman
+		Databases are kept in workspace and fetched only when changed on server
+		"""
+		work_sync = os.path.join(self.ctx.work, "sync")
+		root_sync = os.path.join(self.root, "var/lib/pacman/sync")
+		os.makedirs(work_sync, mode=0o0755, exist_ok=True)
+		os.makedirs(root_sync, mode=0o0755, exist_ok=True)
+		items: list[DownloadItem] = []
+		for repo in self.repos:
+			filename = f"{repo.name}.db"
+			urls = [f"{server.url.rstrip('/')}/{filename}" for server in repo.servers]
+			items.append(DownloadItem(filename, urls, work_sync))
+			# unsigned repos have no database signature
+			sig_urls = [f"{url}.sig" for url in urls]
+			items.append(DownloadItem(f"{filename}.sig", sig_urls, work_sync, optional=True))
+
+		# pinned databases, use them without any network access
+		present = all(os.path.exists(item.path) for item in items if not item.optional)
+		if not self.ctx.refresh and present and not force:
+			log.info("skip refresh pacman databases")
+		else:
+			etags_path = os.path.join(work_sync, "etags.json")
+			etags: dict[str, str] = {}
+			if os.path.exists(etags_path) and not force:
+				with open(etags_path, "r") as f:
+					etags = json.load(f)
+			log.info("refresh pacman databases")
+			dl = Downloader(
+				jobs=max(1, self.ctx.download_jobs),
+				retry=self.ctx.retry_count,
+				profile=self.ctx.profile,
+			)
+			with self.ctx.profile.span("pacman", "refresh"):
 				try:
-					# update database now via pyalpm
-					log.info(f"updating database {mirror.name}")
-					db.update(False)
-					break
-				except:
-					if tries < self.ctx.retry_count:
-						log.warning("update database failed, retry...", exc_info=True)
-						tries += 1
-						continue
-					raise
-		self.init_config()
-		self.refresh()
+					changed = dl.fetch_modified_all(items, etags, force)
+				except DownloadError as e:
+					# every server failed here, let pacman try them in its own way
+					log.warning(f"refresh pacman databases failed: {e}, fallback to pacman")
+					self.refresh(force=force)
+					for item in items:
+						source = os.path.join(root_sync, item.filename)
+						if os.path.exists(source): link_file(source, item.path)
+						elif os.path.exists(item.path): os.remove(item.path)
+						etags.pop(item.filename, None)
+					changed = []
+			for item in changed:
+				if item.optional: continue
+				log.info(f"database {item.filename} updated")
+			with open(etags_path, "w") as f:
+				json.dump(etags, f)
+
+		# share same files with rootfs, databases signatures checked by pacman
+		for item in items:
+			target = os.path.join(root_sync, item.filename)
+			if not os.path.exists(item.path):
+				# stale signature will break the database
+				if os.path.lexists(target): os.remove(target)
+				continue
+			if os.path.exists(target) and os.path.samefile(item.path, target): continue
+			link_file(item.path, target)
+
+	def index_key(self) -> dict:
+		"""
+		Checksums and stamps of sync databases files in databases order
+		"""
+		sync = os.path.join(self.root, "var/lib/pacman/sync")
+		databases: dict[str, list] = {}
+		for name in self.databases:
+			path = os.path.join(sync, f"{name}.db")
+			if not os.path.exists(path):
+				databases[name] = None
+				continue
+			st = os.stat(path)
+			databases[name] = [hash_file(path), st.st_mtime_ns, st.st_size]
+		return {
+			"version": 2,
+			"arch": self.ctx.tgt_arch,
+			"databases": list(databases.items()),
+		}
+
+	def index_path(self) -> str:
+		"""
+		Saved indexes file, beside sync databases in workspace
+		"""
+		return os.path.join(self.ctx.work, "sync", "pacman-index.json")
+
+	def load_index(self, key: dict) -> bool:
+		"""
+		Load saved indexes when sync databases unchanged
+		"""
+		path = self.index_path()
+		if not os.path.exists(path): return False
+		try:
+			with open(path, "r") as f:
+				data = json.load(f)
+		except:
+			log.warning(f"failed to load package index {path}", exc_info=True)
+			return False
+		if data.get("key") != key:
+			log.debug("sync databases changed, drop saved package index")
+			return False
+		self.index_names = data["names"]
+		self.index_provides = data["provides"]
+		self.index_groups = data["groups"]
+		return True
+
+	def save_index(self, key: dict):
+		"""
+		Save indexes beside sync databases for next build
+		"""
+		path = self.index_path()
+		tmp = f"{path}.{os.getpid()}.tmp"
+		os.makedirs(os.path.dirname(path), mode=0o0755, exist_ok=True)
+		with open(tmp, "w") as f:
+			json.dump({
+				"key": key,
+				"names": self.index_names,
+				"provides": self.index_provides,
+				"groups": self.index_groups,
+			}, f)
+		os.replace(tmp, path)
+
+	def build_index(self):
+		"""
+		Build package name, provides and group indexes of all sync databases
+		Indexes store DATABASE/PACKAGE, reused across builds by databases checksums
+		"""
+		self.lookup_cache = {}
+		key = self.index_key()
+		if self.load_index(key):
+			log.debug("use saved package index")
+			return
+		names: dict[str, list[str]] = {}
+		provides: dict[str, list[str]] = {}
+		groups: dict[str, dict[str, str]] = {}
+		for db in self.databases.values():
+			for pkg in db.pkgcache:
+				full = f"{db.name}/{pkg.name}"
+				names.setdefault(pkg.name, []).append(full)
+				for prov in pkg.provides:
+					provides.setdefault(depend_name(prov), []).append(full)
+				for grp in pkg.groups:
+					# same as find_grp_pkgs, first database wins
+					groups.setdefault(grp, {}).setdefault(pkg.name, full)
+		self.index_names = names
+		self.index_provides = provides
+		self.index_groups = {grp: list(pkgs.values()) for grp, pkgs in groups.items()}
+		log.debug(f"indexed {len(names)} packages {len(provides)} provides {len(groups)} groups")
+		if all(value is not None for _, value in key["databases"]):
+			self.save_index(key)
+
+	def index_packages(self, names: list[str]) -> list[pyalpm.Package]:
+		"""
+		Convert DATABASE/PACKAGE in indexes to pyalpm packages
+		"""
+		pkgs: list[pyalpm.Package] = []
+		for full in names:
+			dbn, name = full.split("/", 1)
+			if dbn not in self.databases: continue
+			pkg = self.databases[dbn].get_pkg(name)
+			if pkg: pkgs.append(pkg)
+		return pkgs
+
+	def find_satisfier(self, depend: str) -> pyalpm.Package | None:
+		"""
+		Find first package satisfies depend string in databases order
+		"""
+		name = depend_name(depend)
+		names = self.index_names.get(name, [])
+		provides = self.index_provides.get(name, [])
+		if not names and not provides: return None
+		for dbn in self.databases:
+			prefix = f"{dbn}/"
+			fulls = [full for full in names if full.startswith(prefix)]
+			fulls.extend(full for full in provides if full.startswith(prefix))
+			if len(fulls) <= 0: continue
+			pkg = pyalpm.find_satisfier(self.index_packages(fulls), depend)
+			if pkg: return pkg
+		return None
 
 	def lookup_package(self, name: str, map: bool=False) -> list[pyalpm.Package]:
 		"""
@@ -311,61 +574,135 @@ class Pacman:
 			name = s[1]
 			pkg = db.get_pkg(name)
 			if pkg: return [pkg]
+			if not map:
+				if self.index_names is None: self.build_index()
+				pkg = self.find_satisfier(name)
+				if pkg: return [pkg]
 		elif len(s) == 1:
-			# use PACKAGE, find it in all databases or find as group
-			pkgs = []
-
-			# try find it as group
-			pkg = pyalpm.find_grp_pkgs(self.databases.values(), name)
-			if len(pkg) > 0: pkgs.extend(pkg)
+			if self.index_names is None: self.build_index()
+			if name in self.lookup_cache:
+				pkgs = self.lookup_cache[name]
+				if pkgs is None: raise ValueError(f"package {name} not found")
+				return pkgs
 
-			# try find it as package
-			for dbn in self.databases:
-				db = self.databases[dbn]
-				pkg = db.get_pkg(name)
-				if pkg: pkgs.append(pkg)
+			# use PACKAGE, find it in all databases or find as group
+			pkgs = self.index_packages(
+				self.index_groups.get(name, []) +
+				self.index_names.get(name, [])
+			)
+			if len(pkgs) <= 0 and not map:
+				if name in self.package_map:
+					# package provides found before
+					pkgs = self.lookup_package(self.package_map[name], map=True)
+				else:
+					# package provides
+					pkg = self.find_satisfier(name)
+					if pkg:
+						self.package_map[name] = f"{pkg.db.name}/{pkg.name}"
+						pkgs = [pkg]
+			self.lookup_cache[name] = pkgs if len(pkgs) > 0 else None
 			if len(pkgs) > 0: return pkgs
 
-		# package provides
-		if not map:
-			if name in self.package_map:
-				pkg = self.package_map[name]
-				return self.lookup_package(pkg, map=True)
-			for dbn in self.databases:
-				db = self.databases[dbn]
-				pkg = pyalpm.find_satisfier(db.pkgcache, name)
-				if not pkg: continue
-				full = f"{db.name}/{pkg.name}"
-				self.package_map[name] = full
-				return [pkg]
-
 		raise ValueError(f"package {name} not found")
 
-	def lookup_package_depends(self, name: str, tree: list[str]):
+	def find_candidates(self, depend: str, prefer: set[str]) -> list[pyalpm.Package]:
 		"""
-		Lookup pyalpm package and all dependencies
+		Packages satisfying depend in pacman order, packages with literal name
+		in databases order then other providers, names in prefer first
 		"""
-		local: bool = False
-		if ".pkg.tar." in name:
-			pkg = self.handle.load_pkg(name)
-			if not pkg:
-				raise FileNotFoundError(f"package {name} not found")
-			local = True
-			pkgs = [pkg]
-		else:
-			if "/" in name and name in tree:
-				return
-			try:
-				pkgs = self.lookup_package(name)
-			except:
-				log.warning(f"package {name} not found")
-				return
-		for pkg in pkgs:
-			full = name if local else f"{pkg.db.name}/{pkg.name}"
-			if full in tree: continue
+		if self.index_names is None: self.build_index()
+		name = depend_name(depend)
+		fulls: list[str] = []
+		for full in self.index_names.get(name, []) + self.index_provides.get(name, []):
+			if full not in fulls: fulls.append(full)
+		found = [pkg for pkg in self.index_packages(fulls) if pyalpm.find_satisfier([pkg], depend)]
+		found.sort(key=lambda pkg: pkg.name not in prefer)
+		return found
+
+	def choose_provider(self, depend: str, closure: PackageClosure, prefer: set[str]) -> pyalpm.Package | None:
+		"""
+		Choose a package for depend not conflicting with chosen packages
+		"""
+		candidates = self.find_candidates(depend, prefer)
+		for pkg in candidates:
+			other = closure.conflict(pkg)
+			if other is None: return pkg
+			log.debug(f"skip {pkg.name} for {depend} which conflicts with {other}")
+		if len(candidates) > 0:
+			# let pacman report the conflict
+			log.warning(f"all providers of {depend} conflict with other packages")
+			return candidates[0]
+		return None
+
+	def resolve_closure(self, names: list[str], tree: list[str] = None, prefer: set[str] = None) -> list[str]:
+		"""
+		Lookup pyalpm packages and all dependencies like pacman sync
+		Targets are chosen first, dependencies satisfied by chosen packages (also by
+		provides) are not pulled again, otherwise providers installed in rootfs (prefer)
+		win, then literal names and other providers, conflicting ones are skipped
+		Return full names (DATABASE/PACKAGE or file path) in visit order
+		"""
+		if tree is None: tree = []
+		if prefer is None: prefer = self.installed_packages()
+		visited: set[str] = set(tree)
+		closure = PackageClosure()
+		for full in tree:
+			closure.add(self.lookup_package(full)[0], full)
+
+		# targets first, same name in multiple repos first repo wins
+		stack: list[tuple[str, pyalpm.Package]] = []
+		for name in names:
+			local = ".pkg.tar." in name
+			if local:
+				pkg = self.handle.load_pkg(name)
+				if not pkg:
+					raise FileNotFoundError(f"package {name} not found")
+				pkgs = [pkg]
+			else:
+				if "/" in name and name in visited:
+					continue
+				try:
+					pkgs = self.lookup_package(name)
+				except:
+					log.warning(f"package {name} not found")
+					continue
+			for pkg in pkgs:
+				full = name if local else f"{pkg.db.name}/{pkg.name}"
+				if pkg.name in closure.fulls: continue
+				closure.add(pkg, full)
+				stack.append((full, pkg))
+		stack.reverse()
+
+		while len(stack) > 0:
+			full, pkg = stack.pop()
+			if full in visited: continue
+			visited.add(full)
 			tree.append(full)
+			depends: list[tuple[str, pyalpm.Package]] = []
 			for depend in pkg.depends:
-				self.lookup_package_depends(depend, tree)
+				if closure.satisfier(depend): continue
+				dep = self.choose_provider(depend, closure, prefer)
+				if dep is None:
+					log.warning(f"dependency {depend} of {pkg.name} not found")
+					continue
+				dep_full = f"{dep.db.name}/{dep.name}"
+				closure.add(dep, dep_full)
+				depends.append((dep_full, dep))
+			stack.extend(reversed(depends))
+		return tree
+
+	def lookup_package_depends(self, name: str, tree: list[str]):
+		"""
+		Lookup pyalpm package and all dependencies
+		"""
+		self.resolve_closure([name], tree)
+
+	def installed_packages(self) -> set[str]:
+		"""
+		Names of installed packages in rootfs, read local database directly
+		since pyalpm caches local database before pacman changed it
+		"""
+		return set(installed_versions(self.root).keys())
 
 	def init_cache(self):
 		"""
@@ -474,6 +811,54 @@ class Pacman:
 				)
 
 			self.add_repo(pacman_repo)
+		self.probe_servers()
+		self.init_proxy()
+
+	def probe_servers(self):
+		"""
+		Sort servers of all repos by probed mirror speed
+		"""
+		if not self.ctx.probe_mirrors or not self.ctx.refresh: return
+		urls: dict[str, str] = {}
+		for repo in self.repos:
+			if len(repo.servers) <= 1: continue
+			for server in repo.servers:
+				host = url_host(server.url)
+				if host in urls: continue
+				urls[host] = f"{server.url.rstrip('/')}/{repo.name}.db"
+		if len(urls) <= 1: return
+		os.makedirs(self.ctx.work, mode=0o0755, exist_ok=True)
+		probe = MirrorProbe(os.path.join(self.ctx.work, "mirrors.json"), self.ctx.probe_ttl)
+		scores = probe.scores(urls)
+		for repo in self.repos:
+			# stable sort, same score keeps config order
+			repo.servers.sort(key=lambda server: scores.get(url_host(server.url), 0))
+			names = [server.name or "original" for server in repo.servers]
+			log.debug("servers order of %s: %s", repo.name, " ".join(names))
+
+	def init_proxy(self):
+		"""
+		Start embedded mirror proxy and use it as first server of all repos
+		"""
+		if not self.ctx.proxy_cache: return
+		if self.ctx.mirror_proxy is None:
+			self.ctx.mirror_proxy = MirrorProxy(
+				self.ctx.proxy_cache,
+				retry=self.ctx.retry_count,
+			)
+			self.ctx.mirror_proxy.start()
+		proxy = self.ctx.mirror_proxy
+		for repo in self.repos:
+			proxy.add_repo(repo.name, [server.url for server in repo.servers])
+			url = proxy.repo_url(repo.name)
+			repo.servers.insert(0, PacmanRepoServer(
+				ctx=self.ctx,
+				name="proxy",
+				url=url,
+				config_url=url,
+				mirror=True,
+				local=True,
+			))
 
 	def __init__(self, ctx: ArchBuilderContext):
 		"""
@@ -494,9 +879,11 @@ class Pacman:
 		self.handle.progresscb = progress_cb
 		self.databases = {}
 		self.package_map = {}
+		self.lookup_cache = {}
 		self.caches = []
 		self.repos = []
 		self.pacman_key = PacmanKey(ctx)
+		self.shared_cache = PackageCache(ctx)
 		self.init_cache()
 		self.init_repos()
 		for cache in self.caches:
@@ -542,16 +929,75 @@ class Pacman:
 		ps = " ".join(pkgs)
 		log.info(f"installing packages {ps}")
 		if dl_pkgs:
-			self.download_all(dl_pkgs)
-			args = ["--sync"]
-			if not force: args.append("--needed")
-			if asdeps: args.append("--asdeps")
-			if nodeps: args.extend(["--nodeps", "--nodeps"])
-			args.extend(dl_pkgs)
-			self.pacman(args)
+			verified = self.download_all(dl_pkgs, verify=True)
+			closure = self.resolve_closure(dl_pkgs)
+			opts: list[str] = []
+			if asdeps: opts.append("--asdeps")
+			if nodeps: opts.extend(["--nodeps", "--nodeps"])
+			if verified:
+				try:
+					self.install_verified(dl_pkgs, closure, opts, force)
+				except OSError:
+					# e.g. closure resolved differently from pacman, files stay verified in cache
+					log.warning("pre-verified transaction failed, fallback to pacman sync", exc_info=True)
+					verified = False
+			if not verified:
+				args = ["--sync"]
+				if not force: args.append("--needed")
+				args.extend(opts)
+				args.extend(dl_pkgs)
+				self.pacman(args)
+			self.save_cache(self.package_sums(closure))
 		if local_pkgs:
 			self.install_local(local_pkgs)
 
+	def target_names(self, pkgs: list[str]) -> set[str]:
+		"""
+		Names of packages explicitly installed by targets, groups expanded
+		"""
+		names: set[str] = set()
+		for pkg in pkgs:
+			if ".pkg.tar." in pkg: continue
+			try: names.update(p.name for p in self.lookup_package(pkg))
+			except ValueError: pass
+		return names
+
+	def install_verified(self, pkgs: list[str], closure: list[str], opts: list[str] = [], force: bool = False):
+		"""
+		Install exactly pre-verified package files of resolved closure in one
+		transaction, pacman skips verification of these files only,
+		dependencies not in closure are still installed and verified from repos
+		"""
+		targets = self.target_names(pkgs)
+		versions = installed_versions(self.root)
+		files: dict[str, str] = {}
+		seen: set[str] = set()
+		for full in closure:
+			if ".pkg.tar." in full: continue
+			pkg = self.lookup_package(full)[0]
+
+			# same name in multiple repos, first repo wins like sync
+			if pkg.name in seen: continue
+			seen.add(pkg.name)
+
+			# same as sync, installed dependencies are kept as is
+			if pkg.name not in targets and pkg.name in versions: continue
+			if not force and versions.get(pkg.name) == pkg.version: continue
+			path = self.find_package_file(pkg)
+			if path is None: raise OSError(f"package file of {full} not found")
+			files[pkg.name] = path
+		if len(files) <= 0: return
+		log.info(f"installing {len(files)} pre-verified packages")
+		args = ["--upgrade"]
+		args.extend(opts)
+		args.extend(files.values())
+		self.pacman(args, verified=True)
+
+		# files are installed explicitly, same as sync only targets are explicit
+		if "--asdeps" in opts: return
+		deps = [name for name in files if name not in targets and name not in versions]
+		if deps: self.pacman(["--database", "--asdeps", *deps])
+
 	def replace(self, old_pkgs: list[str], new_pkgs: list[str], /, force: bool=False):
 		"""
 		Replace packages via pacman
@@ -583,32 +1029,419 @@ class Pacman:
 		if len(dl_pkgs) == 0: return
 		core_db = "var/lib/pacman/sync/core.db"
 		if not os.path.exists(os.path.join(self.root, core_db)):
-			self.refresh()
+			self.refresh_databases()
 		log.info("downloading packages %s", " ".join(dl_pkgs))
 		args = ["--sync", "--downloadonly", "--nodeps", "--nodeps"]
 		args.extend(dl_pkgs)
 		tries = 0
-		while True:
+		with self.ctx.profile.span("pacman", "download", packages=len(dl_pkgs)):
+			while True:
+				try:
+					self.pacman(args, nogpg=nogpg)
+					break
+				except:
+					if tries < self.ctx.retry_count:
+						log.warning("download packages failed, retry...", exc_info=True)
+						tries += 1
+						continue
+					raise
+
+	def find_repo(self, name: str) -> PacmanRepo | None:
+		return next((repo for repo in self.repos if repo.name == name), None)
+
+	def native_items(self, packages: list[str]) -> tuple[list[DownloadItem], dict[str, str], list[str]]:
+		"""
+		Generate download items for packages not in cache
+		Return items, filename to package map and packages cannot download
+		"""
+		dest = os.path.join(self.ctx.work, "packages")
+		items: list[DownloadItem] = []
+		names: dict[str, str] = {}
+		failed: list[str] = []
+		for name in packages:
+			if ".pkg.tar." in name: continue
+			pkg = self.lookup_package(name)[0]
+			if pkg.filename in names: continue
+			if self.find_package_file(pkg): continue
+			repo = self.find_repo(pkg.db.name)
+			if repo is None:
+				failed.append(name)
+				continue
+			urls = [f"{server.url.rstrip('/')}/{pkg.filename}" for server in repo.servers]
+			names[pkg.filename] = name
+			items.append(DownloadItem(
+				pkg.filename, urls, dest,
+				size=pkg.size,
+				sha256=getattr(pkg, "sha256sum", None),
+			))
+			if self.ctx.gpgcheck:
+				sig = f"{pkg.filename}.sig"
+				urls = [f"{url}.sig" for url in urls]
+				items.append(DownloadItem(sig, urls, dest, optional=True))
+		return items, names, failed
+
+	def fetch_native(
+		self,
+		items: list[DownloadItem],
+		names: dict[str, str],
+		on_done: callable = None,
+	) -> list[str]:
+		"""
+		Download items in parallel, return packages failed
+		"""
+		failed: list[str] = []
+		if len(items) <= 0: return failed
+		log.info(f"downloading {len(names)} packages with {self.ctx.download_jobs} connections")
+		dl = Downloader(
+			jobs=self.ctx.download_jobs,
+			retry=self.ctx.retry_count,
+			profile=self.ctx.profile,
+			on_done=on_done,
+		)
+		with self.ctx.profile.span("pacman", "download-native", packages=len(names)):
+			for item in dl.fetch(items):
+				if item.filename in names:
+					failed.append(names[item.filename])
+		return failed
+
+	def download_native(self, packages: list[str], on_done: callable = None) -> list[str]:
+		"""
+		Download packages files and signatures in parallel without pacman
+		Return packages which failed to download
+		"""
+		items, names, failed = self.native_items(packages)
+		failed.extend(self.fetch_native(items, names, on_done))
+		if failed: log.warning("fallback to pacman for %s", " ".join(failed))
+		return failed
+
+	def lock_entries(self, packages: list[str], targets: set[str]) -> list[dict]:
+		"""
+		Pin resolved packages to exact versions and files,
+		targets are names of explicitly installed packages
+		"""
+		entries: list[dict] = []
+		for name in packages:
+			if ".pkg.tar." in name:
+				pkg = self.handle.load_pkg(name)
+				entries.append({
+					"name": pkg.name,
+					"version": pkg.version,
+					"filename": os.path.basename(name),
+					"file": os.path.realpath(name),
+					"sha256": hash_file(name),
+					"explicit": True,
+				})
+				continue
+			pkg = self.lookup_package(name)[0]
+			entries.append({
+				"name": pkg.name,
+				"version": pkg.version,
+				"filename": pkg.filename,
+				"sha256": getattr(pkg, "sha256sum", None),
+				"size": pkg.size,
+				"repo": pkg.db.name,
+				"explicit": pkg.name in targets,
+			})
+		return entries
+
+	def locked_entry(self, name: str) -> dict:
+		"""
+		Get a package in lock file
+		"""
+		name = name.split("/")[-1]
+		if name not in self.locked: raise ArchBuilderConfigError(
+			f"package {name} not found in lock file"
+		)
+		return self.locked[name]
+
+	def locked_file(self, entry: dict) -> str | None:
+		"""
+		Find out file of a locked package
+		"""
+		if "file" in entry: return entry["file"]
+		return self.find_cache_file(entry["filename"])
+
+	def lock_items(self, entries: list[dict]) -> tuple[list[DownloadItem], dict[str, str]]:
+		"""
+		Generate download items for locked packages not in cache
+		"""
+		dest = os.path.join(self.ctx.work, "packages")
+		items: list[DownloadItem] = []
+		names: dict[str, str] = {}
+		for entry in entries:
+			if "file" in entry or self.locked_file(entry): continue
+			repo = self.find_repo(entry["repo"])
+			if repo is None: raise ArchBuilderConfigError(
+				f"repo {entry['repo']} of locked package {entry['name']} not found"
+			)
+			urls = [f"{server.url.rstrip('/')}/{entry['filename']}" for server in repo.servers]
+			names[entry["filename"]] = entry["name"]
+			items.append(DownloadItem(
+				entry["filename"], urls, dest,
+				size=entry.get("size", 0),
+				sha256=entry.get("sha256"),
+			))
+			if self.ctx.gpgcheck:
+				sig = f"{entry['filename']}.sig"
+				urls = [f"{url}.sig" for url in urls]
+				items.append(DownloadItem(sig, urls, dest, optional=True))
+		return items, names
+
+	def download_locked(self, entries: list[dict]):
+		"""
+		Download locked packages by filename
+		"""
+		work_cache = os.path.join(self.ctx.work, "packages")
+		self.shared_cache.populate(self.locked_sums(entries), work_cache)
+		items, names = self.lock_items(entries)
+		failed = self.fetch_native(items, names)
+		if failed: raise OSError("download locked packages failed: %s" % " ".join(failed))
+
+	def locked_sums(self, entries: list[dict]) -> dict[str, str]:
+		"""
+		Archive filenames and checksums of locked packages
+		"""
+		return {
+			entry["filename"]: entry.get("sha256")
+			for entry in entries if "file" not in entry
+		}
+
+	def locked_explicit(self, pkgs: list[str]) -> set[str]:
+		"""
+		Names of explicitly installed locked packages, lock files without
+		explicit field use configured package names
+		"""
+		entries = self.locked.values()
+		if any("explicit" in entry for entry in entries):
+			return set(entry["name"] for entry in entries if entry.get("explicit"))
+		names = set(pkg.split("/")[-1] for pkg in pkgs)
+		names.update(entry["name"] for entry in entries if "file" in entry)
+		return names
+
+	def install_locked(self, entries: list[dict], pkgs: list[str]):
+		"""
+		Install locked packages files in one transaction,
+		same as sync only targets in pkgs are explicitly installed
+		"""
+		if len(entries) <= 0: return
+		self.download_locked(entries)
+		verified = self.verify_locked(entries)
+		files = [self.locked_file(entry) for entry in entries]
+		versions = installed_versions(self.root)
+		log.info(f"installing {len(files)} locked packages")
+		args = ["--upgrade", "--needed"]
+		args.extend(files)
+		self.pacman(args, verified=verified)
+		self.save_cache(self.locked_sums(entries))
+
+		# files are installed explicitly, mark new dependencies
+		explicit = self.locked_explicit(pkgs)
+		deps = [
+			entry["name"] for entry in entries
+			if entry["name"] not in explicit and entry["name"] not in versions
+		]
+		if deps: self.pacman(["--database", "--asdeps", *deps])
+
+	def verify_locked(self, entries: list[dict]) -> bool:
+		"""
+		Pre-verify locked packages signatures
+		Return whether all packages signatures verified
+		"""
+		verifier = self.new_verifier()
+		if not verifier: return False
+		for entry in entries:
+			if "file" in entry: continue
+			verifier.submit(entry["name"], self.locked_file(entry))
+		if verifier.finish(): return True
+
+		# bad files removed, download them again
+		self.download_locked(entries)
+		return False
+
+	def wanted_packages(self, pkgs: list[str], installed: set[str]) -> tuple[dict[str, str], dict[str, str]]:
+		"""
+		Resolve configured packages for an existing rootfs, dependencies
+		satisfied by installed packages (also by provides) keep them
+		Return DATABASE/PACKAGE and version of every package by bare name
+		"""
+		packages: dict[str, str] = {}
+		wanted: dict[str, str] = {}
+		for full in self.resolve_closure(pkgs, prefer=installed):
+			if ".pkg.tar." in full: continue
+			pkg = self.lookup_package(full)[0]
+			if pkg.name in wanted: continue
+			packages[pkg.name] = full
+			wanted[pkg.name] = pkg.version
+		return packages, wanted
+
+	def update(self, pkgs: list[str]) -> tuple[list[str], list[str]]:
+		"""
+		Upgrade installed packages to configured packages in one transaction,
+		only changed packages are downloaded and installed
+		Return changed packages and installed packages not configured anymore
+		"""
+		installed = installed_versions(self.root)
+		if self.locked is not None:
+			wanted = {entry["name"]: entry["version"] for entry in self.locked.values()}
+			changed, stale = diff_versions(installed, wanted)
+			self.install_locked([self.locked[name] for name in changed], pkgs)
+			return changed, stale
+
+		packages, wanted = self.wanted_packages(pkgs, set(installed))
+		changed, stale = diff_versions(installed, wanted)
+		if changed:
+			log.info("updating packages %s", " ".join(changed))
+			fulls = [packages[name] for name in changed]
+			verified = self.download_all(fulls, verify=True, closure=False)
+			if verified:
+				self.install_verified(fulls, fulls)
+			else:
+				args = ["--sync", "--needed"]
+				args.extend(fulls)
+				self.pacman(args)
+			self.save_cache(self.package_sums(fulls))
+
+			# new dependencies should not be explicitly installed
+			targets = self.target_names(pkgs)
+			deps = [name for name in changed if name not in installed and name not in targets]
+			if deps: self.pacman(["--database", "--asdeps", *deps])
+		return changed, stale
+
+	def fast_install(self, pkgs: list[str]) -> bool:
+		"""
+		Install packages into empty rootfs by extracting archives directly
+		Return False when packages cannot be fast installed
+		"""
+		if len(pkgs) <= 0 or len(self.installed_packages()) > 0: return False
+		if any(".pkg.tar." in pkg for pkg in pkgs): return False
+		if not have_external("bsdtar"):
+			log.warning("bsdtar not found, fallback to pacman")
+			return False
+		if self.locked is not None:
+			entries = list(self.locked.values())
+			self.download_locked(entries)
+			verified = self.verify_locked(entries)
+			files = [self.locked_file(entry) for entry in entries]
+			sums = self.locked_sums(entries)
+		else:
+			verified = self.download_all(pkgs, verify=True)
+			closure = self.resolve_closure(pkgs)
+			files = [self.find_package_file(self.lookup_package(name)[0]) for name in closure]
+			sums = self.package_sums(closure)
+
+		# no pacman transaction to verify signatures later
+		if self.ctx.gpgcheck and not verified:
+			log.warning("packages signatures not pre-verified, fallback to pacman")
+			return False
+		if None in files:
+			raise OSError("some packages files not found after download")
+		if self.locked is not None:
+			explicit = self.locked_explicit(pkgs)
+		else:
+			# members of groups are explicitly installed same as pacman
+			explicit = self.target_names(pkgs)
+		validation = "pgp" if self.ctx.gpgcheck else "none"
+		if not FastInstaller(self.ctx, self.root, validation).install(files, explicit):
+			return False
+		self.save_cache(sums)
+		return True
+
+	def start_prefetch(self, pkgs: list[str]):
+		"""
+		Download packages in background, signatures are verified at install time
+		Packages are resolved here since pyalpm handle is not thread safe
+		"""
+		if self.ctx.download_jobs <= 0 or len(pkgs) <= 0: return
+
+		# keyring packages are downloaded by keyring step at the same time
+		if self.locked is not None:
+			entries = [self.locked_entry(name) for name in pkgs if not name.endswith("-keyring")]
+			work_cache = os.path.join(self.ctx.work, "packages")
+			self.shared_cache.populate(self.locked_sums(entries), work_cache)
+			items, names = self.lock_items(entries)
+		else:
+			packages = [
+				name for name in self.resolve_closure(pkgs)
+				if not name.endswith("-keyring")
+			]
+			work_cache = os.path.join(self.ctx.work, "packages")
+			self.shared_cache.populate(self.package_sums(packages), work_cache)
+			items, names, _ = self.native_items(packages)
+		if len(items) <= 0: return
+
+		def run():
 			try:
-				self.pacman(args, nogpg=nogpg)
-				break
+				with self.ctx.profile.span("pacman", "prefetch", packages=len(names)):
+					self.fetch_native(items, names)
 			except:
-				if tries < self.ctx.retry_count:
-					log.warning("download packages failed, retry...", exc_info=True)
-					tries += 1
-					continue
-				raise
+				log.warning("prefetch packages failed", exc_info=True)
+
+		log.info(f"prefetching {len(names)} packages in background")
+		self.prefetch = threading.Thread(target=run, name="prefetch")
+		self.prefetch.start()
 
-	def download_all(self, pkgs: list[str]):
+	def wait_prefetch(self):
+		"""
+		Wait background packages download finished
+		"""
+		if self.prefetch is None: return
+		if self.prefetch.is_alive():
+			log.info("waiting for prefetching packages")
+		self.prefetch.join()
+		self.prefetch = None
+
+	def download_all(self, pkgs: list[str], verify: bool = False, closure: bool = True) -> bool:
 		"""
 		Download packages and all dependencies
+		Return whether all packages signatures pre-verified
 		"""
 		pkg_once = 100
-		packages: list[str] = []
-		for pkg in pkgs:
-			self.lookup_package_depends(pkg, packages)
+		packages = self.resolve_closure(pkgs) if closure else pkgs
+		work_cache = os.path.join(self.ctx.work, "packages")
+		self.shared_cache.populate(self.package_sums(packages), work_cache)
+
+		# verify signatures as soon as files ready, pyalpm only used here
+		verifier = self.new_verifier() if verify else None
+		signs: dict[str, tuple[str, str]] = {}
+		if verifier:
+			for name in packages:
+				if ".pkg.tar." in name: continue
+				pkg = self.lookup_package(name)[0]
+				signs[pkg.filename] = (pkg.name, getattr(pkg, "base64_sig", None))
+
+		def submit_ready():
+			for filename, (name, embedded) in signs.items():
+				path = self.find_cache_file(filename)
+				if path: verifier.submit(name, path, embedded)
+
+		def on_done(item: DownloadItem):
+			if item.filename in signs:
+				name, embedded = signs[item.filename]
+				verifier.submit(name, item.path, embedded)
+
+		if verifier: submit_ready()
+		if self.ctx.download_jobs > 0:
+			packages = self.download_native(packages, on_done if verifier else None)
 		for once in range(0, len(packages), pkg_once):
 			self.download(packages[once:once + pkg_once])
+		if not verifier: return False
+		submit_ready()
+		if verifier.finish():
+			# pacman must not download any file without verification
+			paths = [self.find_cache_file(filename) for filename in signs]
+			return all(path and verifier.is_verified(path) for path in paths)
+
+		# bad files removed, let pacman download and verify them again
+		bad = [name for filename, (name, _) in signs.items() if not self.find_cache_file(filename)]
+		self.download(bad)
+		return False
+
+	def new_verifier(self) -> PackageVerifier | None:
+		"""
+		Create a signatures verifier when enabled
+		"""
+		if not self.ctx.gpgcheck or not self.ctx.preverify: return None
+		return PackageVerifier(self.ctx, self.pacman_key)
 
 	def install_local(self, files: list[str]):
 		"""
@@ -630,37 +1463,69 @@ class Pacman:
 		if force: args.append("--refresh")
 		self.pacman(args)
 
-	def find_package_file(self, pkg: pyalpm.Package) -> str | None:
+	def find_cache_file(self, filename: str) -> str | None:
 		"""
-		Find out pacman package archive file in cache
+		Find out a file in all cache folders
 		"""
 		for cache in self.caches:
-			p = os.path.join(cache, pkg.filename)
+			p = os.path.join(cache, filename)
 			if os.path.exists(p): return p
 		return None
 
+	def find_package_file(self, pkg: pyalpm.Package) -> str | None:
+		"""
+		Find out pacman package archive file in cache
+		"""
+		return self.find_cache_file(pkg.filename)
+
+	def package_sums(self, packages: list[str]) -> dict[str, str]:
+		"""
+		Archive filenames and database checksums of packages
+		"""
+		sums: dict[str, str] = {}
+		for name in packages:
+			if ".pkg.tar." in name: continue
+			pkg = self.lookup_package(name)[0]
+			sums[pkg.filename] = getattr(pkg, "sha256sum", None)
+		return sums
+
+	def save_cache(self, sums: dict[str, str]):
+		"""
+		Add packages files into shared cache after installed,
+		signatures are verified by pre-verify or pacman transaction
+		"""
+		if not self.shared_cache.enabled: return
+		files: dict[str, str] = {}
+		for filename, sha256 in sums.items():
+			path = self.find_cache_file(filename)
+			if path: files[path] = sha256
+		self.shared_cache.save(files)
+
 	def trust_keyring_pkg(self, pkg: pyalpm.Package):
 		"""
 		Trust a keyring package from file without install it
 		"""
+		self.trust_keyring_file(pkg.name, self.find_package_file(pkg))
+
+	def trust_keyring_file(self, name: str, path: str):
+		"""
+		Trust a keyring package file without install it
+		"""
 		if not self.ctx.gpgcheck: return
 		names: list[str] = []
 		target = os.path.join(self.ctx.work, "keyrings")
 		keyring = "usr/share/pacman/keyrings/"
 
-		# find out file path
-		path = self.find_package_file(pkg)
-
 		# cleanup keyring extract folder
 		if os.path.exists(target):
 			shutil.rmtree(target)
 		os.makedirs(target, mode=0o0755)
 		if path is None: raise RuntimeError(
-			f"package {pkg.name} not found"
+			f"package {name} not found"
 		)
 
 		# open keyring package to extract
-		log.debug(f"processing keyring package {pkg.name}")
+		log.debug(f"processing keyring package {name}")
 		with libarchive.file_reader(path) as archive:
 			for file in archive:
 				pn: str = file.pathname
@@ -692,8 +1557,16 @@ class Pacman:
 		"""
 		if not self.ctx.gpgcheck: return
 		if len(pkgnames) <= 0: return
+		if self.locked is not None:
+			entries = [self.locked_entry(name) for name in pkgnames]
+			self.download_locked(entries)
+			with self.pacman_key.session():
+				for entry in entries:
+					self.trust_keyring_file(entry["name"], self.locked_file(entry))
+			return
 		self.download(pkgnames, nogpg=nogpg)
-		for pkgname in pkgnames:
-			pkgs = self.lookup_package(pkgname)
-			for pkg in pkgs:
-				self.trust_keyring_pkg(pkg)
+		with self.pacman_key.session():
+			for pkgname in pkgnames:
+				pkgs = self.lookup_package(pkgname)
+				for pkg in pkgs:
+					self.trust_keyring_pkg(pkg)
@@ -2,6 +2,7 @@ import os
 import re
 import pathlib
 from packaging import version
+from contextlib import contextmanager
 from logging import getLogger
 from builder.lib.context import ArchBuilderContext
 log = getLogger(__name__)
@@ -11,13 +12,30 @@ class PacmanKey:
 	def __init__(self, ctx: ArchBuilderContext):
 		self.ctx= ctx
 		self.gpgdir = os.path.join(ctx.get_rootfs(), "etc/pacman.d/gnupg")
+		self.deferred = 0
+		self.dirty = False
 
 	def gpg_cmd(self) -> list[str]:
-		return [
+		cmds = [
 			"gpg",
 			"--homedir", self.gpgdir,
 			"--no-permission-warning",
 		]
+		# trustdb checked once when session finished
+		if self.deferred > 0: cmds.append("--no-auto-check-trustdb")
+		return cmds
+
+	@contextmanager
+	def session(self):
+		"""
+		Batch keyring operations, check trustdb only once at the end
+		with pacman.pacman_key.session(): ...
+		"""
+		self.deferred += 1
+		try: yield self
+		finally: self.deferred -= 1
+		if self.deferred == 0 and self.dirty:
+			self.update_db()
 
 	def gpg(self, args: list[str], stdin: str=None):
 		"""
@@ -101,9 +119,36 @@ class PacmanKey:
 		self.update_db()
 
 	def update_db(self):
+		if self.deferred > 0:
+			self.dirty = True
+			return
 		log.debug(f"updating database...")
+		self.dirty = False
 		self.gpg(["--batch", "--check-trustdb"])
 
+	def verify_signature(self, path: str, sig: str) -> str | None:
+		"""
+		Verify a detached signature with trusted keys in keyring
+		Return error message or None when valid
+		"""
+		cmds = self.gpg_cmd()
+		if "--no-auto-check-trustdb" not in cmds:
+			cmds.append("--no-auto-check-trustdb")
+		cmds.extend(["--batch", "--quiet", "--status-fd", "1", "--verify", sig, path])
+		ret, stdout = self.ctx.run_external(cmds, want_stdout=True)
+		status: list[str] = []
+		for line in stdout.split("\n"):
+			cols = line.split()
+			if len(cols) >= 2 and cols[0] == "[GNUPG:]":
+				status.append(cols[1])
+		for bad in ("KEYREVOKED", "REVKEYSIG", "EXPKEYSIG", "BADSIG", "ERRSIG"):
+			if bad in status: return f"gpg reports {bad}"
+		if ret != 0 or "VALIDSIG" not in status:
+			return f"bad signature (gpg exit {ret})"
+		if "TRUST_FULLY" not in status and "TRUST_ULTIMATE" not in status:
+			return "signed by untrusted key"
+		return None
+
 	def add_keys_from(self, paths: list[str] | str, update: bool=True):
 		items: list[str] = []
 		if type(paths) is str:
@@ -187,10 +232,22 @@ class PacmanKey:
 			items.extend(keys)
 		else:
 			raise TypeError("bad keys type")
-		for key in items:
+		self.lsign_keys(items, update=update)
+
+	def lsign_keys(self, keys: list[str], fail: bool=False, update: bool=True):
+		"""
+		Local sign multiple keys, gpg only signs one key in every call,
+		failed keys are reported one by one when fail is set
+		"""
+		if len(keys) <= 0: return
+		for key in keys:
 			log.debug(f"local sign key {key}")
 			args = ["--command-fd", "0", "--quiet", "--batch", "--lsign-key", key]
-			self.gpg(args, stdin="y\ny\n")
+			try:
+				self.gpg(args, stdin="y\ny\n")
+			except:
+				if not fail: raise
+				log.warning(f"lsign-key {key} failed")
 		if update: self.update_db()
 
 	def pouplate_keys(
@@ -222,18 +279,18 @@ class PacmanKey:
 				raise FileNotFoundError(f"keyring {key} not found")
 		if len(items) == 0:
 			return
+		log.info("Appending keys from %s...", " ".join(f"{key}.gpg" for key in items))
+		args = ["--quiet", "--batch", "--import"]
+		args.extend(os.path.join(folder, f"{key}.gpg") for key in items)
+		self.gpg(args)
+		trusted: list[str] = []
 		for key in items:
-			file = f"{key}.gpg"
-			path = os.path.join(folder, file)
-			log.info(f"Appending keys from {file}...")
-			self.gpg(["--quiet", "--import", path])
-		for key in items:
-			file = f"{key}-trusted"
-			path = os.path.join(folder, file)
+			path = os.path.join(folder, f"{key}-trusted")
 			if not os.path.exists(path):
 				continue
 			log.debug(f"populate trust {key}")
-			self.trust_key_from(path, update=False)
+			trusted.append(path)
+		self.trust_key_from(trusted, update=False)
 		for key in items:
 			file = f"{key}-revoked"
 			path = os.path.join(folder, file)
@@ -243,23 +300,32 @@ class PacmanKey:
 			self.revoke_key_from(path, fail=True, update=False)
 		if update: self.update_db()
 
-	def trust_key_from(self, path: str, update: bool=True):
-		with open(path, "r") as f:
-			while True:
-				line = f.readline()
-				if not line:
-					break
+	def trust_key_from(self, paths: str | list[str], update: bool=True):
+		"""
+		Local sign and import owner trust from trusted files
+		"""
+		items = [paths] if type(paths) is str else paths
+		if len(items) <= 0: return
+		content = ""
+		keys: list[str] = []
+		for path in items:
+			with open(path, "r") as f:
+				data = f.read()
+			for line in data.split("\n"):
 				line = line.strip()
 				if len(line) <= 0 or line.startswith("#"):
 					continue
 				cols = line.split(":")
-				if len(cols) > 1:
-					self.lsign_key(cols[0], update=False)
-		log.debug(f"import owner trust from {path}")
-		self.gpg(["--import-ownertrust", path])
+				if len(cols) > 1 and cols[0] not in keys:
+					keys.append(cols[0])
+			content += data if data.endswith("\n") else data + "\n"
+		self.lsign_key(keys, update=False)
+		log.debug(f"import owner trust from {items}")
+		self.gpg(["--import-ownertrust"], stdin=content)
 		if update: self.update_db()
 
 	def revoke_key_from(self, path: str, fail: bool=False, update: bool=True):
+		keys: list[str] = []
 		with open(path, "r") as f:
 			while True:
 				line = f.readline()
@@ -268,11 +334,43 @@ class PacmanKey:
 				line = line.strip()
 				if len(line) <= 0 or line.startswith("#"):
 					continue
-				try:
-					self.revoke_key(line, update=False)
-				except:
-					if not fail: raise
-					log.warning(f"revoke key {line} failed")
+				keys.append(line)
+		self.revoke_keys(keys, fail=fail, update=False)
+		if update: self.update_db()
+
+	def revoke_keys(self, keys: list[str], fail: bool=False, update: bool=True):
+		"""
+		Disable multiple keys in one ownertrust import,
+		same as disable in edit-key which sets the disabled flag of ownertrust
+		Keys not given as full fingerprint or failed import are disabled one by one
+		"""
+		if len(keys) <= 0: return
+		re_fpr = re.compile(r'(0x)?[0-9a-fA-F]{40}$')
+		fprs: list[str] = []
+		others: list[str] = []
+		for key in keys:
+			if re_fpr.match(key): fprs.append(key[-40:].upper())
+			else: others.append(key)
+		if len(fprs) > 0:
+			try:
+				# keep current ownertrust, only add disabled flag
+				trust: dict[str, int] = {}
+				for line in self.gpg_eval(["--export-ownertrust"]).split("\n"):
+					cols = line.strip().split(":")
+					if len(cols) < 2 or line.startswith("#"): continue
+					trust[cols[0].upper()] = int(cols[1])
+				content = "".join(f"{fpr}:{trust.get(fpr, 0) | 0x80}:\n" for fpr in fprs)
+				log.debug(f"revoke keys {fprs}")
+				self.gpg(["--quiet", "--batch", "--import-ownertrust"], stdin=content)
+			except:
+				log.warning("revoke keys in batch failed, fallback to revoke one by one", exc_info=True)
+				others = list(keys)
+		for key in others:
+			try:
+				self.revoke_key(key, update=False)
+			except:
+				if not fail: raise
+				log.warning(f"revoke key {key} failed")
 		if update: self.update_db()
 
 	def revoke_key(self, keyid: str, update: bool=True):
@@ -0,0 +1,232 @@
+import os
+import time
+import shutil
+import tempfile
+import hashlib
+from logging import getLogger
+from builder.lib import json
+from builder.lib.mount import MountTab
+from builder.lib.utils import hash_file, file_lock, tree_size, snapshot_stages
+from builder.lib.context import ArchBuilderContext
+from builder.lib.checkpoint import hook_inputs
+from builder.component.pacman import Pacman
+log = getLogger(__name__)
+
+
+def is_btrfs(path: str) -> bool:
+	"""
+	Is path stored in a btrfs filesystem
+	"""
+	mnt = MountTab.parse_mounts().find_path(path)
+	return mnt is not None and mnt.fstype == "btrfs"
+
+
+def is_subvolume(path: str) -> bool:
+	"""
+	Is path a btrfs subvolume (subvolume root inode is always 256)
+	"""
+	if not os.path.isdir(path): return False
+	return os.stat(path).st_ino == 256 and is_btrfs(path)
+
+
+class RootfsSnapshots:
+	"""
+	Content-addressed store of rootfs after packages installed
+
+	Snapshots keyed by resolved package closure with versions, repo
+	databases checksums and hooks run into rootfs before packages,
+	clone by btrfs snapshot or reflink copy.
+	"""
+	ctx: ArchBuilderContext
+	store: str = None
+	limit: int = 0
+
+	@property
+	def enabled(self) -> bool:
+		return self.store is not None
+
+	def __init__(self, ctx: ArchBuilderContext):
+		self.ctx = ctx
+		if ctx.snapshot_cache:
+			self.store = os.path.realpath(ctx.snapshot_cache)
+			self.limit = ctx.snapshot_limit
+			os.makedirs(self.store, mode=0o0755, exist_ok=True)
+
+	def path_of(self, key: str) -> str:
+		return os.path.join(self.store, key)
+
+	def load_index(self) -> dict[str, dict]:
+		path = os.path.join(self.store, "index.json")
+		if not os.path.exists(path): return {}
+		try:
+			with open(path, "r") as f:
+				return json.load(f)
+		except:
+			log.warning(f"failed to load snapshot index {path}", exc_info=True)
+			return {}
+
+	def save_index(self, index: dict[str, dict]):
+		path = os.path.join(self.store, "index.json")
+		tmp = f"{path}.tmp"
+		with open(tmp, "w") as f:
+			json.dump(index, f, indent=2)
+		os.replace(tmp, path)
+
+	def lock(self):
+		return file_lock(os.path.join(self.store, ".lock"))
+
+	def make_key(self, pacman: Pacman) -> str | None:
+		"""
+		Calculate snapshot key from resolved packages and databases
+		"""
+		if not self.enabled: return None
+		replaces: list[dict] = self.ctx.get("pacman.replaces", [])
+
+		# pin every package to a version or a file checksum
+		pinned: list[str] = []
+		if pacman.locked is not None:
+			for entry in pacman.locked.values():
+				pinned.append(f"{entry['filename']}={entry['sha256']}")
+		else:
+			install: list[str] = list(self.ctx.get("pacman.install", []))
+			install.extend(pkg["new"] for pkg in replaces)
+			for name in pacman.resolve_closure(install):
+				if ".pkg.tar." in name:
+					pinned.append(f"{os.path.basename(name)}={hash_file(name)}")
+				else:
+					pkg = pacman.lookup_package(name)[0]
+					pinned.append(f"{name}={pkg.version}")
+
+		databases: dict[str, str] = {}
+		sync = os.path.join(pacman.root, "var/lib/pacman/sync")
+		for repo in pacman.repos:
+			path = os.path.join(sync, f"{repo.name}.db")
+			if os.path.exists(path):
+				databases[repo.name] = hash_file(path)
+
+		# restore replaces whole rootfs, include everything written before it
+		hooks = {
+			stage: hook_inputs(self.ctx, stage)
+			for stage in snapshot_stages
+		}
+
+		data = json.dumps({
+			"arch": self.ctx.tgt_arch,
+			"hooks": hooks,
+			"gpgcheck": self.ctx.gpgcheck,
+			"packages": sorted(pinned),
+			"databases": databases,
+			"uninstall": self.ctx.get("pacman.uninstall", []),
+			"replaces": replaces,
+			"trust": self.ctx.get("pacman.trust", []),
+		}, sort_keys=True)
+		key = hashlib.sha256(data.encode()).hexdigest()
+		log.debug(f"rootfs snapshot key {key} for {len(pinned)} packages")
+		return key
+
+	def remove_tree(self, path: str):
+		"""
+		Remove a folder or a btrfs subvolume
+		"""
+		if not os.path.exists(path): return
+		if is_subvolume(path):
+			ret = self.ctx.run_external(["btrfs", "subvolume", "delete", path])
+			if ret == 0: return
+			log.warning(f"delete subvolume {path} failed, fallback to remove")
+		shutil.rmtree(path)
+
+	def clone_tree(self, src: str, dst: str):
+		"""
+		Clone a folder via btrfs snapshot or reflink copy
+		"""
+		if is_subvolume(src):
+			args = ["btrfs", "subvolume", "snapshot", src, dst]
+			if self.ctx.run_external(args) == 0: return
+			log.warning(f"snapshot {src} failed, fallback to copy")
+		elif is_btrfs(os.path.dirname(dst)):
+			args = ["btrfs", "subvolume", "create", dst]
+			if self.ctx.run_external(args) != 0:
+				log.warning(f"create subvolume {dst} failed")
+		else:
+			os.makedirs(dst, mode=0o0755, exist_ok=True)
+
+		# one-file-system to skip chroot mount points contents
+		args = [
+			"cp", "--archive", "--reflink=auto",
+			"--one-file-system", "--no-target-directory",
+			src, dst,
+		]
+		ret = self.ctx.run_external(args)
+		if ret != 0: raise OSError(f"cp failed with {ret}")
+
+	def exists(self, key: str) -> bool:
+		if not self.enabled or key is None: return False
+		with self.lock():
+			return key in self.load_index() and os.path.isdir(self.path_of(key))
+
+	def restore(self, key: str) -> bool:
+		"""
+		Replace rootfs with a snapshot, rootfs must not be mounted
+		"""
+		if not self.enabled or key is None: return False
+		path = self.path_of(key)
+		root = self.ctx.get_rootfs()
+		with self.lock():
+			index = self.load_index()
+			if key not in index or not os.path.isdir(path):
+				log.info(f"rootfs snapshot {key} not found")
+				return False
+			log.info(f"restoring rootfs from snapshot {key}")
+			self.remove_tree(root)
+			self.clone_tree(path, root)
+			index[key]["used"] = time.time()
+			self.save_index(index)
+		return True
+
+	def save(self, key: str):
+		"""
+		Store current rootfs as a snapshot
+		"""
+		if not self.enabled or key is None: return
+		path = self.path_of(key)
+		log.info(f"saving rootfs snapshot {key}")
+
+		# unique folder per build, concurrent builds of same key never share it
+		parent = tempfile.mkdtemp(prefix=f".{key}.", dir=self.store)
+		tmp = os.path.join(parent, "rootfs")
+		try:
+			self.clone_tree(self.ctx.get_rootfs(), tmp)
+
+			# package files are already in cache, do not store them again
+			cache = os.path.join(tmp, "var/cache/pacman/pkg")
+			if os.path.isdir(cache):
+				for file in os.listdir(cache):
+					os.remove(os.path.join(cache, file))
+
+			size = tree_size(tmp)
+			with self.lock():
+				index = self.load_index()
+				if key in index and os.path.isdir(path):
+					log.info(f"rootfs snapshot {key} already saved by another build")
+				else:
+					self.remove_tree(path)
+					os.rename(tmp, path)
+					index[key] = {"size": size, "used": time.time()}
+				self.evict(index, key)
+				self.save_index(index)
+		finally:
+			self.remove_tree(tmp)
+			os.rmdir(parent)
+
+	def evict(self, index: dict[str, dict], keep: str = None):
+		"""
+		Remove least recently used snapshots until under size limit
+		"""
+		if self.limit <= 0: return
+		total = sum(item["size"] for item in index.values())
+		for key in sorted(index.keys(), key=lambda k: index[k]["used"]):
+			if total <= self.limit: break
+			if key == keep: continue
+			log.info(f"evicting rootfs snapshot {key}")
+			self.remove_tree(self.path_of(key))
+			total -= index.pop(key)["size"]
@@ -0,0 +1,113 @@
+import os
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from logging import getLogger
+from builder.lib import json
+from builder.lib.context import ArchBuilderContext
+from builder.component.pacman_key import PacmanKey
+log = getLogger(__name__)
+
+
+def file_stamp(path: str) -> str:
+	st = os.stat(path)
+	return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+class PackageVerifier:
+	"""
+	Verify packages signatures with build keyring in parallel
+
+	Files are submitted as soon as they downloaded, verified files are
+	recorded in workspace so pacman transaction can skip verification.
+	"""
+	ctx: ArchBuilderContext
+	key: PacmanKey
+	path: str
+	record: dict[str, str]
+	bad: list[str]
+
+	def __init__(self, ctx: ArchBuilderContext, key: PacmanKey):
+		self.ctx = ctx
+		self.key = key
+		self.path = os.path.join(ctx.work, "verified.json")
+		self.record = self.load()
+		self.bad = []
+		self.lock = threading.Lock()
+		self.futures: list[Future] = []
+		self.submitted: set[str] = set()
+		self.pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+
+	def load(self) -> dict[str, str]:
+		if not os.path.exists(self.path): return {}
+		try:
+			with open(self.path, "r") as f:
+				return json.load(f)
+		except:
+			log.warning(f"failed to load verified packages {self.path}", exc_info=True)
+			return {}
+
+	def save(self):
+		tmp = f"{self.path}.tmp"
+		with open(tmp, "w") as f:
+			json.dump(self.record, f)
+		os.replace(tmp, self.path)
+
+	def is_verified(self, path: str) -> bool:
+		return os.path.exists(path) and self.record.get(path) == file_stamp(path)
+
+	def verify_one(self, name: str, path: str, embedded: str = None):
+		"""
+		Verify one package file by detached or database embedded signature
+		"""
+		sig = f"{path}.sig"
+		tmp = None
+		try:
+			if not os.path.exists(sig):
+				if not embedded:
+					raise RuntimeError("no signature found")
+				tmp = os.path.join(self.ctx.work, "verify", f"{os.path.basename(path)}.sig")
+				os.makedirs(os.path.dirname(tmp), mode=0o0755, exist_ok=True)
+				with open(tmp, "wb") as f:
+					f.write(base64.b64decode(embedded))
+				sig = tmp
+			error = self.key.verify_signature(path, sig)
+		except Exception as e:
+			error = str(e)
+		finally:
+			if tmp and os.path.exists(tmp): os.remove(tmp)
+		with self.lock:
+			if error:
+				log.error(f"package {name} ({os.path.basename(path)}) verify failed: {error}")
+				self.bad.append(path)
+			else:
+				self.record[path] = file_stamp(path)
+
+	def submit(self, name: str, path: str, embedded: str = None):
+		"""
+		Queue a package file to verify
+		"""
+		with self.lock:
+			if path in self.submitted: return
+			self.submitted.add(path)
+			if self.is_verified(path): return
+			self.futures.append(self.pool.submit(self.verify_one, name, path, embedded))
+
+	def finish(self) -> bool:
+		"""
+		Wait all verifications, remove bad files to download again
+		Return whether all submitted files verified
+		"""
+		with self.ctx.profile.span("pacman", "verify", packages=len(self.futures)):
+			for future in self.futures:
+				future.result()
+		self.pool.shutdown()
+		for path in self.bad:
+			for file in (path, f"{path}.sig"):
+				if os.path.exists(file): os.remove(file)
+		if self.futures: self.save()
+		if self.bad:
+			log.warning(f"removed {len(self.bad)} bad packages, download them again")
+		else:
+			log.info(f"verified {len(self.futures)} packages signatures")
+		return len(self.bad) == 0
@@ -59,7 +59,7 @@ class FileSystemBuilder(ImageContentBuilder):
 		scmds = " ".join(ecmds)
 		log.debug(f"add root cmdline {scmds}")
 		cmds.extend(ecmds)
-		self.builder.ctx.resolve_subscript()
+		self.builder.ctx.resolve_subscript("kernel.cmdline")
 
 	def resolve_dev_tag(self, dev: str, mnt: MountPoint):
 		dev = dev.upper()
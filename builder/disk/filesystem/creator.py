@@ -40,10 +40,11 @@ class FileSystemCreator:
 		log.info(f"from {src} to {dst}")
 		if not os.path.ismount(dst):
 			raise RuntimeError(f"destination {dst} is not a mount")
-		self.ctx.do_copy(
-			"rootfs" if dir == "/" else dir,
-			src, dst, delete=True, no_cross=True
-		)
+		with self.ctx.profile.span("copy", dir, fstype=self.fstype):
+			self.ctx.do_copy(
+				"rootfs" if dir == "/" else dir,
+				src, dst, delete=True, no_cross=True
+			)
 
 	def auto_create_image(self) -> bool:
 		return True
@@ -121,13 +121,25 @@ class ImageBuilder:
 				self.device = self.output
 
 
+	@property
+	def label(self) -> str:
+		"""
+		Name of this image for logging
+		"""
+		if "mount" in self.config: return f"{self.type} {self.config['mount']}"
+		if "name" in self.config: return f"{self.type} {self.config['name']}"
+		if self.output: return f"{self.type} {os.path.basename(self.output)}"
+		return self.type
+
 	def build(self):
-		self.prepare_device(self.builder, False)
-		self.builder.build()
+		with self.ctx.profile.span("image", f"build {self.label}"):
+			self.prepare_device(self.builder, False)
+			self.builder.build()
 
 	def build_post(self):
-		self.prepare_device(self.builder, True)
-		self.builder.build_post()
+		with self.ctx.profile.span("image", f"build-post {self.label}"):
+			self.prepare_device(self.builder, True)
+			self.builder.build_post()
 
 
 def get_builders(ctx: ArchBuilderContext) -> list[ImageBuilder]:
@@ -59,6 +59,30 @@ class CGroup:
 				ret.append(int(line))
 		return ret
 
+	def read_stat(self, name: str) -> dict[str, int]:
+		"""
+		Read a flat or nested keyed stat file (cpu.stat, io.stat, ...)
+		Nested values of all devices are summed up by key
+		read_stat("cpu.stat") = {"usage_usec": 1234, "user_usec": 1000, ...}
+		read_stat("io.stat") = {"rbytes": 4096, "wbytes": 8192, ...}
+		"""
+		ret: dict[str, int] = {}
+		if not self.valid: return ret
+		path = os.path.join(self.path, name)
+		if not os.path.exists(path): return ret
+		with open(path, "r") as f:
+			for line in f:
+				cols = line.split()
+				if len(cols) == 2 and "=" not in cols[1]:
+					ret[cols[0]] = ret.get(cols[0], 0) + int(cols[1])
+					continue
+				for col in cols[1:]:
+					if "=" not in col: continue
+					key, val = col.split("=", 1)
+					try: ret[key] = ret.get(key, 0) + int(val)
+					except ValueError: pass
+		return ret
+
 	def kill_all(self, sig: int = signal.SIGTERM, timeout: int = 10, kill: int = 8):
 		"""
 		Kill all children process and wait them exit
@@ -0,0 +1,215 @@
+import os
+import time
+import fnmatch
+import hashlib
+from urllib import request
+from logging import getLogger
+from builder.lib import json
+from builder.lib.utils import hash_file
+from builder.lib.context import ArchBuilderContext
+log = getLogger(__name__)
+
+
+def tree_digest(path: str) -> str:
+	"""
+	Calculate digest of a file or all files in a folder
+	"""
+	if not os.path.isdir(path): return hash_file(path)
+	h = hashlib.sha256()
+	for folder, dirs, files in os.walk(path):
+		dirs.sort()
+		for name in sorted(files):
+			full = os.path.join(folder, name)
+			h.update(os.path.relpath(full, path).encode() + b"\0")
+			if os.path.islink(full): h.update(os.readlink(full).encode())
+			else: h.update(hash_file(full).encode())
+	return h.hexdigest()
+
+
+def url_validators(url: str) -> dict:
+	"""
+	Get validators of a remote file by a HEAD request
+	Unreachable url gets an unique value so stage always reruns
+	"""
+	try:
+		req = request.Request(url, method="HEAD")
+		with request.urlopen(req, timeout=30) as resp:
+			return {
+				"etag": resp.getheader("ETag"),
+				"modified": resp.getheader("Last-Modified"),
+				"length": resp.getheader("Content-Length"),
+			}
+	except Exception as e:
+		log.debug(f"failed to get validators of {url}: {e}")
+		return {"error": str(e), "time": time.time()}
+
+
+def file_inputs(ctx: ArchBuilderContext, file: dict) -> dict:
+	"""
+	Add content of referenced source file or url validators to file entry
+	"""
+	if "source" in file:
+		src: str = file["source"]
+		if not src.startswith("/"):
+			src = os.path.join(ctx.dir, src)
+		digest = tree_digest(src) if os.path.exists(src) else None
+		return {**file, "+source": digest}
+	if "url" in file:
+		return {**file, "+url": url_validators(file["url"])}
+	return file
+
+
+def hook_inputs(ctx: ArchBuilderContext, stage: str = None) -> dict:
+	"""
+	Collect files and scripts hooks which run in stage
+	"""
+	files = ctx.get("filesystem.files", [])
+	scripts = ctx.get("scripts", [])
+	return {
+		"files": [file_inputs(ctx, file) for file in files if file.get("stage") == stage],
+		"scripts": [script for script in scripts if script.get("stage") == stage],
+	}
+
+
+def installed_versions(root: str) -> dict[str, str]:
+	"""
+	Installed packages versions in rootfs local database
+	"""
+	local = os.path.join(root, "var/lib/pacman/local")
+	if not os.path.isdir(local): return {}
+	versions: dict[str, str] = {}
+	for entry in os.scandir(local):
+		if not entry.is_dir() or entry.name.count("-") < 2: continue
+		name, ver, rel = entry.name.rsplit("-", 2)
+		versions[name] = f"{ver}-{rel}"
+	return versions
+
+
+def diff_versions(installed: dict[str, str], wanted: dict[str, str]) -> tuple[list[str], list[str]]:
+	"""
+	Compare installed and wanted packages versions, both keyed by bare names
+	Return changed (new or other version) and stale (not wanted) packages
+	"""
+	changed = [name for name, version in wanted.items() if installed.get(name) != version]
+	stale = [name for name in installed if name not in wanted]
+	return changed, stale
+
+
+def package_inputs(ctx: ArchBuilderContext, names: list[str] = None, files: list[str] = None) -> dict[str, str]:
+	"""
+	Collect versions of installed packages which a stage depends on
+	Packages are matched by names patterns or owned files prefixes,
+	all packages are used when both not specified
+	"""
+	root = ctx.get_rootfs()
+	versions = installed_versions(root)
+	if names is None and files is None: return versions
+	inputs: dict[str, str] = {}
+	for name, version in versions.items():
+		if any(fnmatch.fnmatchcase(name, pattern) for pattern in names or []):
+			inputs[name] = version
+			continue
+		if not files: continue
+		path = os.path.join(root, "var/lib/pacman/local", f"{name}-{version}", "files")
+		if not os.path.exists(path): continue
+		with open(path, "r") as f:
+			if any(line.startswith(tuple(files)) for line in f):
+				inputs[name] = version
+	return inputs
+
+
+class StageCheckpoint:
+	"""
+	Fingerprints of finished rootfs stages
+
+	Every stage fingerprint is made from the config values, referenced
+	source files and packages it reads, a changed stage will invalidate all stages after it, except
+	in update mode which only reruns stages with changed inputs.
+	"""
+	ctx: ArchBuilderContext
+	path: str
+	stages: dict[str, str]
+	changed: bool
+	cascade: bool
+
+	def __init__(self, ctx: ArchBuilderContext):
+		self.ctx = ctx
+		self.path = os.path.join(ctx.work, "stages.json")
+		self.stages = {}
+		self.changed = not ctx.checkpoint
+		self.cascade = not ctx.update
+		self.load()
+
+	def load(self):
+		"""
+		Load recorded fingerprints from workspace
+		"""
+		if not os.path.exists(self.path): return
+
+		# rootfs was removed, recorded stages are useless
+		local = os.path.join(self.ctx.get_rootfs(), "var/lib/pacman/local")
+		if not os.path.exists(local):
+			log.debug("no local database in rootfs, ignore recorded stages")
+			return
+
+		try:
+			with open(self.path, "r") as f:
+				self.stages = json.load(f)
+		except:
+			log.warning(f"failed to load stages from {self.path}", exc_info=True)
+			self.stages = {}
+
+	def save(self):
+		"""
+		Write recorded fingerprints into workspace
+		"""
+		tmp = f"{self.path}.tmp"
+		with open(tmp, "w") as f:
+			json.dump(self.stages, f, indent=2)
+		os.replace(tmp, self.path)
+
+	def fingerprint(self, name: str, inputs: dict) -> str:
+		"""
+		Calculate fingerprint for a stage
+		"""
+		data = json.dumps(inputs, sort_keys=True)
+		h = hashlib.sha256()
+		h.update(name.encode())
+		h.update(data.encode())
+		return h.hexdigest()
+
+	def run(
+		self,
+		name: str,
+		keys: list[str],
+		func: callable,
+		*args,
+		extra=None,
+		packages: dict[str, str] = None,
+		force: bool = False,
+	):
+		"""
+		Run a stage if it or any previous stage changed
+		"""
+		inputs = {key: self.ctx.get(key) for key in keys}
+		if extra is not None: inputs["+extra"] = extra
+		if packages is not None: inputs["+packages"] = packages
+		fp = self.fingerprint(name, inputs)
+		with self.ctx.profile.span("stage", name) as span:
+			if not force and not self.changed and self.stages.get(name) == fp:
+				log.info(f"skip unchanged stage {name}")
+				span.args["skipped"] = True
+				return
+			if not self.cascade:
+				log.info(f"stage {name} changed, rerun it")
+			elif not self.changed and len(self.stages) > 0:
+				log.info(f"stage {name} changed, rebuild from here")
+			self.changed = self.cascade or self.changed
+
+			# forget old fingerprint first, stage may fail halfway
+			if name in self.stages:
+				self.stages.pop(name)
+				self.save()
+			func(*args)
+			self.stages[name] = fp
+			self.save()
@@ -1,8 +1,7 @@
-import os
 from logging import getLogger
 from builder.lib import json
 from builder.lib.cpu import cpu_arch_compatible
-from builder.lib.utils import load_simple
+from builder.lib.utils import merge_config_file, merge_configs
 from builder.lib.context import ArchBuilderContext
 log = getLogger(__name__)
 
@@ -11,46 +10,14 @@ class ArchBuilderConfigError(Exception):
 	pass
 
 
-def _dict_merge(dst: dict, src: dict):
-	"""
-	Merge two dict with override
-	"""
-	for key in src.keys():
-		st = type(src[key])
-		if key in dst and st is type(dst[key]):
-			if st == list:
-				dst[key].extend(src[key])
-				continue
-			if st == dict:
-				_dict_merge(dst[key], src[key])
-				continue
-		dst[key] = src[key]
-
-
 def load_config_file(ctx: ArchBuilderContext, path: str):
 	"""
 	Load one config (yaml/json) to context
 	"""
-	loaded = load_simple(path)
-	def _proc_include(inc: str | list[str]):
-		pt = type(inc)
-		if pt is str: inc = [inc]
-		elif pt is list: pass
-		else: raise ArchBuilderConfigError("bad type for also")
-		load_configs(ctx, inc)
-	if loaded is None: return
-	if "+also" in loaded:
-		_proc_include(loaded["+also"])
-		loaded.pop("+also")
-	if ctx.config is None:
-		log.debug(f"use {path} as current config")
-		ctx.config = loaded
-	else:
-		log.debug(f"merge {path} into current config")
-		_dict_merge(ctx.config, loaded)
-	if "+then" in loaded:
-		_proc_include(loaded["+then"])
-		loaded.pop("+then")
+	try:
+		merge_config_file(ctx.dir, path, ctx.config)
+	except ValueError as e:
+		raise ArchBuilderConfigError(str(e)) from e
 
 def fill_base_options(ctx: ArchBuilderContext):
 	if "target" not in ctx.config:
@@ -82,21 +49,12 @@ def load_configs(ctx: ArchBuilderContext, configs: list[str]):
 	"""
 	Load multiple config to context
 	"""
-	loaded = 0
-	for config in configs:
-		success = False
-		for suffix in ["yml", "yaml", "jsn", "json"]:
-			fn = f"{config}.{suffix}"
-			path = os.path.join(ctx.dir, "configs", fn)
-			if os.path.exists(path):
-				load_config_file(ctx, path)
-				loaded += 1
-				success = True
-		if not success:
-			raise FileNotFoundError(f"config {config} not found")
-	if loaded > 0:
-		if ctx.config is None:
-			raise ArchBuilderConfigError("no any config loaded")
+	try:
+		loaded = merge_configs(ctx.dir, configs, ctx.config)
+	except ValueError as e:
+		raise ArchBuilderConfigError(str(e)) from e
+	if loaded > 0 and not ctx.config:
+		raise ArchBuilderConfigError("no any config loaded")
 	log.debug(f"loaded {loaded} configs")
 
 
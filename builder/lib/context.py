@@ -10,6 +10,8 @@ from builder.lib.subscript import dict_get
 from builder.lib.loop import loop_detach
 from builder.lib.mount import MountTab, MountPoint
 from builder.lib.cgroup import CGroup
+from builder.lib.profile import BuildProfile
+from builder.lib.proxy import MirrorProxy
 from builder.lib.subscript import SubScript
 from builder.lib.shadow import PasswdFile, GroupFile
 log = getLogger(__name__)
@@ -23,6 +25,17 @@ class ArchBuilderContext:
 	config: dict = {}
 	config_orig: dict = {}
 
+	"""
+	Subscript resolver of config, kept for incremental re-resolve
+	"""
+	subscript: SubScript = None
+
+	"""
+	Cached values of config keys, per context, reset when config resolved
+	Values are shared references into config, copy them before changing
+	"""
+	get_cache: dict = None
+
 	"""
 	Target name
 	"""
@@ -49,6 +62,16 @@ class ArchBuilderContext:
 	"""
 	clean: bool = False
 
+	"""
+	Skip unchanged rootfs stages
+	"""
+	checkpoint: bool = True
+
+	"""
+	Upgrade existing rootfs in place, only rerun stages with changed inputs
+	"""
+	update: bool = False
+
 	"""
 	Top tree folder
 	"""
@@ -120,6 +143,96 @@ class ArchBuilderContext:
 	"""
 	version: str = datetime.now().strftime('%Y%m%d%H%M%S')
 
+	"""
+	Rootfs snapshots cache folder
+	"""
+	snapshot_cache: str = None
+
+	"""
+	Rootfs snapshots cache size limit
+	"""
+	snapshot_limit: int = 64 * 2**30
+
+	"""
+	Refresh pacman databases, disable to use pinned databases in workspace
+	"""
+	refresh: bool = True
+
+	"""
+	Probe mirrors speed and sort servers
+	"""
+	probe_mirrors: bool = True
+
+	"""
+	Seconds to reuse probed mirrors speed
+	"""
+	probe_ttl: int = 3600
+
+	"""
+	Packages cache folder shared by all workspaces
+	"""
+	package_cache: str = None
+
+	"""
+	Shared packages cache size limit
+	"""
+	package_cache_limit: int = 32 * 2**30
+
+	"""
+	Build time pacman keyring cache folder
+	"""
+	keyring_cache: str = None
+
+	"""
+	Mirror proxy store folder, enable embedded caching mirror proxy
+	"""
+	proxy_cache: str = None
+
+	"""
+	Running embedded mirror proxy
+	"""
+	mirror_proxy: MirrorProxy = None
+
+	"""
+	Wall time and usage profile of build
+	"""
+	profile: BuildProfile = None
+
+	"""
+	Write trace event timeline to file
+	"""
+	trace: str = None
+
+	"""
+	Parallel connections for packages downloader, zero to use pacman
+	"""
+	download_jobs: int = 8
+
+	"""
+	Verify packages signatures in parallel before pacman transaction
+	"""
+	preverify: bool = True
+
+	"""
+	Install exactly packages in lock file
+	"""
+	lock: str = None
+
+	"""
+	Write resolved packages into lock file, empty for default path
+	"""
+	write_lock: str = None
+
+	"""
+	Download packages in background while keyring initializing
+	"""
+	pipeline: bool = True
+
+	"""
+	Extract packages directly into empty rootfs instead of pacman transaction
+	"""
+	fast_bootstrap: bool = False
+
 	"""
 	Pacman download retry count
 	"""
@@ -128,9 +241,15 @@ class ArchBuilderContext:
 	def get(self, key: str, default=None):
 		"""
 		Get config value
+		Values are cached after config resolved, until resolved again,
+		returned lists and dicts are the same objects in config
 		"""
-		try: ret = dict_get(key, self.config)
-		except: pass
+		if self.subscript is not None and key in self.get_cache:
+			ret = self.get_cache[key]
+		else:
+			try: ret = dict_get(key, self.config)
+			except (KeyError, ValueError): ret = None
+			if self.subscript is not None: self.get_cache[key] = ret
 		return default if ret is None else ret
 
 	def get_rootfs(self): return os.path.join(self.work, "rootfs")
@@ -138,10 +257,12 @@ class ArchBuilderContext:
 	def get_mount(self): return os.path.join(self.work, "mount")
 
 	def __init__(self):
-		self.cgroup = CGroup("arch-image-builder")
+		self.get_cache = {}
+		self.cgroup = CGroup(os.getenv("ARCH_CGROUP", "arch-image-builder"))
 		self.config["version"] = self.version
 		try: self.cgroup.create()
 		except: log.warning("failed to create cgroup", exc_info=1)
+		self.profile = BuildProfile(self.cgroup)
 
 	def __deinit__(self):
 		self.cleanup()
@@ -151,6 +272,10 @@ class ArchBuilderContext:
 		Cleanup build context
 		"""
 		from builder.build.mount import undo_mounts
+		self.profile.finish()
+		if self.mirror_proxy:
+			self.mirror_proxy.stop()
+			self.mirror_proxy = None
 		self.cgroup.kill_all()
 		self.cgroup.destroy()
 		undo_mounts(self)
@@ -177,21 +302,25 @@ class ArchBuilderContext:
 		log.debug(f"running external command {argv}")
 		fstdin = None if stdin is None else PIPE
 		fstdout = None if not want_stdout else PIPE
-		proc = Popen(args, cwd=cwd, env=env, stdin=fstdin, stdout=fstdout)
-		if cgroup is None: cgroup = self.cgroup
-		cgroup.add_pid(proc.pid)
-		if stdin:
-			try:
-				if type(stdin) is str: stdin = stdin.encode()
-				proc.stdin.write(stdin)
-				proc.stdin.close()
-			except BrokenPipeError:
-				pass
-		ret = proc.wait()
+		prog = os.path.basename(args[2 if args[0] == "chroot" and len(args) > 2 else 0])
+		with self.profile.span("command", prog, argv=argv) as span:
+			proc = Popen(args, cwd=cwd, env=env, stdin=fstdin, stdout=fstdout)
+			self.profile.add_pid(proc.pid)
+			if cgroup is None: cgroup = self.cgroup
+			cgroup.add_pid(proc.pid)
+			if stdin:
+				try:
+					if type(stdin) is str: stdin = stdin.encode()
+					proc.stdin.write(stdin)
+					proc.stdin.close()
+				except BrokenPipeError:
+					pass
+			if want_stdout: stdout = proc.stdout.read().decode()
+			ret = proc.wait()
+			span.args["exit"] = ret
 		log.debug(f"command exit with {ret}")
 		if not want_stdout:
 			return ret
-		stdout = proc.stdout.read().decode()
 		return (ret, stdout)
 
 	def reload_passwd(self):
@@ -212,13 +341,20 @@ class ArchBuilderContext:
 		"""
 		self.config_orig = deepcopy(self.config)
 
-	def resolve_subscript(self):
+	def resolve_subscript(self, path: str = None):
 		"""
 		Run subscript replaces
+		When path of original config changed, only re-resolve values depend on it
 		"""
-		ss = SubScript()
+		self.get_cache = {}
+		if path is not None and self.subscript is not None:
+			self.subscript.update(self.config_orig, path)
+			return
+		self.subscript = None
 		self.config = deepcopy(self.config_orig)
+		ss = SubScript()
 		ss.parse(self.config)
+		self.subscript = ss
 
 	def mount(
 		self,
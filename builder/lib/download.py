@@ -0,0 +1,402 @@
+import os
+import time
+import base64
+import shutil
+import hashlib
+import threading
+from http import client
+from urllib import request
+from urllib.parse import urlsplit, urljoin, unquote
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+log = getLogger(__name__)
+
+
+class DownloadError(Exception):
+	pass
+
+
+class LocalResponse:
+	"""
+	Response of a file:// url, same interface used from HTTPResponse
+	"""
+	status: int
+	headers: dict[str, str]
+	ttfb: float = 0
+	will_close: bool = False
+
+	def __init__(self, status: int, headers: dict[str, str] = None):
+		self.status = status
+		self.headers = headers or {}
+
+	def getheader(self, name: str, default: str = None) -> str | None:
+		return self.headers.get(name, default)
+
+	def read(self, *args) -> bytes:
+		return b""
+
+
+class DownloadItem:
+	"""
+	Filename to save in destination folder
+	"""
+	filename: str = None
+
+	"""
+	Full urls to try in order
+	"""
+	urls: list[str] = None
+
+	"""
+	Destination folder
+	"""
+	dest: str = None
+
+	"""
+	Expected file size, zero for unknown
+	"""
+	size: int = 0
+
+	"""
+	Expected sha256 hex digest
+	"""
+	sha256: str = None
+
+	"""
+	Missing file is not an error
+	"""
+	optional: bool = False
+
+	"""
+	Download succeeded
+	"""
+	done: bool = False
+
+	@property
+	def path(self) -> str:
+		return os.path.join(self.dest, self.filename)
+
+	def __init__(
+		self,
+		filename: str,
+		urls: list[str],
+		dest: str,
+		size: int = 0,
+		sha256: str = None,
+		optional: bool = False,
+	):
+		self.filename = filename
+		self.urls = urls
+		self.dest = dest
+		self.size = size
+		self.sha256 = sha256
+		self.optional = optional
+
+
+class Downloader:
+	"""
+	Parallel HTTP downloader with per host connection reuse
+	"""
+	jobs: int
+	retry: int
+	timeout: int
+	max_redirect: int = 5
+	user_agent: str = None
+
+	def __init__(
+		self,
+		jobs: int = 8,
+		retry: int = 5,
+		timeout: int = 60,
+		profile=None,
+		on_done: callable = None,
+	):
+		self.jobs = max(1, jobs)
+		self.retry = retry
+		self.timeout = timeout
+		self.profile = profile
+		self.on_done = on_done
+		self.user_agent = os.getenv("HTTP_USER_AGENT", "arch-image-builder")
+		self.proxies = request.getproxies()
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.opened: list[client.HTTPConnection] = []
+
+	@property
+	def connections(self) -> dict[tuple[str, str], client.HTTPConnection]:
+		"""
+		Connections pool of current thread
+		"""
+		if not hasattr(self.local, "connections"):
+			self.local.connections = {}
+		return self.local.connections
+
+	def proxy_for(self, scheme: str, netloc: str) -> str | None:
+		"""
+		Get proxy url from http_proxy / https_proxy, honour no_proxy
+		"""
+		proxy = self.proxies.get(scheme)
+		if not proxy or request.proxy_bypass(urlsplit(f"//{netloc}").hostname or netloc):
+			return None
+		return proxy
+
+	def connection(self, scheme: str, netloc: str) -> client.HTTPConnection:
+		key = (scheme, netloc)
+		if key not in self.connections:
+			proxy = self.proxy_for(scheme, netloc)
+			headers: dict[str, str] = {}
+			if proxy:
+				p = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+				if p.username is not None:
+					auth = f"{unquote(p.username)}:{unquote(p.password or '')}"
+					headers["Proxy-Authorization"] = "Basic " + base64.b64encode(auth.encode()).decode()
+				target = p.hostname if p.port is None else f"{p.hostname}:{p.port}"
+			match scheme:
+				case "http" if proxy:
+					# plain http proxy takes absolute url as request target
+					conn = client.HTTPConnection(target, timeout=self.timeout)
+					conn.proxy_headers = headers
+				case "https" if proxy:
+					conn = client.HTTPSConnection(target, timeout=self.timeout)
+					conn.set_tunnel(netloc, headers=headers)
+				case "http": conn = client.HTTPConnection(netloc, timeout=self.timeout)
+				case "https": conn = client.HTTPSConnection(netloc, timeout=self.timeout)
+				case _: raise DownloadError(f"unsupported scheme {scheme}")
+			self.connections[key] = conn
+			with self.lock: self.opened.append(conn)
+		return self.connections[key]
+
+	def drop_connection(self, scheme: str, netloc: str):
+		conn = self.connections.pop((scheme, netloc), None)
+		if conn:
+			try: conn.close()
+			except: pass
+
+	def close(self):
+		"""
+		Close all connections of all threads
+		"""
+		with self.lock:
+			for conn in self.opened:
+				try: conn.close()
+				except: pass
+			self.opened.clear()
+
+	def request(self, url: str, path: str, headers: dict[str, str] = None) -> client.HTTPResponse:
+		"""
+		Download url into path, return finished response
+		"""
+		req_headers = {
+			"User-Agent": self.user_agent,
+			"Connection": "keep-alive",
+		}
+		if headers: req_headers.update(headers)
+		start = time.monotonic()
+		for _ in range(self.max_redirect + 1):
+			u = urlsplit(url)
+			if u.scheme == "file":
+				return self.request_file(unquote(u.path), path, req_headers)
+			target = u.path or "/"
+			if u.query: target += "?" + u.query
+
+			def send() -> client.HTTPResponse:
+				conn = self.connection(u.scheme, u.netloc)
+				if hasattr(conn, "proxy_headers"):
+					conn.request("GET", url.split("#")[0], headers={**req_headers, **conn.proxy_headers})
+				else:
+					conn.request("GET", target, headers=req_headers)
+				return conn.getresponse()
+
+			try:
+				resp = send()
+			except:
+				# server closed the kept connection, reconnect once
+				self.drop_connection(u.scheme, u.netloc)
+				resp = send()
+			resp.ttfb = time.monotonic() - start
+			if resp.status in (301, 302, 303, 307, 308):
+				resp.read()
+				location = resp.getheader("Location")
+				if not location: raise DownloadError(f"redirect without location from {url}")
+				url = urljoin(url, location)
+				continue
+			if resp.status != 200:
+				resp.read()
+				return resp
+			try:
+				with open(path, "wb") as f:
+					while True:
+						block = resp.read(0x100000)
+						if not block: break
+						f.write(block)
+			except:
+				self.drop_connection(u.scheme, u.netloc)
+				raise
+			if resp.will_close:
+				self.drop_connection(u.scheme, u.netloc)
+			return resp
+		raise DownloadError(f"too many redirects for {url}")
+
+	def request_file(self, src: str, path: str, headers: dict[str, str]) -> LocalResponse:
+		"""
+		Copy a local file like a HTTP request, for file:// servers
+		"""
+		if not os.path.isfile(src): return LocalResponse(404)
+		mtime = os.path.getmtime(src)
+		since = headers.get("If-Modified-Since")
+		if since and int(mtime) <= parsedate_to_datetime(since).timestamp():
+			return LocalResponse(304)
+		shutil.copyfile(src, path)
+		return LocalResponse(200, {
+			"Content-Length": str(os.path.getsize(src)),
+			"Last-Modified": formatdate(mtime, usegmt=True),
+		})
+
+	def verify(self, item: DownloadItem, path: str):
+		"""
+		Check size and checksum of downloaded file
+		"""
+		if item.size > 0:
+			size = os.path.getsize(path)
+			if size != item.size:
+				raise DownloadError(f"{item.filename} size mismatch {size} != {item.size}")
+		if item.sha256:
+			h = hashlib.sha256()
+			with open(path, "rb") as f:
+				while True:
+					block = f.read(0x100000)
+					if not block: break
+					h.update(block)
+			if h.hexdigest() != item.sha256:
+				raise DownloadError(f"{item.filename} checksum mismatch")
+
+	def fetch_one(self, item: DownloadItem) -> bool:
+		"""
+		Download one file, retry and fail over across all urls
+		"""
+		part = os.path.join(item.dest, f".{item.filename}.part")
+		missing = 0
+		for tries in range(self.retry + 1):
+			if tries > 0: time.sleep(min(2 ** tries, 30))
+			missing = 0
+			for url in item.urls:
+				try:
+					status = self.request(url, part).status
+					if status == 404:
+						missing += 1
+						continue
+					if status != 200:
+						raise DownloadError(f"http status {status}")
+					self.verify(item, part)
+					os.replace(part, item.path)
+					item.done = True
+					log.debug(f"downloaded {item.filename} from {url}")
+					return True
+				except Exception as e:
+					log.warning(f"download {url} failed: {e}")
+				finally:
+					if os.path.exists(part): os.remove(part)
+			# not found in any server, retry is useless
+			if missing == len(item.urls): break
+		if not item.optional or missing != len(item.urls):
+			log.error(f"failed to download {item.filename}")
+		return False
+
+	def fetch_modified(self, item: DownloadItem, etag: str = None, force: bool = False) -> tuple[bool, str]:
+		"""
+		Download one file only when changed on server, always when force
+		Optional file missing on all servers is removed locally
+		Return whether file changed and the new ETag
+		"""
+		headers: dict[str, str] = {}
+		if os.path.exists(item.path) and not force:
+			mtime = os.path.getmtime(item.path)
+			headers["If-Modified-Since"] = formatdate(mtime, usegmt=True)
+			if etag: headers["If-None-Match"] = etag
+		part = os.path.join(item.dest, f".{item.filename}.part")
+		for tries in range(self.retry + 1):
+			if tries > 0: time.sleep(min(2 ** tries, 30))
+			missing = 0
+			for url in item.urls:
+				try:
+					resp = self.request(url, part, headers)
+					if resp.status == 404:
+						missing += 1
+						continue
+					if resp.status == 304:
+						log.debug(f"{item.filename} not modified on {url}")
+						item.done = True
+						return False, etag
+					if resp.status != 200:
+						raise DownloadError(f"http status {resp.status}")
+					self.verify(item, part)
+					modified = resp.getheader("Last-Modified")
+					if modified:
+						mtime = parsedate_to_datetime(modified).timestamp()
+						os.utime(part, (mtime, mtime))
+					os.replace(part, item.path)
+					item.done = True
+					log.debug(f"downloaded {item.filename} from {url}")
+					return True, resp.getheader("ETag")
+				except Exception as e:
+					log.warning(f"download {url} failed: {e}")
+				finally:
+					if os.path.exists(part): os.remove(part)
+			# not found in any server, retry is useless
+			if missing == len(item.urls): break
+		if item.optional and missing == len(item.urls):
+			log.debug(f"optional {item.filename} not found on any server")
+			existed = os.path.exists(item.path)
+			if existed: os.remove(item.path)
+			return existed, None
+		raise DownloadError(f"failed to download {item.filename} from all {len(item.urls)} servers")
+
+	def fetch_modified_all(
+		self,
+		items: list[DownloadItem],
+		etags: dict[str, str],
+		force: bool = False,
+	) -> list[DownloadItem]:
+		"""
+		Download changed files in parallel, update etags by filename
+		Return changed items
+		"""
+		if len(items) <= 0: return []
+		for item in items:
+			os.makedirs(item.dest, mode=0o0755, exist_ok=True)
+		try:
+			with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+				results = list(pool.map(
+					lambda item: self.fetch_modified(item, etags.get(item.filename), force),
+					items
+				))
+		finally:
+			self.close()
+		changed: list[DownloadItem] = []
+		for item, (ok, etag) in zip(items, results):
+			if etag: etags[item.filename] = etag
+			if ok: changed.append(item)
+		return changed
+
+	def run_one(self, item: DownloadItem) -> bool:
+		if self.profile is None: ok = self.fetch_one(item)
+		else:
+			with self.profile.span("download", item.filename):
+				ok = self.fetch_one(item)
+		if ok and self.on_done: self.on_done(item)
+		return ok
+
+	def fetch(self, items: list[DownloadItem]) -> list[DownloadItem]:
+		"""
+		Download all files in parallel, return failed items
+		"""
+		if len(items) <= 0: return []
+		for item in items:
+			os.makedirs(item.dest, mode=0o0755, exist_ok=True)
+		try:
+			with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+				results = list(pool.map(self.run_one, items))
+		finally:
+			self.close()
+		return [item for item, ok in zip(items, results) if not ok and not item.optional]
@@ -1,6 +1,8 @@
 import io
 import os
+import time
 import stat
+import errno
 import fcntl
 import ctypes
 from builder.lib import utils
@@ -40,6 +42,7 @@ LOOP_CTL_GET_FREE    = 0x4C82
 LOOP_SET_STATUS_SETTABLE_FLAGS   = LO_FLAGS_AUTOCLEAR | LO_FLAGS_PARTSCAN
 LOOP_SET_STATUS_CLEARABLE_FLAGS  = LO_FLAGS_AUTOCLEAR
 LOOP_CONFIGURE_SETTABLE_FLAGS    = LO_FLAGS_READ_ONLY | LO_FLAGS_AUTOCLEAR | LO_FLAGS_PARTSCAN | LO_FLAGS_DIRECT_IO
+LOOP_BUSY_RETRY                  = 16
 
 
 class LoopInfo64(ctypes.Structure):
@@ -118,14 +121,11 @@ def loop_setup(
 ) -> str:
 	if path is None and fio is None and fd < 0:
 		raise ValueError("no source file set")
-	if no < 0:
-		if dev is None:
-			dev = loop_get_free()
-		else:
-			fn = os.path.basename(dev)
-			if fn.startswith("loop"): no = int(fn[4:])
-	loop_create_dev(no=no, dev=dev)
-	opened, loop = -1, -1
+	auto = dev is None and no < 0
+	if not auto and no < 0:
+		fn = os.path.basename(dev)
+		if fn.startswith("loop"): no = int(fn[4:])
+	opened = -1
 	if fio:
 		if fd < 0: fd = fio.fileno()
 		if path is None: path = fio.name
@@ -152,22 +152,40 @@ def loop_setup(
 			lo_file_name=file_name,
 		)
 		lc = LoopConfig(fd=fd, block_size=block_size, info=li)
-		loop = os.open(dev, os.O_RDWR)
-		if loop < 0: raise OSError(f"open loop device {dev} failed")
-		try:
-			ret = fcntl.ioctl(loop, LOOP_CONFIGURE, lc)
-			if ret != 0: raise OSError(f"configure loop device {dev} with {path} failed")
-		except OSError as e:
-			if e.errno != 22:
-				raise
-			ret = fcntl.ioctl(loop, LOOP_SET_FD, fd)
-			if ret != 0: raise OSError(f"loop set fd for device {dev} with {path} failed")
-			ret = fcntl.ioctl(loop, LOOP_SET_STATUS64, li)
-			if ret != 0: raise OSError(f"loop set status for device {dev} with {path} failed")
+		for tries in range(LOOP_BUSY_RETRY):
+			if auto: dev = loop_get_free()
+			loop_create_dev(no=no, dev=dev)
+			if loop_configure(dev, path, fd, lc, li, auto):
+				return dev
+
+			# another builder took this free loop device, pick next one
+			time.sleep(0.1 * (tries + 1))
+		raise OSError(errno.EBUSY, f"no free loop device for {path}")
 	finally:
-		if loop >= 0: os.close(loop)
 		if opened >= 0: os.close(opened)
-	return dev
+
+
+def loop_configure(dev: str, path: str, fd: int, lc: LoopConfig, li: LoopInfo64, auto: bool) -> bool:
+	"""
+	Attach fd to loop device, return False when an auto picked device is busy
+	"""
+	loop = os.open(dev, os.O_RDWR)
+	if loop < 0: raise OSError(f"open loop device {dev} failed")
+	try:
+		ret = fcntl.ioctl(loop, LOOP_CONFIGURE, lc)
+		if ret != 0: raise OSError(f"configure loop device {dev} with {path} failed")
+	except OSError as e:
+		if e.errno == errno.EBUSY and auto:
+			return False
+		if e.errno != errno.EINVAL:
+			raise
+		ret = fcntl.ioctl(loop, LOOP_SET_FD, fd)
+		if ret != 0: raise OSError(f"loop set fd for device {dev} with {path} failed")
+		ret = fcntl.ioctl(loop, LOOP_SET_STATUS64, li)
+		if ret != 0: raise OSError(f"loop set status for device {dev} with {path} failed")
+	finally:
+		os.close(loop)
+	return True
 
 
 def loop_get_sysfs(dev: str) -> str:
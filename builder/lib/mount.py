@@ -385,6 +385,19 @@ class MountTab(list[MountPoint], SerializableList):
 		root = os.path.realpath(folder)
 		return [mnt for mnt in self if mnt.target.startswith(root)]
 
+	def find_path(self, path: str) -> MountPoint | None:
+		"""
+		Find mount point which contains path
+		"""
+		real = os.path.realpath(path)
+		ret: MountPoint = None
+		for mnt in self:
+			if real != mnt.target and not real.startswith(mnt.target.rstrip("/") + "/"):
+				continue
+			if ret is None or len(mnt.target) >= len(ret.target):
+				ret = mnt
+		return ret
+
 	def find_target(self, target: str) -> Self: return [mnt for mnt in self if mnt.target == target]
 	def find_source(self, source: str) -> Self: return [mnt for mnt in self if mnt.source == source]
 	def find_fstype(self, fstype: str) -> Self: return [mnt for mnt in self if mnt.fstype == fstype]
@@ -0,0 +1,112 @@
+import os
+import time
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from builder.lib import json
+from builder.lib.utils import file_lock
+from builder.lib.download import Downloader
+log = getLogger(__name__)
+
+
+def url_host(url: str) -> str:
+	"""
+	Get scheme and host of url as cache key
+	url_host("https://mirrors.bfsu.edu.cn/archlinux/core/os/x86_64") = "https://mirrors.bfsu.edu.cn"
+	"""
+	u = urlsplit(url)
+	return f"{u.scheme}://{u.netloc}"
+
+
+class MirrorProbe:
+	"""
+	Measure time to first byte and throughput of mirror hosts
+
+	Results are cached per host in a json file and reused until ttl,
+	a failed host gets an infinite score and is sorted to the end,
+	local (non http) hosts are never probed and always sorted first.
+	"""
+	path: str
+	ttl: int
+	size: int = 0x10000
+	timeout: int = 10
+
+	def __init__(self, path: str, ttl: int = 3600):
+		self.path = path
+		self.ttl = ttl
+
+	def load(self) -> dict[str, dict]:
+		if not os.path.exists(self.path): return {}
+		try:
+			with open(self.path, "r") as f:
+				return json.load(f)
+		except:
+			log.warning(f"failed to load mirror probes {self.path}", exc_info=True)
+			return {}
+
+	def save(self, results: dict[str, dict]):
+		tmp = f"{self.path}.tmp"
+		with open(tmp, "w") as f:
+			json.dump(results, f, indent=2)
+		os.replace(tmp, self.path)
+
+	def probe(self, url: str) -> dict:
+		"""
+		Fetch first bytes of url by a range request
+		"""
+		dl = Downloader(jobs=1, retry=0, timeout=self.timeout)
+		result = {"time": time.time(), "url": url}
+		try:
+			start = time.monotonic()
+			resp = dl.request(url, os.devnull, {"Range": f"bytes=0-{self.size - 1}"})
+			total = time.monotonic() - start
+			if resp.status not in (200, 206):
+				raise OSError(f"http status {resp.status}")
+			ttfb = resp.ttfb
+			length = int(resp.getheader("Content-Length") or self.size)
+			result["ttfb"] = ttfb
+			log.debug(f"probe {url} ttfb {ttfb * 1000:.0f}ms")
+
+			# too small file to measure throughput
+			if length >= self.size:
+				result["throughput"] = length / max(total - ttfb, 0.001)
+				log.debug(f"probe {url} speed {result['throughput'] / 1024:.0f}KiB/s")
+		except Exception as e:
+			log.debug(f"probe {url} failed: {e}")
+			result["error"] = str(e)
+		finally:
+			dl.close()
+		return result
+
+	@staticmethod
+	def score(result: dict) -> float:
+		"""
+		Estimated seconds to fetch 1MiB, lower is better
+		"""
+		if result is None or "error" in result: return float("inf")
+		if "throughput" not in result: return result["ttfb"]
+		return result["ttfb"] + 0x100000 / max(result["throughput"], 1)
+
+	def scores(self, urls: dict[str, str]) -> dict[str, float]:
+		"""
+		Probe hosts (host to probe url) not cached or expired
+		Return score of every host
+		"""
+		local = {host: 0.0 for host in urls if not host.startswith(("http://", "https://"))}
+		urls = {host: url for host, url in urls.items() if host not in local}
+		if len(urls) <= 0: return local
+		with file_lock(f"{self.path}.lock"):
+			results = self.load()
+			now = time.time()
+			expired = [
+				host for host in urls
+				if host not in results or now - results[host]["time"] > self.ttl
+			]
+			if expired:
+				log.info(f"probing {len(expired)} mirrors")
+				with ThreadPoolExecutor(max_workers=len(expired)) as pool:
+					probes = pool.map(self.probe, (urls[host] for host in expired))
+					for host, result in zip(expired, probes):
+						results[host] = result
+				self.save(results)
+		return {**local, **{host: self.score(results.get(host)) for host in urls}}
@@ -0,0 +1,263 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from logging import getLogger
+from builder.lib import json
+from builder.lib.cgroup import CGroup
+from builder.lib.serializable import SerializableDict
+log = getLogger(__name__)
+
+
+def stat_delta(old: dict[str, int], new: dict[str, int]) -> dict[str, int]:
+	"""
+	Calculate difference of two cgroup stats
+	"""
+	return {key: new[key] - old.get(key, 0) for key in new}
+
+
+class ProfileSpan(SerializableDict):
+	"""
+	Category of span (hook, stage, command, ...)
+	"""
+	category: str = None
+
+	"""
+	Name of span
+	"""
+	name: str = None
+
+	"""
+	Start time in seconds since build start
+	"""
+	start: float = 0
+
+	"""
+	Wall time in seconds
+	"""
+	duration: float = 0
+
+	"""
+	Nested level in current thread
+	"""
+	depth: int = 0
+
+	"""
+	Process and thread id which run this span
+	"""
+	pid: int = 0
+	tid: int = 0
+
+	"""
+	Extra values
+	"""
+	args: dict = None
+
+	"""
+	CPU and I/O usage delta of build cgroup
+	"""
+	cpu: dict = None
+	io: dict = None
+
+	"""
+	Process ids spawned in this span
+	"""
+	pids: list[int] = None
+
+	def to_dict(self) -> dict:
+		return {
+			"category": self.category,
+			"name": self.name,
+			"start": self.start,
+			"duration": self.duration,
+			"depth": self.depth,
+			"pid": self.pid,
+			"tid": self.tid,
+			"args": self.args,
+			"cpu": self.cpu,
+			"io": self.io,
+			"pids": self.pids,
+		}
+
+	def to_trace(self) -> dict:
+		"""
+		Convert to a complete event of Chrome trace event format
+		"""
+		args = dict(self.args)
+		if self.pids: args["pids"] = self.pids
+		if self.cpu: args["cpu"] = self.cpu
+		if self.io: args["io"] = self.io
+		return {
+			"name": self.name,
+			"cat": self.category,
+			"ph": "X",
+			"ts": int(self.start * 1000000),
+			"dur": int(self.duration * 1000000),
+			"pid": self.pid,
+			"tid": self.tid,
+			"args": args,
+		}
+
+	def __init__(self, category: str, name: str, args: dict = None):
+		self.category = category
+		self.name = name
+		self.args = args if args else {}
+		self.pids = []
+		self.pid = os.getpid()
+		self.tid = threading.get_native_id()
+
+
+class BuildProfile:
+	"""
+	Wall time of stages and external commands, with cgroup usage
+	"""
+	cgroup: CGroup
+	spans: list[ProfileSpan]
+	started: float
+	wall: float
+	totals: dict = None
+
+	def __init__(self, cgroup: CGroup = None):
+		self.cgroup = cgroup
+		self.spans = []
+		self.started = time.monotonic()
+		self.wall = time.time()
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.cpu = self.read_stat("cpu.stat")
+		self.io = self.read_stat("io.stat")
+
+	def read_stat(self, name: str) -> dict[str, int]:
+		if self.cgroup is None: return {}
+		try: return self.cgroup.read_stat(name)
+		except: return {}
+
+	def list_pid(self) -> set[int]:
+		if self.cgroup is None: return set()
+		try: return set(self.cgroup.list_pid())
+		except: return set()
+
+	def add_pid(self, pid: int):
+		"""
+		Add a spawned process id to all running spans in current thread
+		"""
+		for span in self.stack:
+			if pid not in span.pids:
+				span.pids.append(pid)
+
+	@property
+	def stack(self) -> list[ProfileSpan]:
+		if not hasattr(self.local, "stack"):
+			self.local.stack = []
+		return self.local.stack
+
+	@contextmanager
+	def span(self, category: str, name: str, **args):
+		"""
+		Measure a block of code
+		with ctx.profile.span("stage", "locale"): ...
+		"""
+		span = ProfileSpan(category, name, args)
+		span.depth = len(self.stack)
+		cpu = self.read_stat("cpu.stat")
+		io = self.read_stat("io.stat")
+		pids = self.list_pid()
+		self.stack.append(span)
+		start = time.monotonic()
+		span.start = start - self.started
+		try:
+			yield span
+		finally:
+			span.duration = time.monotonic() - start
+			span.cpu = stat_delta(cpu, self.read_stat("cpu.stat"))
+			span.io = stat_delta(io, self.read_stat("io.stat"))
+
+			# daemons spawned in this span still alive in cgroup
+			for pid in sorted(self.list_pid() - pids):
+				if pid not in span.pids:
+					span.pids.append(pid)
+			self.stack.pop()
+			with self.lock:
+				self.spans.append(span)
+
+	def summary(self) -> dict:
+		"""
+		Total wall time by category and by command program
+		"""
+		categories: dict[str, float] = {}
+		programs: dict[str, float] = {}
+		for span in self.spans:
+			if span.depth == 0:
+				categories[span.category] = categories.get(span.category, 0) + span.duration
+			if span.category == "command":
+				programs[span.name] = programs.get(span.name, 0) + span.duration
+		return {
+			"categories": categories,
+			"programs": dict(sorted(programs.items(), key=lambda i: i[1], reverse=True)),
+		}
+
+	def finish(self):
+		"""
+		Record total usage of cgroup before it destroyed
+		"""
+		if self.totals is not None: return
+		self.totals = {
+			"cpu": stat_delta(self.cpu, self.read_stat("cpu.stat")),
+			"io": stat_delta(self.io, self.read_stat("io.stat")),
+		}
+
+	def to_dict(self) -> dict:
+		self.finish()
+		return {
+			"start": self.wall,
+			"duration": time.monotonic() - self.started,
+			"cpu": self.totals["cpu"],
+			"io": self.totals["io"],
+			"summary": self.summary(),
+			"spans": sorted(self.spans, key=lambda s: s.start),
+		}
+
+	def to_trace(self) -> dict:
+		"""
+		Convert to Chrome trace event format (load in Perfetto or chrome://tracing)
+		"""
+		events: list[dict] = []
+		threads: set[tuple[int, int]] = set()
+		for span in sorted(self.spans, key=lambda s: (s.start, -s.duration)):
+			events.append(span.to_trace())
+			threads.add((span.pid, span.tid))
+		for pid, tid in sorted(threads):
+			events.append({
+				"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+				"args": {"name": "main" if pid == tid else f"worker {tid}"},
+			})
+		pids = set(pid for pid, _ in threads)
+		for pid in sorted(pids):
+			events.append({
+				"name": "process_name", "ph": "M", "pid": pid,
+				"args": {"name": "arch-image-builder"},
+			})
+		return {
+			"traceEvents": events,
+			"displayTimeUnit": "ms",
+			"otherData": {"start": self.wall},
+		}
+
+	def save_trace(self, path: str):
+		"""
+		Write Chrome trace event json
+		"""
+		folder = os.path.dirname(path)
+		if folder: os.makedirs(folder, mode=0o0755, exist_ok=True)
+		with open(path, "w") as f:
+			json.dump(self.to_trace(), f)
+		log.info(f"wrote build trace {path}")
+
+	def save(self, path: str):
+		"""
+		Write profile as json
+		"""
+		os.makedirs(os.path.dirname(path), mode=0o0755, exist_ok=True)
+		with open(path, "w") as f:
+			json.dump(self.to_dict(), f, indent=2)
+		log.info(f"wrote build profile {path}")
@@ -0,0 +1,302 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import libarchive
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import unquote
+from logging import getLogger
+from builder.lib.utils import file_lock, hash_file
+from builder.lib.download import Downloader, DownloadItem
+log = getLogger(__name__)
+
+
+def database_checksums(path: str) -> dict[str, tuple[int, str]]:
+	"""
+	Read package files sizes and sha256 checksums from a sync database
+	"""
+	sums: dict[str, tuple[int, str]] = {}
+	with libarchive.file_reader(path) as archive:
+		for entry in archive:
+			if not entry.pathname.endswith("/desc"): continue
+			fields: dict[str, list[str]] = {}
+			key = None
+			for line in b"".join(entry.get_blocks()).decode().splitlines():
+				if line.startswith("%") and line.endswith("%"):
+					key = line[1:-1]
+					fields[key] = []
+				elif key and line:
+					fields[key].append(line)
+			if "FILENAME" not in fields or "SHA256SUM" not in fields: continue
+			size = int(fields.get("CSIZE", ["0"])[0])
+			sums[fields["FILENAME"][0]] = (size, fields["SHA256SUM"][0])
+	return sums
+
+
+def is_cacheable(filename: str) -> bool:
+	"""
+	Files served by mirror proxy
+	"""
+	if "/" in filename or filename.startswith("."): return False
+	if filename.endswith((".db", ".db.sig")): return True
+	if ".pkg.tar." in filename: return True
+	return False
+
+
+class MirrorProxy:
+	"""
+	Caching HTTP proxy for pacman repos
+
+	Serves http://127.0.0.1:PORT/REPO/FILE from a local store, misses
+	are fetched from upstream servers of the repo only once, requests
+	in same process wait the running fetch, other builds sharing the
+	store wait the file lock. Packages are checked against size and
+	sha256 in cached repo databases before served, packages unknown by
+	databases are served as is and checked by pacman at install time.
+	"""
+	store: str
+	upstreams: dict[str, list[str]]
+	port: int = 0
+	db_ttl: int = 60
+
+	def __init__(self, store: str, retry: int = 5, timeout: int = 60):
+		self.store = os.path.realpath(store)
+		self.upstreams = {}
+		self.downloader = Downloader(jobs=1, retry=retry, timeout=timeout)
+		self.tasks: dict[str, asyncio.Future] = {}
+		self.loop: asyncio.AbstractEventLoop = None
+		self.server: asyncio.Server = None
+		self.thread: threading.Thread = None
+		self.checksums: dict[str, tuple[tuple, dict]] = {}
+		self.verified: dict[str, tuple[int, int]] = {}
+		self.lock = threading.Lock()
+		os.makedirs(self.store, mode=0o0755, exist_ok=True)
+
+	@property
+	def url(self) -> str:
+		return f"http://127.0.0.1:{self.port}"
+
+	def repo_url(self, repo: str) -> str:
+		return f"{self.url}/{repo}"
+
+	def add_repo(self, repo: str, urls: list[str]):
+		self.upstreams[repo] = [url.rstrip("/") for url in urls]
+
+	def cache_path(self, repo: str, filename: str) -> str:
+		"""
+		Packages are shared by all repos, databases stored per upstream
+		"""
+		if ".pkg.tar." in filename:
+			return os.path.join(self.store, "packages", filename)
+		upstream = "\n".join(self.upstreams[repo])
+		key = hashlib.sha256(upstream.encode()).hexdigest()[:16]
+		return os.path.join(self.store, "databases", f"{repo}-{key}", filename)
+
+	def expected(self, repo: str, filename: str) -> tuple[int, str] | None:
+		"""
+		Find size and sha256 of a package in cached databases of repo
+		"""
+		folder = os.path.dirname(self.cache_path(repo, f"{repo}.db"))
+		path = os.path.join(folder, f"{repo}.db")
+		if not os.path.exists(path): return None
+		st = os.stat(path)
+		stamp = (st.st_mtime_ns, st.st_size)
+		with self.lock:
+			cached = self.checksums.get(path)
+			if cached is None or cached[0] != stamp:
+				try: cached = (stamp, database_checksums(path))
+				except Exception as e:
+					log.warning(f"failed to read proxy database {path}: {e}")
+					cached = (stamp, {})
+				self.checksums[path] = cached
+		return cached[1].get(filename)
+
+	def check_package(self, path: str, expect: tuple[int, str]) -> bool:
+		"""
+		Check a cached package file, verified files are remembered by stamp
+		"""
+		st = os.stat(path)
+		stamp = (st.st_mtime_ns, st.st_size)
+		if self.verified.get(path) == stamp: return True
+		size, sha256 = expect
+		if (size > 0 and st.st_size != size) or hash_file(path) != sha256:
+			return False
+		self.verified[path] = stamp
+		return True
+
+	def fetch(self, repo: str, filename: str) -> str | None:
+		"""
+		Fetch file from upstream into store, run in executor thread
+		"""
+		path = self.cache_path(repo, filename)
+		folder = os.path.dirname(path)
+		os.makedirs(folder, mode=0o0755, exist_ok=True)
+		with file_lock(os.path.join(folder, f".{filename}.lock")):
+			item = DownloadItem(
+				filename,
+				[f"{url}/{filename}" for url in self.upstreams[repo]],
+				folder,
+				optional=filename.endswith(".sig"),
+			)
+			expect = None
+			if ".pkg.tar." in filename and not filename.endswith(".sig"):
+				expect = self.expected(repo, filename)
+				if expect: item.size, item.sha256 = expect
+			if ".pkg.tar." in filename:
+				# packages never change, fetch only once
+				if os.path.exists(path):
+					if expect is None or self.check_package(path, expect): return path
+					log.warning(f"proxy cached {filename} mismatch checksum, fetch again")
+					os.remove(path)
+				return path if self.downloader.fetch_one(item) else None
+
+			# databases revalidated at most once in ttl
+			stamp = os.path.join(folder, f".{filename}.etag")
+			if os.path.exists(stamp) and os.path.exists(path):
+				if time.time() - os.path.getmtime(stamp) < self.db_ttl:
+					return path
+			etag = None
+			if os.path.exists(stamp):
+				with open(stamp, "r") as f:
+					etag = f.read().strip() or None
+			try:
+				_, etag = self.downloader.fetch_modified(item, etag)
+			except Exception as e:
+				log.warning(f"proxy fetch {filename} failed: {e}")
+				return path if os.path.exists(path) else None
+			with open(stamp, "w") as f:
+				f.write(etag or "")
+			return path
+
+	async def ensure(self, repo: str, filename: str) -> str | None:
+		"""
+		Fetch a file, concurrent requests share one fetch
+		"""
+		key = f"{repo}/{filename}"
+		if key not in self.tasks:
+			future = self.loop.run_in_executor(None, self.fetch, repo, filename)
+			self.tasks[key] = future
+			future.add_done_callback(lambda _: self.tasks.pop(key, None))
+		return await asyncio.shield(self.tasks[key])
+
+	async def respond(
+		self,
+		writer: asyncio.StreamWriter,
+		status: int,
+		reason: str,
+		headers: dict[str, str] = None,
+	):
+		lines = [f"HTTP/1.1 {status} {reason}\r\n"]
+		if headers is None: headers = {"Content-Length": "0"}
+		for key, value in headers.items():
+			lines.append(f"{key}: {value}\r\n")
+		lines.append("\r\n")
+		writer.write("".join(lines).encode())
+		await writer.drain()
+
+	async def serve(self, writer: asyncio.StreamWriter, method: str, target: str, headers: dict[str, str]):
+		"""
+		Serve one request
+		"""
+		parts = unquote(target.split("?")[0]).lstrip("/").split("/")
+		if method not in ("GET", "HEAD"):
+			await self.respond(writer, 405, "Method Not Allowed")
+			return
+		if len(parts) != 2 or parts[0] not in self.upstreams or not is_cacheable(parts[1]):
+			await self.respond(writer, 404, "Not Found")
+			return
+		repo, filename = parts
+		try:
+			path = await self.ensure(repo, filename)
+		except Exception as e:
+			log.warning(f"proxy fetch {repo}/{filename} failed: {e}")
+			path = None
+		if path is None or not os.path.exists(path):
+			await self.respond(writer, 404, "Not Found")
+			return
+
+		st = os.stat(path)
+		since = headers.get("if-modified-since")
+		if since:
+			try:
+				if int(st.st_mtime) <= parsedate_to_datetime(since).timestamp():
+					await self.respond(writer, 304, "Not Modified")
+					return
+			except (TypeError, ValueError): pass
+		await self.respond(writer, 200, "OK", {
+			"Content-Length": str(st.st_size),
+			"Content-Type": "application/octet-stream",
+			"Last-Modified": formatdate(st.st_mtime, usegmt=True),
+		})
+		if method == "HEAD": return
+		with open(path, "rb") as f:
+			await self.loop.sendfile(writer.transport, f)
+
+	async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		"""
+		Handle a keep-alive client connection
+		"""
+		try:
+			while True:
+				line = await reader.readline()
+				if not line: break
+				req = line.decode("latin-1").split()
+				if len(req) != 3: break
+				headers: dict[str, str] = {}
+				while True:
+					line = await reader.readline()
+					if line in (b"\r\n", b"\n", b""): break
+					key, _, value = line.decode("latin-1").partition(":")
+					headers[key.strip().lower()] = value.strip()
+				await self.serve(writer, req[0], req[1], headers)
+				if headers.get("connection", "").lower() == "close": break
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+	def start(self):
+		"""
+		Start proxy in a background thread
+		"""
+		started = threading.Event()
+		error: list[BaseException] = []
+
+		def run():
+			self.loop = asyncio.new_event_loop()
+			try:
+				self.server = self.loop.run_until_complete(
+					asyncio.start_server(self.handle, "127.0.0.1", self.port)
+				)
+				self.port = self.server.sockets[0].getsockname()[1]
+			except BaseException as e:
+				error.append(e)
+				self.loop.close()
+				return
+			finally:
+				started.set()
+			self.loop.run_forever()
+			self.server.close()
+			self.loop.run_until_complete(self.server.wait_closed())
+			self.loop.close()
+
+		self.thread = threading.Thread(target=run, name="mirror-proxy", daemon=True)
+		self.thread.start()
+		started.wait()
+		if error:
+			self.thread.join()
+			self.thread = None
+			raise OSError(f"start mirror proxy failed: {error[0]}") from error[0]
+		log.info(f"mirror proxy listening on {self.url} with store {self.store}")
+
+	def stop(self):
+		"""
+		Stop proxy and wait the thread exit
+		"""
+		if self.thread is None: return
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.thread = None
+		self.downloader.close()
+		log.debug("mirror proxy stopped")
@@ -1,3 +1,5 @@
+from copy import deepcopy
+from functools import lru_cache
 from builder.lib.utils import str_find_all
 from logging import getLogger
 log = getLogger(__name__)
@@ -9,36 +11,51 @@ class SubScriptValue:
 	original: str = None
 	default: str = None
 	incomplete: bool = False
+	join: bool = False
+	use_default: bool = False
 
 	def __str__(self): return self.content
 	def __repr__(self): return self.content
 
 
-def dict_get(key: str, root: dict):
-	def get_token(node, k):
-		if node is None: return None
-		nt = type(node)
-		if nt is list: return node.get(int(k), None)
-		elif nt is tuple: return node.get(int(k), None)
-		elif nt is dict: return node.get(k, None)
-		else: raise KeyError(f"unsupported get in {nt.__name__}")
+@lru_cache(maxsize=4096)
+def compile_path(key: str) -> tuple[str, ...]:
+	"""
+	Split key path into tokens, cached for repeated lookups
+	compile_path("a.b[0].c") = ("a", "b", "0", "c")
+	"""
 	keys = ["[", "."]
-	node = root
+	tokens: list[str] = []
 	while len(key) > 0:
 		if key[0] == "[":
 			p = key.find("]", 1)
 			if p < 0: raise ValueError("missing ]")
-			node = get_token(node, key[1:p])
+			tokens.append(key[1:p])
 			key = key[p + 1:]
 			continue
 		if key[0] == ".":
 			key = key[1:]
 			continue
 		p = str_find_all(key, keys)
-		k = key[:p] if p >= 0 else key
-		node = get_token(node, k)
-		if p < 0: return node
-		key = key[p + 1:]
+		if p < 0:
+			tokens.append(key)
+			break
+		tokens.append(key[:p])
+		key = key[p:]
+	return tuple(tokens)
+
+
+def dict_get(key: str, root: dict):
+	node = root
+	for token in compile_path(key):
+		if node is None: return None
+		nt = type(node)
+		if nt is dict:
+			node = node.get(token, None)
+		elif nt is list or nt is tuple:
+			idx = int(token)
+			node = node[idx] if 0 <= idx < len(node) else None
+		else: raise KeyError(f"unsupported get in {nt.__name__}")
 	return node
 
 
@@ -49,19 +66,49 @@ def resolve_simple_values(original: str, values: dict) -> str:
 	return value
 
 
+def split_path(path: str) -> tuple[str, str | int]:
+	"""
+	Split value path into parent path and key
+	split_path("a.b[1]") = ("a.b", 1)
+	split_path("a.b") = ("a", "b")
+	"""
+	if path.endswith("]"):
+		p = path.rfind("[")
+		return path[:p], int(path[p + 1:-1])
+	p = path.rfind(".")
+	if p < 0: return "", path
+	return path[:p], path[p + 1:]
+
+
 class SubScript:
+	"""
+	Resolve ${...} references in config tree by a dependency graph
+
+	Tree is scanned once, every value path depends on its children and
+	a string depends on all paths it references, then all values are
+	resolved in topological order. Defaults are used for missing paths,
+	or to break cycles when nothing else can be resolved.
+	Graph is kept after parse, so a changed subtree only re-resolves
+	values depend on it.
+	"""
 	root: dict
-	resolved: list[str]
-	unresolved: list[str]
-	count: int
+	resolved: set[str]
+	unresolved: set[str]
+	nodes: dict[str, tuple[dict | list, str | int]]
+	parts: dict[str, list[str | SubScriptValue]]
+	depends: dict[str, set[str]]
+	pending: dict[str, set[str]]
+	dependents: dict[str, set[str]]
 
-	def resolve_token(self, token: str) -> SubScriptValue:
+	def parse_token(self, token: str) -> SubScriptValue:
+		"""
+		Parse token inside ${}, [@]path[:default]
+		"""
 		val = SubScriptValue()
 		val.original = token
-		lstr = False
 		if token[0] == "@":
 			token = token[1:]
-			lstr = True
+			val.join = True
 		if ":" in token:
 			bval = token.split(":")
 			if len(bval) != 2:
@@ -69,105 +116,304 @@ class SubScript:
 			token = bval[0]
 			val.default = bval[1]
 		val.token = token
-		if token not in self.unresolved:
-			self.unresolved.append(token)
-		value = dict_get(token, self.root)
-		if token not in self.resolved:
-			val.incomplete = True
-			return val
-		if lstr:
-			vt = type(value)
-			if vt is list: value = " ".join(value)
-			else: raise ValueError(f"@ not support for {vt.__name__}")
-		self.unresolved.remove(token)
-		val.content = value
 		return val
 
-	def process(self, content: str, lvl: str, use_def: bool) -> SubScriptValue:
+	def split(self, content: str, lvl: str) -> list[str | SubScriptValue]:
+		"""
+		Split string into literal texts and tokens
+		"""
+		parts: list[str | SubScriptValue] = []
 		last = 0
-		ret = SubScriptValue()
-		ret.original = content
-		ret.content = content
-		while last < len(content):
-			last = content.find("$", last)
-			if last < 0: break
-			if content[last:last + 2] == "$$":
-				content = content[:last] + content[last + 1:]
-				last += 1
+		while True:
+			pos = content.find("$", last)
+			if pos < 0: break
+			if content[pos:pos + 2] == "$$":
+				parts.append(content[last:pos + 1])
+				last = pos + 2
 				continue
-			if len(content) <= last + 2 or content[last + 1] != "{":
+			if len(content) <= pos + 2 or content[pos + 1] != "{":
 				raise ValueError(f"unexpected token in subscript at {lvl}")
-			tp = content.find("}", last + 1)
+			tp = content.find("}", pos + 1)
 			if tp < 0: raise ValueError(f"missing }} in subscript at {lvl}")
-			token = content[last + 2: tp]
-			val = self.resolve_token(token)
-			if val.incomplete:
-				if use_def and val.default is not None:
-					value = val.default
-				else:
-					ret.incomplete = True
-					return ret
-			else:
-				value = val.content
-			value = str(value)
-			content = content[:last] + value + content[tp + 1:]
-			last += len(value)
-		ret.content = content
-		return ret
-
-	def parse_rec(self, node: dict | list, level: str, use_def: bool=False) -> bool:
-		def process_one(key, lvl):
-			value = node[key]
-			vt = type(value)
-			if vt is dict or vt is list:
-				if not self.parse_rec(value, lvl, use_def):
-					return False
-			elif vt is str:
-				val = self.process(value, lvl, use_def)
-				if val.incomplete:
-					return False
-				node[key] = val.content
-			self.resolved.append(lvl)
-			self.count += 1
-			return True
-		ret = True
+			parts.append(content[last:pos])
+			parts.append(self.parse_token(content[pos + 2:tp]))
+			last = tp + 1
+		parts.append(content[last:])
+		return parts
+
+	def scan_one(self, node: dict | list, key: str | int, lvl: str, found: list[str]):
+		"""
+		Record one value path and all paths under it into found
+		"""
+		self.nodes[lvl] = (node, key)
+		found.append(lvl)
+		value = node[key]
+		vt = type(value)
+		if vt is dict or vt is list:
+			self.depends[lvl] = set(self.scan(value, lvl, found))
+		else:
+			self.depends[lvl] = set()
+			if vt is str and "$" in value:
+				self.parts[lvl] = self.split(value, lvl)
+
+	def scan(self, node: dict | list, level: str, found: list[str]) -> list[str]:
+		"""
+		Record all values paths under node into found, return paths of children
+		"""
 		nt = type(node)
 		if nt is dict:
-			for key in node:
-				lvl = f"{level}.{key}" if len(level) > 0 else key
-				if lvl in self.resolved: continue
-				if not process_one(key, lvl): ret = False
+			items = [(key, f"{level}.{key}" if len(level) > 0 else key) for key in node]
 		elif nt is list or nt is tuple:
-			for idx in range(len(node)):
-				lvl = f"{level}[{idx}]"
-				if lvl in self.resolved: continue
-				if not process_one(idx, lvl): ret = False
+			items = [(idx, f"{level}[{idx}]") for idx in range(len(node))]
 		else: raise ValueError(f"unknown input value at {level}")
-		return ret
+		for key, lvl in items:
+			self.scan_one(node, key, lvl, found)
+		return [lvl for _, lvl in items]
+
+	def link(self, paths: list[str]):
+		"""
+		Add references of strings and children into dependency graph
+		"""
+		for lvl in paths:
+			for dep in self.depends[lvl]:
+				self.dependents.setdefault(dep, set()).add(lvl)
+			if lvl not in self.parts: continue
+			for part in self.parts[lvl]:
+				if type(part) is str: continue
+				self.dependents.setdefault(part.token, set()).add(lvl)
+				self.depends[lvl].add(part.token)
+
+	def reset_defaults(self, lvl: str):
+		"""
+		Use defaults only for references to missing paths
+		"""
+		for part in self.parts.get(lvl, []):
+			if type(part) is str: continue
+			part.use_default = part.token not in self.nodes and part.default is not None
+
+	def prepare(self, paths: list[str]) -> list[str]:
+		"""
+		Mark values as unresolved, return values ready to resolve
+		"""
+		ready: list[str] = []
+		for lvl in paths:
+			self.resolved.discard(lvl)
+		for lvl in paths:
+			self.reset_defaults(lvl)
+			pending = set()
+			for dep in self.depends[lvl]:
+				if dep in self.resolved: continue
+				if dep not in self.nodes:
+					# missing path with default is never waited
+					parts = [part for part in self.parts.get(lvl, []) if type(part) is not str]
+					if all(part.use_default for part in parts if part.token == dep): continue
+					self.unresolved.add(dep)
+				pending.add(dep)
+			self.pending[lvl] = pending
+			if len(pending) <= 0: ready.append(lvl)
+		return ready
+
+	def value_of(self, val: SubScriptValue) -> str:
+		"""
+		Get string value of a token, referenced path is already resolved
+		"""
+		if val.use_default: return val.default
+		node, key = self.nodes[val.token]
+		value = node[key]
+		if val.join:
+			vt = type(value)
+			if vt is list: value = " ".join(value)
+			else: raise ValueError(f"@ not support for {vt.__name__}")
+		return str(value)
+
+	def resolve_one(self, lvl: str):
+		"""
+		Resolve a value which all dependencies resolved
+		"""
+		if lvl in self.parts:
+			node, key = self.nodes[lvl]
+			node[key] = "".join(
+				part if type(part) is str else self.value_of(part)
+				for part in self.parts[lvl]
+			)
+		self.resolved.add(lvl)
+
+	def run(self, ready: list[str]):
+		"""
+		Resolve values in topological order from ready values
+		"""
+		while ready:
+			lvl = ready.pop()
+			if lvl in self.resolved: continue
+			self.resolve_one(lvl)
+			for dep in self.dependents.get(lvl, ()):
+				pending = self.pending.get(dep)
+				if pending is None or lvl not in pending: continue
+				pending.discard(lvl)
+				if len(pending) <= 0: ready.append(dep)
+
+	def use_default(self, remain: list[str]) -> list[str]:
+		"""
+		Use defaults for unresolved references until a string is ready,
+		return new ready values
+		"""
+		for lvl in remain:
+			if lvl not in self.parts: continue
+			pending = self.pending[lvl]
+			parts = [
+				part for part in self.parts[lvl]
+				if type(part) is not str and part.default is not None and part.token in pending
+			]
+			if len(parts) <= 0: continue
+			for part in parts:
+				part.use_default = True
+				pending.discard(part.token)
+			if len(pending) <= 0: return [lvl]
+		return []
+
+	def find_cycle(self, remain: list[str]) -> list[str] | None:
+		"""
+		Find a references cycle in unresolved values
+		"""
+		state: dict[str, int] = {}
+		for start in remain:
+			if start in state: continue
+			stack = [(start, iter(sorted(self.pending.get(start, ()))))]
+			path = [start]
+			state[start] = 1
+			while stack:
+				lvl, deps = stack[-1]
+				dep = next(deps, None)
+				if dep is None:
+					state[lvl] = 2
+					stack.pop()
+					path.pop()
+					continue
+				if state.get(dep) == 1:
+					return path[path.index(dep):] + [dep]
+				if dep in state: continue
+				state[dep] = 1
+				path.append(dep)
+				stack.append((dep, iter(sorted(self.pending.get(dep, ())))))
+		return None
 
 	def dump_unresolved(self):
-		for key in self.unresolved:
+		for key in sorted(self.unresolved):
 			log.warning(f"value {key} unresolved")
 
-	def parse(self, root: dict):
-		self.root = root
-		use_def = False
-		while True:
-			self.count = 0
-			ret = self.parse_rec(root, "", use_def)
-			if ret: break
-			if self.count > 0:
-				continue
-			if len(self.unresolved) == 0:
-				break
-			if not use_def:
-				use_def = True
-				continue
+	def finish(self, paths: list[str]):
+		"""
+		Resolve values, break cycles by defaults, report unresolvable values
+		"""
+		self.unresolved.clear()
+		self.run(self.prepare(paths))
+		remain = [lvl for lvl in paths if lvl not in self.resolved]
+		while remain:
+			# break references cycles by defaults one by one
+			ready = self.use_default(remain)
+			if len(ready) <= 0: break
+			self.run(ready)
+			remain = [lvl for lvl in remain if lvl not in self.resolved]
+		if remain:
+			cycle = self.find_cycle(remain)
 			self.dump_unresolved()
+			if cycle:
+				raise ValueError(f"subscript references cycle: {' -> '.join(cycle)}")
 			raise ValueError("some value cannot be resolved")
 		self.dump_unresolved()
 
+	def parse(self, root: dict):
+		self.root = root
+		paths: list[str] = []
+		self.scan(root, "", paths)
+		self.link(paths)
+		self.finish(paths)
+
+	def subtree(self, path: str) -> list[str]:
+		"""
+		Paths of value and all values under it
+		"""
+		paths = [path]
+		for lvl in paths:
+			if lvl in self.parts: continue
+			paths.extend(dep for dep in self.depends.get(lvl, ()) if split_path(dep)[0] == lvl)
+		return paths
+
+	def forget(self, lvl: str):
+		"""
+		Remove a value from dependency graph
+		"""
+		for dep in self.depends.pop(lvl, ()):
+			if dep in self.dependents: self.dependents[dep].discard(lvl)
+		self.nodes.pop(lvl, None)
+		self.parts.pop(lvl, None)
+		self.pending.pop(lvl, None)
+		self.resolved.discard(lvl)
+
+	def container(self, root: dict, path: str) -> dict | list | None:
+		"""
+		Get container value of path in a tree
+		"""
+		if len(path) <= 0: return root
+		parent, key = split_path(path)
+		node = self.container(root, parent)
+		if type(node) is dict and key in node: return node[key]
+		if type(node) is list and type(key) is int and key < len(node): return node[key]
+		return None
+
+	def update(self, orig: dict, path: str):
+		"""
+		Original config subtree at path changed, copy only the subtree and
+		re-resolve values which depend on it
+		"""
+		parent, key = split_path(path)
+		while len(parent) > 0 and (
+			parent not in self.nodes or
+			type(self.container(orig, parent)) not in (dict, list)
+		):
+			path = parent
+			parent, key = split_path(path)
+		node = self.container(self.root, parent)
+		source = self.container(orig, parent)
+		if type(node) not in (dict, list) or type(source) is not type(node):
+			raise ValueError(f"cannot update subscript at {path}")
+
+		# drop old subtree and copy new subtree from original config
+		removed = self.subtree(path) if path in self.nodes else []
+		for lvl in removed:
+			self.forget(lvl)
+		paths: list[str] = []
+		exists = key in source if type(source) is dict else key < len(source)
+		if exists:
+			node[key] = deepcopy(source[key])
+			self.scan_one(node, key, path, paths)
+			self.link(paths)
+		elif type(node) is dict:
+			node.pop(key, None)
+		else:
+			raise ValueError(f"cannot remove list item at {path}")
+		if len(parent) > 0:
+			if exists: self.depends[parent].add(path)
+			else: self.depends[parent].discard(path)
+			self.dependents.setdefault(path, set()).add(parent)
+
+		# all values depend on changed path need resolve again
+		affected = set(paths)
+		queue = [path] + paths + removed
+		while queue:
+			lvl = queue.pop()
+			for dep in self.dependents.get(lvl, ()):
+				if dep in affected or dep not in self.nodes: continue
+				affected.add(dep)
+				queue.append(dep)
+		log.debug(f"re-resolving {len(affected)} values after {path} changed")
+		self.finish([lvl for lvl in self.depends if lvl in affected])
+
 	def __init__(self):
-		self.resolved = []
-		self.unresolved = []
-		self.count = 0
+		self.resolved = set()
+		self.unresolved = set()
+		self.nodes = {}
+		self.parts = {}
+		self.depends = {}
+		self.pending = {}
+		self.dependents = {}
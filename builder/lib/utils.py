@@ -1,9 +1,14 @@
 import os
 import io
 import yaml
+import fcntl
 import shlex
+import pickle
 import shutil
 import typing
+import hashlib
+from functools import lru_cache
+from contextlib import contextmanager
 from locale import setlocale, LC_ALL
 from builder.lib import json
 from logging import getLogger
@@ -21,16 +26,94 @@ def init_environment():
 	setlocale(LC_ALL, "C")
 
 
+# libyaml C loader is much faster than pure python loader
+yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# parsed configs, path to (mtime, size) and pickled data, in process only
+config_cache: dict[str, tuple[tuple[int, int], bytes]] = {}
+
+# resolved include graphs, (folder, path) to loaded files, their stamps and pickled tree
+config_tree_cache: dict[tuple[str, str], tuple[list[str], list[tuple[int, int]], bytes]] = {}
+
+
+def config_cache_dir() -> str | None:
+	"""
+	Folder of parsed configs cache, set ARCH_CONFIG_CACHE to empty to disable
+	"""
+	folder = os.getenv("ARCH_CONFIG_CACHE")
+	if folder is None:
+		base = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+		folder = os.path.join(base, "arch-image-builder", "configs")
+	return folder or None
+
+
+def parse_simple(path: str):
+	"""
+	Parse a yaml or json config file
+	"""
+	loaded = None
+	with open(path, "r", encoding="utf-8") as f:
+		if path.endswith((".yml", ".yaml")):
+			log.debug(f"load {path} as yaml")
+			loaded = yaml.load(f, Loader=yaml_loader)
+		elif path.endswith((".jsn", ".json")):
+			log.debug(f"load {path} as json")
+			loaded = json.load(f)
+	return loaded
+
+
+def load_cached(path: str, stamp: tuple[int, int]):
+	"""
+	Get parsed config from disk cache, or parse and save it
+	Disk cache is plain json, configs not representable in json are not saved
+	"""
+	folder = config_cache_dir()
+	cache = None
+	if folder:
+		key = hashlib.sha256(path.encode()).hexdigest()
+		cache = os.path.join(folder, f"{key}.json")
+		try:
+			with open(cache, "r", encoding="utf-8") as f:
+				cached = json.load(f)
+			if cached["path"] == path and tuple(cached["stamp"]) == stamp:
+				log.debug(f"load {path} from configs cache")
+				return cached["data"]
+		except FileNotFoundError: pass
+		except Exception as e:
+			log.debug(f"ignore bad configs cache {cache}: {e}")
+	data = parse_simple(path)
+	if cache:
+		try:
+			text = json.dumps({"path": path, "stamp": stamp, "data": data})
+			if json.loads(text)["data"] != data:
+				raise ValueError("not representable in json")
+			os.makedirs(folder, mode=0o0700, exist_ok=True)
+			tmp = f"{cache}.{os.getpid()}.tmp"
+			with open(tmp, "w", encoding="utf-8") as f:
+				f.write(text)
+			os.replace(tmp, cache)
+		except (OSError, TypeError, ValueError) as e:
+			log.debug(f"skip configs cache {cache}: {e}")
+	return data
+
+
 def load_simple(path: str):
+	"""
+	Load a yaml or json config file
+	Parsed files are cached by mtime and size in process and on disk,
+	every call returns a new copy
+	"""
 	log.debug(f"try to open config {path}")
 	try:
-		with open(path, "r", encoding="utf-8") as f:
-			if path.endswith((".yml", ".yaml")):
-				log.debug(f"load {path} as yaml")
-				loaded = yaml.safe_load(f)
-			elif path.endswith((".jsn", ".json")):
-				log.debug(f"load {path} as json")
-				loaded = json.load(f)
+		real = os.path.realpath(path)
+		st = os.stat(real)
+		stamp = (st.st_mtime_ns, st.st_size)
+		cached = config_cache.get(real)
+		if cached is None or cached[0] != stamp:
+			data = load_cached(real, stamp)
+			cached = (stamp, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+			config_cache[real] = cached
+		loaded = pickle.loads(cached[1])
 		log.info(f"loaded config {path}")
 	except BaseException:
 		log.error(f"failed to load config {path}")
@@ -38,6 +121,131 @@ def load_simple(path: str):
 	return loaded
 
 
+def dict_merge(dst: dict, src: dict):
+	"""
+	Merge two dict with override
+	"""
+	for key in src.keys():
+		st = type(src[key])
+		if key in dst and st is type(dst[key]):
+			if st == list:
+				dst[key].extend(src[key])
+				continue
+			if st == dict:
+				dict_merge(dst[key], src[key])
+				continue
+		dst[key] = src[key]
+
+
+@lru_cache(maxsize=None)
+def find_config_files(folder: str, config: str) -> tuple[str, ...]:
+	"""
+	Find files of a config name with all suffixes, cached for shared includes
+	"""
+	paths: list[str] = []
+	for suffix in ["yml", "yaml", "jsn", "json"]:
+		path = os.path.join(folder, "configs", f"{config}.{suffix}")
+		if os.path.exists(path): paths.append(path)
+	return tuple(paths)
+
+
+def config_stamps(paths: list[str]) -> list[tuple[int, int]] | None:
+	"""
+	Current (mtime, size) of files, None when any file is gone
+	"""
+	stamps: list[tuple[int, int]] = []
+	for path in paths:
+		try: st = os.stat(os.path.realpath(path))
+		except FileNotFoundError: return None
+		stamps.append((st.st_mtime_ns, st.st_size))
+	return stamps
+
+
+def resolve_config_file(folder: str, path: str) -> tuple[dict, list[str]]:
+	"""
+	Resolve one config file with all includes into a new tree
+	Trees are cached per file by stamps of all included files,
+	every call returns a new copy and the loaded files in load order
+	"""
+	key = (folder, os.path.realpath(path))
+	cached = config_tree_cache.get(key)
+	if cached is not None and config_stamps(cached[0]) == cached[1]:
+		log.debug(f"use resolved config tree of {path}")
+		return pickle.loads(cached[2]), list(cached[0])
+	tree: dict = {}
+	files: list[str] = []
+	load_config_tree(folder, path, tree, files)
+	# stamps seen when files parsed, a file changed meanwhile misses next time
+	stamps = [config_cache[os.path.realpath(file)][0] for file in files]
+	config_tree_cache[key] = (files, stamps, pickle.dumps(tree, pickle.HIGHEST_PROTOCOL))
+	return tree, list(files)
+
+
+def merge_config_file(folder: str, path: str, merged: dict, files: list[str] = None):
+	"""
+	Merge one config file into merged, +also includes before and +then includes after it
+	"""
+	tree, loaded = resolve_config_file(folder, path)
+	if files is not None: files.extend(loaded)
+	log.debug(f"merge {path} into current config")
+	dict_merge(merged, tree)
+
+
+def load_config_tree(folder: str, path: str, merged: dict, files: list[str]):
+	"""
+	Walk include graph of one config file and merge it into merged
+	"""
+	loaded = load_simple(path)
+	files.append(path)
+	def _proc_include(inc: str | list[str]):
+		pt = type(inc)
+		if pt is str: inc = [inc]
+		elif pt is list: pass
+		else: raise ValueError(f"bad type for include in {path}")
+		merge_configs(folder, inc, merged, files)
+	if loaded is None: return
+	if "+also" in loaded:
+		_proc_include(loaded.pop("+also"))
+	then = loaded.pop("+then", None)
+	dict_merge(merged, loaded)
+	if then is not None:
+		_proc_include(then)
+
+
+def merge_configs(folder: str, configs: list[str], merged: dict, files: list[str] = None) -> int:
+	"""
+	Merge configs by name from folder/configs with all includes into merged,
+	without build context, record every loaded file in load order into files
+	"""
+	loaded = 0
+	for config in configs:
+		paths = find_config_files(folder, config)
+		if len(paths) <= 0:
+			raise FileNotFoundError(f"config {config} not found")
+		for path in paths:
+			merge_config_file(folder, path, merged, files)
+			loaded += 1
+	return loaded
+
+
+# hooks stages run before packages snapshot
+snapshot_stages = ("start", "pre-init", "pre-build", "pre-pacman")
+
+
+def layer_key(config: dict) -> str:
+	"""
+	Key of shared rootfs snapshot after packages installed,
+	presets with same packages and early hooks can share one snapshot
+	"""
+	hooks = config.get("scripts", []) + config.get("filesystem", {}).get("files", [])
+	data = json.dumps({
+		"arch": config.get("arch"),
+		"pacman": config.get("pacman"),
+		"hooks": [hook for hook in hooks if hook.get("stage") in snapshot_stages],
+	}, sort_keys=True)
+	return hashlib.sha256(data.encode()).hexdigest()
+
+
 def str_find_all(
 	orig: str,
 	keys: list[str] | tuple[str] | str,
@@ -239,3 +447,69 @@ def path_to_name(path: str) -> str:
 	if path.startswith("/"): path = path[1:]
 	if len(path) <= 0: return "empty"
 	return path.replace("/", "-")
+
+
+def hash_file(path: str, algo: str = "sha256") -> str:
+	"""
+	Calculate hex digest of a file
+	hash_file("/etc/hostname") = "8f434346648f6b96df89dda901c5176b10a6d83961dd3c1ac88b59b2dc327aa4"
+	"""
+	h = hashlib.new(algo)
+	with open(path, "rb") as f:
+		while True:
+			block = f.read(0x100000)
+			if not block: break
+			h.update(block)
+	return h.hexdigest()
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False):
+	"""
+	Hold an advisory lock on a file
+	with file_lock("/var/cache/builder/.lock"): ...
+	"""
+	fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o0644)
+	try:
+		fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+		yield fd
+	finally:
+		os.close(fd)
+
+
+def tree_size(path: str) -> int:
+	"""
+	Get disk usage of a folder in bytes, hard links only counted once
+	tree_size("/boot") = 104857600
+	"""
+	total = 0
+	inodes: set[tuple[int, int]] = set()
+	for root, dirs, files in os.walk(path):
+		for name in dirs + files:
+			st = os.lstat(os.path.join(root, name))
+			ino = (st.st_dev, st.st_ino)
+			if ino in inodes: continue
+			inodes.add(ino)
+			total += st.st_blocks * 512
+	return total
+
+
+def link_file(src: str, dst: str) -> str:
+	"""
+	Populate a file by hard link, reflink or copy, return the method used
+	link_file("/var/cache/builder/a.pkg", "/tmp/a.pkg") = "hardlink"
+	"""
+	if os.path.exists(dst): os.remove(dst)
+	try:
+		os.link(src, dst)
+		return "hardlink"
+	except OSError:
+		pass
+	with open(src, "rb") as fs, open(dst, "wb") as fd:
+		try:
+			# FICLONE, share extents on btrfs / xfs
+			fcntl.ioctl(fd.fileno(), 0x40049409, fs.fileno())
+			return "reflink"
+		except OSError:
+			shutil.copyfileobj(fs, fd, 0x100000)
+	return "copy"
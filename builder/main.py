@@ -1,14 +1,15 @@
 import os
 import logging
 from sys import stdout
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from builder import batch
 from builder.build import bootstrap, package
 from builder.lib import config, utils
 from builder.lib.context import ArchBuilderContext
 log = logging.getLogger(__name__)
 
 
-def parse_arguments(ctx: ArchBuilderContext):
+def parse_arguments(ctx: ArchBuilderContext) -> Namespace:
 	parser = ArgumentParser(
 		prog="arch-image-builder",
 		description="Build flashable image for Arch Linux",
@@ -22,6 +23,26 @@ def parse_arguments(ctx: ArchBuilderContext):
 	parser.add_argument("-d", "--debug",       help="Enable debug logging", default=False, action='store_true')
 	parser.add_argument("-G", "--no-gpgcheck", help="Disable GPG check", default=False, action='store_true')
 	parser.add_argument("-r", "--repack",      help="Repack rootfs only", default=False, action='store_true')
+	parser.add_argument("-u", "--update",      help="Upgrade existing rootfs in place", default=False, action='store_true')
+	parser.add_argument("--no-checkpoint",     help="Rebuild all rootfs stages", default=False, action='store_true')
+	parser.add_argument("--no-refresh",        help="Use existing pacman databases without refresh", default=False, action='store_true')
+	parser.add_argument("--no-probe",          help="Use servers in config order without probing mirrors", default=False, action='store_true')
+	parser.add_argument("--snapshot-cache",    help="Set rootfs snapshots cache folder", default=os.getenv("ARCH_SNAPSHOT_CACHE"))
+	parser.add_argument("--snapshot-limit",    help="Set rootfs snapshots cache size limit")
+	parser.add_argument("--package-cache",     help="Set packages cache folder shared by all workspaces", default=os.getenv("ARCH_PACKAGE_CACHE"))
+	parser.add_argument("--package-cache-limit", help="Set shared packages cache size limit")
+	parser.add_argument("--keyring-cache",     help="Set pacman keyring cache folder", default=os.getenv("ARCH_KEYRING_CACHE"))
+	parser.add_argument("--proxy-cache",       help="Enable embedded caching mirror proxy with store folder", default=os.getenv("ARCH_PROXY_CACHE"))
+	parser.add_argument("--download-jobs",     help="Set parallel connections to download packages", type=int)
+	parser.add_argument("--no-pipeline",       help="Download packages after keyring initialized", default=False, action='store_true')
+	parser.add_argument("--no-preverify",      help="Verify packages signatures in pacman only", default=False, action='store_true')
+	parser.add_argument("--fast-bootstrap",    help="Extract packages directly into empty rootfs", default=False, action='store_true')
+	parser.add_argument("--lock",              help="Install exactly packages in lock file")
+	parser.add_argument("--write-lock",        help="Write resolved packages into lock file", nargs="?", const="")
+	parser.add_argument("--trace",             help="Write build timeline as trace event json")
+	parser.add_argument("-P", "--presets",     help="Select multiple presets to build in batch", action='append')
+	parser.add_argument("-A", "--all-presets", help="Build all presets in batch", default=False, action='store_true')
+	parser.add_argument("-j", "--jobs",        help="Set parallel jobs for batch build", default=4, type=int)
 	args = parser.parse_args()
 
 	# debug logging
@@ -32,9 +53,34 @@ def parse_arguments(ctx: ArchBuilderContext):
 	if args.no_gpgcheck: ctx.gpgcheck = False
 	if args.repack: ctx.repack = True
 	if args.clean: ctx.clean = True
+	if args.no_checkpoint: ctx.checkpoint = False
+	if args.update: ctx.update = True
+	if args.no_refresh: ctx.refresh = False
+	if args.no_probe: ctx.probe_mirrors = False
+	if args.no_pipeline: ctx.pipeline = False
+	if args.no_preverify: ctx.preverify = False
+	if args.fast_bootstrap: ctx.fast_bootstrap = True
+	if args.lock: ctx.lock = os.path.realpath(args.lock)
+	if args.write_lock is not None:
+		ctx.write_lock = os.path.realpath(args.write_lock) if args.write_lock else ""
+	if ctx.lock and ctx.write_lock is not None:
+		raise RuntimeError("lock and write-lock should not be used at the same time")
+	if args.snapshot_cache: ctx.snapshot_cache = os.path.realpath(args.snapshot_cache)
+	if args.download_jobs is not None: ctx.download_jobs = args.download_jobs
+	if args.trace: ctx.trace = os.path.realpath(args.trace)
+	if args.snapshot_limit: ctx.snapshot_limit = utils.size_to_bytes(args.snapshot_limit)
+	if args.keyring_cache: ctx.keyring_cache = os.path.realpath(args.keyring_cache)
+	if args.proxy_cache: ctx.proxy_cache = os.path.realpath(args.proxy_cache)
+	if args.package_cache: ctx.package_cache = os.path.realpath(args.package_cache)
+	if args.package_cache_limit: ctx.package_cache_limit = utils.size_to_bytes(args.package_cache_limit)
 	if ctx.clean and ctx.repack:
 		raise RuntimeError("clean and repack should not be used at the same time")
+	if ctx.update and (ctx.clean or ctx.repack):
+		raise RuntimeError("update should not be used with clean or repack")
+	return args
 
+
+def load_arguments(ctx: ArchBuilderContext, args: Namespace):
 	# collect configs path
 	configs = []
 	if args.config:
@@ -83,11 +129,33 @@ def main():
 	ctx.dir = os.path.realpath(os.path.join(os.path.dirname(__file__), os.path.pardir))
 	ctx.work = os.path.realpath(os.path.join(ctx.dir, "build"))
 	ctx.artifacts = ctx.work
-	parse_arguments(ctx)
+	args = parse_arguments(ctx)
+
+	# build multiple presets via worker processes
+	if args.presets or args.all_presets:
+		presets: list[str] = []
+		if args.all_presets: presets.extend(batch.find_presets(ctx))
+		for preset in args.presets or []:
+			presets.extend(preset.split(","))
+		ctx.work = os.path.realpath(args.workspace)
+		ctx.artifacts = os.path.realpath(args.artifacts)
+		try: batch.build_presets(ctx, args, presets)
+		finally: ctx.cleanup()
+		return
+
+	load_arguments(ctx, args)
 	log.info(f"package version:    {ctx.version}")
 	log.info(f"source tree folder: {ctx.dir}")
 	log.info(f"workspace folder:   {ctx.work}")
 	log.info(f"build target name:  {ctx.target}")
-	bootstrap.build_rootfs(ctx)
-	if ctx.preset:
-		package.done_package(ctx)
+	profile = os.path.join(ctx.get_output(), "profile.json")
+	if os.path.exists(profile): os.remove(profile)
+	try:
+		with ctx.profile.span("build", ctx.target):
+			bootstrap.build_rootfs(ctx)
+			if ctx.preset:
+				with ctx.profile.span("step", "package"):
+					package.done_package(ctx)
+	finally:
+		ctx.profile.save(profile)
+		if ctx.trace: ctx.profile.save_trace(ctx.trace)
@@ -1,7 +1,9 @@
 import os
+import hashlib
 import logging
 from sys import stderr
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from builder.lib import json, utils
 log = logging.getLogger(__name__)
 
@@ -32,6 +34,11 @@ class WorkflowHelper:
 	"""
 	filter_auto: bool = False
 
+	"""
+	Resolve includes of presets and output build matrix info
+	"""
+	matrix: bool = False
+
 
 def parse_arguments(ctx: WorkflowHelper):
 	parser = ArgumentParser(
@@ -42,6 +49,7 @@ def parse_arguments(ctx: WorkflowHelper):
 	parser.add_argument("--list-presets",      help="List presets", default=False, action='store_true')
 	parser.add_argument("--filter-arch",       help="Filter with CPU architecture")
 	parser.add_argument("--filter-auto",       help="Filter with auto", default=False, action='store_true')
+	parser.add_argument("--matrix",            help="Resolve includes and output matrix info", default=False, action='store_true')
 	args = parser.parse_args()
 
 	# debug logging
@@ -55,12 +63,57 @@ def parse_arguments(ctx: WorkflowHelper):
 		ctx.filter_arch.append(args.filter_arch)
 
 	ctx.filter_auto = args.filter_auto
+	ctx.matrix = args.matrix
+
+
+# keys naming a preset only, not changing what it builds
+identity_keys = ("target", "workflows")
+
+
+def resolve_preset(folder: str, name: str) -> dict:
+	"""
+	Resolve full include graph of a preset, run in worker process
+	Return resolved arch, content hash of merged config and base layer key
+	"""
+	merged: dict = {}
+	utils.merge_configs(folder, [f"presets/{name}"], merged)
+	configs = list(merged.get("package", {}).get("configs", []))
+	utils.merge_configs(folder, configs, merged)
+
+	# same merged config always produces same image
+	content = {key: value for key, value in merged.items() if key not in identity_keys}
+	content = json.dumps(content, sort_keys=True)
+	return {
+		"resolved_arch": merged.get("arch"),
+		"hash": hashlib.sha256(content.encode()).hexdigest(),
+		"layer": utils.layer_key(merged),
+	}
+
+
+def matrix_presets(ctx: WorkflowHelper, results: list[dict]) -> list[dict]:
+	"""
+	Resolve presets in a process pool, mark duplicated builds and
+	put the first preset of every shared base layer in front
+	"""
+	names = [result["preset"] for result in results]
+	with ProcessPoolExecutor() as pool:
+		infos = list(pool.map(resolve_preset, [ctx.dir] * len(names), names))
+	hashes: dict[str, str] = {}
+	layers: dict[str, str] = {}
+	for result, info in zip(results, infos):
+		result.update(info)
+		result["duplicate"] = hashes.setdefault(info["hash"], result["preset"])
+		result["layer_first"] = layers.setdefault(info["layer"], result["preset"]) == result["preset"]
+		if result["duplicate"] == result["preset"]: result["duplicate"] = None
+		else: log.debug(f"preset {result['preset']} is same as {result['duplicate']}")
+	log.debug(f"{len(results)} presets in {len(layers)} shared base layers")
+	return sorted(results, key=lambda result: not result["layer_first"])
 
 
 def list_presets(ctx: WorkflowHelper):
 	results: list[dict[str, str]] = []
 	presets = os.path.join(ctx.dir, "configs", "presets")
-	for preset in os.listdir(presets):
+	for preset in sorted(os.listdir(presets)):
 		if not preset.endswith((".yaml", ".yml", ".jsn", ".json")):
 			continue
 		path = os.path.join(presets, preset)
@@ -72,6 +125,7 @@ def list_presets(ctx: WorkflowHelper):
 			config = utils.load_simple(path)
 		except:
 			log.warning(f"load {name} failed", exc_info=True)
+			continue
 		if "workflows" not in config:
 			log.debug(f"skip {name} because no workflows")
 			continue
@@ -93,6 +147,8 @@ def list_presets(ctx: WorkflowHelper):
 			"arch": config["workflows"]["arch"],
 			"runner": runners[config["workflows"]["arch"]],
 		})
+	if ctx.matrix:
+		results = matrix_presets(ctx, results)
 	print(json.dumps(results))
 
 
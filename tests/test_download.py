@@ -0,0 +1,167 @@
+import os
+import hashlib
+import threading
+import pytest
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from builder.lib import download
+from builder.lib.download import Downloader, DownloadItem, DownloadError
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+	"""
+	Serve files of server.files, fail first server.failures requests of a path
+	"""
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, *args): pass
+
+	def do_GET(self):
+		srv = self.server
+		with srv.lock:
+			srv.requests.append(self.path)
+			failures = srv.failures.get(self.path, 0)
+			if failures > 0: srv.failures[self.path] = failures - 1
+		if failures > 0:
+			self.send_error(500)
+			return
+		if self.path not in srv.files:
+			self.send_error(404)
+			return
+		since = self.headers.get("If-Modified-Since")
+		if since and parsedate_to_datetime(since).timestamp() >= srv.mtime:
+			self.send_response(304)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+		data = srv.files[self.path]
+		self.send_response(200)
+		self.send_header("Content-Length", str(len(data)))
+		self.send_header("Last-Modified", formatdate(srv.mtime, usegmt=True))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+@pytest.fixture
+def mirrors(monkeypatch):
+	"""
+	Start two local mirrors, return their base urls and servers
+	"""
+	for name in ["http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"]:
+		monkeypatch.delenv(name, raising=False)
+	monkeypatch.setattr(download.time, "sleep", lambda _: None)
+	servers: list[ThreadingHTTPServer] = []
+	for _ in range(2):
+		srv = ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+		srv.files, srv.failures, srv.requests = {}, {}, []
+		srv.mtime = 1700000000
+		srv.lock = threading.Lock()
+		threading.Thread(target=srv.serve_forever, args=(0.05,), daemon=True).start()
+		servers.append(srv)
+	yield [f"http://127.0.0.1:{srv.server_port}" for srv in servers], servers
+	for srv in servers:
+		srv.shutdown()
+		srv.server_close()
+
+
+def make_item(urls: list[str], dest: str, filename: str, data: bytes = None, **kwargs) -> DownloadItem:
+	if data is not None:
+		kwargs.setdefault("size", len(data))
+		kwargs.setdefault("sha256", hashlib.sha256(data).hexdigest())
+	return DownloadItem(filename, [f"{url}/{filename}" for url in urls], dest, **kwargs)
+
+
+def test_download_retry(mirrors, tmp_path):
+	urls, servers = mirrors
+	data = b"package" * 1000
+	servers[0].files["/foo.pkg"] = data
+	servers[0].failures["/foo.pkg"] = 2
+	item = make_item(urls[:1], str(tmp_path), "foo.pkg", data)
+	failed = Downloader(jobs=2, retry=3).fetch([item])
+	assert failed == []
+	assert item.done
+	assert (tmp_path / "foo.pkg").read_bytes() == data
+	assert servers[0].requests.count("/foo.pkg") == 3
+	assert not os.path.exists(tmp_path / ".foo.pkg.part")
+
+
+def test_download_failover(mirrors, tmp_path):
+	urls, servers = mirrors
+	data = b"package"
+	servers[0].failures["/foo.pkg"] = 100
+	servers[1].files["/foo.pkg"] = data
+	item = make_item(urls, str(tmp_path), "foo.pkg", data)
+	assert Downloader(retry=0).fetch([item]) == []
+	assert (tmp_path / "foo.pkg").read_bytes() == data
+	assert servers[1].requests == ["/foo.pkg"]
+
+
+def test_download_mismatch(mirrors, tmp_path):
+	urls, servers = mirrors
+	servers[0].files["/bad-sum.pkg"] = b"corrupted"
+	servers[0].files["/bad-size.pkg"] = b"short"
+	servers[1].files["/bad-sum.pkg"] = b"expected!"
+	bad_sum = make_item(urls, str(tmp_path), "bad-sum.pkg", b"expected!")
+	bad_size = make_item(urls[:1], str(tmp_path), "bad-size.pkg", size=100)
+	failed = Downloader(retry=1).fetch([bad_sum, bad_size])
+	assert failed == [bad_size]
+	assert (tmp_path / "bad-sum.pkg").read_bytes() == b"expected!"
+	assert not (tmp_path / "bad-size.pkg").exists()
+	assert sorted(os.listdir(tmp_path)) == ["bad-sum.pkg"]
+
+
+def test_download_optional_missing(mirrors, tmp_path):
+	urls, servers = mirrors
+	item = make_item(urls, str(tmp_path), "foo.pkg.sig", optional=True)
+	assert Downloader(retry=3).fetch([item]) == []
+	assert not item.done
+	assert servers[0].requests == ["/foo.pkg.sig"]
+	assert servers[1].requests == ["/foo.pkg.sig"]
+
+	required = make_item(urls, str(tmp_path), "bar.pkg")
+	assert Downloader(retry=3).fetch([required]) == [required]
+
+
+def test_fetch_modified(mirrors, tmp_path):
+	urls, servers = mirrors
+	servers[0].files["/core.db"] = b"database"
+	item = make_item(urls[:1], str(tmp_path), "core.db")
+	dl = Downloader(retry=0)
+	changed, _ = dl.fetch_modified(item)
+	assert changed
+	assert os.path.getmtime(item.path) == servers[0].mtime
+
+	# unchanged on server, local file kept
+	item = make_item(urls[:1], str(tmp_path), "core.db")
+	changed, _ = dl.fetch_modified(item)
+	assert not changed
+	assert item.done
+	assert (tmp_path / "core.db").read_bytes() == b"database"
+
+	# force always downloads
+	servers[0].files["/core.db"] = b"database2"
+	changed, _ = dl.fetch_modified(item, force=True)
+	assert changed
+	assert (tmp_path / "core.db").read_bytes() == b"database2"
+
+	missing = make_item(urls, str(tmp_path), "extra.db")
+	with pytest.raises(DownloadError):
+		dl.fetch_modified(missing)
+
+
+def test_fetch_modified_optional(mirrors, tmp_path):
+	urls, servers = mirrors
+	servers[0].files["/core.db.sig"] = b"signature"
+	item = make_item(urls, str(tmp_path), "core.db.sig", optional=True)
+	dl = Downloader(retry=2)
+	changed, _ = dl.fetch_modified(item)
+	assert changed
+	assert (tmp_path / "core.db.sig").read_bytes() == b"signature"
+
+	# signature dropped on server, stale local one removed
+	del servers[0].files["/core.db.sig"]
+	changed, _ = dl.fetch_modified(item)
+	assert changed
+	assert not (tmp_path / "core.db.sig").exists()
+	changed, _ = dl.fetch_modified(item)
+	assert not changed
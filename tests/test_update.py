@@ -0,0 +1,116 @@
+import os
+import io
+import tarfile
+import pytest
+from types import SimpleNamespace
+from builder.lib.checkpoint import installed_versions, diff_versions
+
+
+def make_local(root: str, entries: list[str]):
+	"""
+	Create local database entries NAME-VERSION-RELEASE in rootfs
+	"""
+	for entry in entries:
+		os.makedirs(os.path.join(root, "var/lib/pacman/local", entry))
+
+
+def make_sync(root: str, repo: str, packages: list[tuple]):
+	"""
+	Create sync database of (NAME, VERSION, DEPENDS, PROVIDES, CONFLICTS) in rootfs
+	"""
+	sync = os.path.join(root, "var/lib/pacman/sync")
+	os.makedirs(sync, exist_ok=True)
+	with tarfile.open(os.path.join(sync, f"{repo}.db"), "w:gz") as tar:
+		for name, version, depends, provides, conflicts in packages:
+			lines: list[str] = []
+			for field, values in [
+				("FILENAME", [f"{name}-{version}-x86_64.pkg.tar.zst"]),
+				("NAME", [name]),
+				("VERSION", [version]),
+				("ARCH", ["x86_64"]),
+				("DEPENDS", depends),
+				("PROVIDES", provides),
+				("CONFLICTS", conflicts),
+			]:
+				if len(values) > 0: lines += [f"%{field}%", *values, ""]
+			folder = tarfile.TarInfo(f"{name}-{version}")
+			folder.type = tarfile.DIRTYPE
+			folder.mode = 0o755
+			tar.addfile(folder)
+			data = "\n".join(lines).encode()
+			desc = tarfile.TarInfo(f"{name}-{version}/desc")
+			desc.size = len(data)
+			tar.addfile(desc, io.BytesIO(data))
+
+
+def make_pacman(tmp_path, root: str, repos: list[str]):
+	"""
+	Create pacman context for resolving only, without config and keyring
+	"""
+	pyalpm = pytest.importorskip("pyalpm")
+	from builder.component.pacman import Pacman
+	pacman = Pacman.__new__(Pacman)
+	pacman.ctx = SimpleNamespace(work=str(tmp_path / "work"), tgt_arch="x86_64")
+	pacman.root = root
+	pacman.handle = pyalpm.Handle(root, os.path.join(root, "var/lib/pacman"))
+	pacman.databases = {repo: pacman.handle.register_syncdb(repo, 0) for repo in repos}
+	pacman.package_map, pacman.lookup_cache = {}, {}
+	pacman.index_names = None
+	return pacman
+
+
+def test_update_upgrade_and_remove(tmp_path):
+	root = str(tmp_path)
+	make_local(root, [
+		"glibc-2.40-1",
+		"lib32-gcc-libs-14.1-1",
+		"foo-1.0-1",
+		"bar-1:2.0-1",
+	])
+	installed = installed_versions(root)
+	assert installed["lib32-gcc-libs"] == "14.1-1"
+	assert installed["bar"] == "1:2.0-1"
+
+	# resolved closure of DATABASE/PACKAGE keyed by bare names
+	wanted = {
+		"glibc": "2.40-1",
+		"lib32-gcc-libs": "14.1-1",
+		"foo": "1.1-1",
+	}
+	changed, stale = diff_versions(installed, wanted)
+	assert changed == ["foo"]
+	assert stale == ["bar"]
+
+
+def test_update_new_package(tmp_path):
+	root = str(tmp_path)
+	make_local(root, ["glibc-2.40-1"])
+	changed, stale = diff_versions(installed_versions(root), {
+		"glibc": "2.40-1",
+		"baz": "3.0-2",
+	})
+	assert changed == ["baz"]
+	assert stale == []
+
+
+def test_update_installed_provider(tmp_path):
+	root = str(tmp_path / "rootfs")
+	make_sync(root, "extra", [
+		("mesa", "24.1-1", [], ["libgl"], []),
+		("mesa-qcom-git", "24.2-1", [], ["mesa=24.2", "libgl"], ["mesa"]),
+		("app", "1.0-1", ["mesa", "libgl"], [], []),
+	])
+	make_local(root, ["mesa-qcom-git-24.1-1", "app-1.0-1"])
+	pacman = make_pacman(tmp_path, root, ["extra"])
+
+	# installed provider satisfies mesa, no conflicting mesa pulled
+	installed = installed_versions(root)
+	packages, wanted = pacman.wanted_packages(["app"], set(installed))
+	assert packages == {"app": "extra/app", "mesa-qcom-git": "extra/mesa-qcom-git"}
+	changed, stale = diff_versions(installed, wanted)
+	assert changed == ["mesa-qcom-git"]
+	assert stale == []
+
+	# fresh rootfs resolves mesa by literal name
+	packages, wanted = pacman.wanted_packages(["app"], set())
+	assert sorted(packages) == ["app", "mesa"]